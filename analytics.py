@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import time
+
+import config
+from database import ROLLUP_RANGE_SQL, db as default_db
+
+
+def bar(value: float, peak: float, width: int = None) -> str:
+    """Text chart bar for `value` on a scale where `peak` fills `width` characters"""
+    width = width or config.ANALYTICS_BAR_WIDTH
+    filled = round(width * value / peak) if peak > 0 else 0
+    return '█' * filled + '░' * (width - filled)
+
+
+class Analytics:
+    """Daily sales, revenue, signup and approval-latency rollups
+
+    rollup() folds reviewed purchases into daily_episode_sales and
+    daily_course_sales in purchase_id order, MAINTENANCE_BATCH_SIZE at a
+    time, and moves the high-water mark in the same transaction. Pending
+    purchases are passed over; reviewing one that the mark has passed
+    counts it right away (Database._transition_purchase), so each purchase
+    is counted exactly once and an unreviewed receipt holds nothing up.
+    Revenue uses the episode's price when the purchase is rolled up;
+    purchases of deleted episodes are skipped. The read methods only touch
+    the rollup tables, so their cost depends on the number of days and
+    courses shown, not on the size of purchases.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or default_db
+
+    async def rollup(self) -> dict:
+        """Roll up the purchases reviewed since the last run, within MAINTENANCE_TIME_BUDGET"""
+        deadline = time.monotonic() + config.MAINTENANCE_TIME_BUDGET
+        purchases = batches = 0
+        while True:
+            count = await self._rollup_batch()
+            if count:
+                purchases += count
+                batches += 1
+            if not count or time.monotonic() > deadline:
+                return {'purchases': purchases, 'batches': batches, 'high_water_mark': await self.high_water_mark()}
+            await asyncio.sleep(0)  # Let queued writers in between batches
+
+    async def _rollup_batch(self) -> int:
+        """Roll up the next batch of purchases; how many were read"""
+        async with self.db.writer() as db:
+            # Reading the mark inside the write transaction keeps concurrent runs apart
+            await db.execute('BEGIN IMMEDIATE')
+            async with db.execute("SELECT value FROM rollup_state WHERE name = 'purchases'") as cursor:
+                mark = (await cursor.fetchone())[0]
+            async with db.execute('''
+                SELECT COUNT(*), MAX(purchase_id) FROM (
+                    SELECT purchase_id FROM purchases
+                    WHERE purchase_id > ?
+                    ORDER BY purchase_id
+                    LIMIT ?
+                )
+            ''', (mark, config.MAINTENANCE_BATCH_SIZE)) as cursor:
+                count, upper = await cursor.fetchone()
+            if not count:
+                return 0
+            for statement in ROLLUP_RANGE_SQL:
+                await db.execute(statement, (mark, upper))
+            await db.execute("UPDATE rollup_state SET value = ? WHERE name = 'purchases'", (upper,))
+        return count
+
+    async def high_water_mark(self) -> int:
+        """The last purchase_id included in the rollups"""
+        async with self.db.reader() as db:
+            async with db.execute("SELECT value FROM rollup_state WHERE name = 'purchases'") as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def days(count: int = None) -> list:
+        """The last `count` UTC dates as 'YYYY-MM-DD', oldest first"""
+        count = count or config.ANALYTICS_DAYS
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        return [(today - datetime.timedelta(days=back)).isoformat() for back in range(count - 1, -1, -1)]
+
+    async def daily_totals(self, days: list) -> list:
+        """(day, sales, revenue, new_users, approval_seconds, timed_approvals) for each of `days`"""
+        totals = {day: [0, 0.0, 0, 0, 0] for day in days}
+        async with self.db.reader() as db:
+            async with db.execute('''
+                SELECT day, SUM(sales), SUM(revenue), SUM(approval_seconds), SUM(timed_approvals)
+                FROM daily_course_sales
+                WHERE day >= ? AND day <= ?
+                GROUP BY day
+            ''', (days[0], days[-1])) as cursor:
+                for day, sales, revenue, seconds, timed in await cursor.fetchall():
+                    totals[day][0:2] = sales, revenue
+                    totals[day][3:5] = seconds, timed
+            async with db.execute(
+                'SELECT day, new_users FROM daily_users WHERE day >= ? AND day <= ?', (days[0], days[-1])
+            ) as cursor:
+                for day, new_users in await cursor.fetchall():
+                    totals[day][2] = new_users
+        return [(day, *totals[day]) for day in days]
+
+    async def top_courses(self, days: list, limit: int = None):
+        """(course_id, sales, revenue, approval_seconds, timed_approvals) of the best-earning courses"""
+        async with self.db.reader() as db:
+            async with db.execute('''
+                SELECT course_id, SUM(sales), SUM(revenue), SUM(approval_seconds), SUM(timed_approvals)
+                FROM daily_course_sales
+                WHERE day >= ? AND day <= ?
+                GROUP BY course_id
+                HAVING SUM(sales) > 0
+                ORDER BY SUM(revenue) DESC, SUM(sales) DESC
+                LIMIT ?
+            ''', (days[0], days[-1], limit or config.ANALYTICS_TOP_COURSES)) as cursor:
+                return await cursor.fetchall()
+
+    async def course_daily(self, course_id: int, days: list) -> list:
+        """(day, sales, revenue) of one course for each of `days`"""
+        totals = {day: (0, 0.0) for day in days}
+        async with self.db.reader() as db:
+            async with db.execute('''
+                SELECT day, sales, revenue FROM daily_course_sales
+                WHERE day >= ? AND day <= ? AND course_id = ?
+            ''', (days[0], days[-1], course_id)) as cursor:
+                for day, sales, revenue in await cursor.fetchall():
+                    totals[day] = (sales, revenue)
+        return [(day, *totals[day]) for day in days]
+
+    async def course_episodes(self, course_id: int, days: list):
+        """(episode_id, sales, revenue, approval_seconds, timed_approvals) per episode of a course"""
+        async with self.db.reader() as db:
+            async with db.execute('''
+                SELECT episode_id, SUM(sales), SUM(revenue), SUM(approval_seconds), SUM(timed_approvals)
+                FROM daily_episode_sales
+                WHERE day >= ? AND day <= ? AND course_id = ?
+                GROUP BY episode_id
+                ORDER BY SUM(revenue) DESC, SUM(sales) DESC
+            ''', (days[0], days[-1], course_id)) as cursor:
+                return await cursor.fetchall()
+
+
+# Global analytics instance
+analytics = Analytics()
@@ -0,0 +1,80 @@
+"""Approving pending purchases one at a time vs in bulk
+
+Fills a fresh database with `--pending` pending purchases for each run,
+then approves all of them: one approve_purchase per row (one transaction
+each, as the single review screen does), approve_purchases per selected
+page of KEYBOARD_PAGE_SIZE, and a single approve_purchases over every row.
+Also reports how many user notifications notify_reviewed would queue.
+
+    python bench/bulk_review.py [--pending 1000] [--users 200]
+"""
+import argparse
+import asyncio
+import itertools
+import random
+
+from common import Timer, report, seeded_database
+
+import config
+
+
+async def pending_database(pending: int, users: int):
+    courses, episodes = 10, 20
+    db = await seeded_database(users, courses, episodes)
+    # One purchase per user and episode
+    pairs = list(itertools.product(range(1, users + 1), range(1, courses * episodes + 1)))
+    async with db.writer() as conn:
+        await conn.executemany(
+            'INSERT INTO purchases (user_id, episode_id, receipt_photo) VALUES (?, ?, ?)',
+            [(user_id, episode_id, 'receipt') for user_id, episode_id in random.sample(pairs, pending)]
+        )
+        async with conn.execute("SELECT purchase_id FROM purchases WHERE payment_status = 'pending'") as cursor:
+            ids = [row[0] for row in await cursor.fetchall()]
+    return db, ids
+
+
+async def one_by_one(db, ids):
+    moved = []
+    for purchase_id in ids:
+        moved.append(await db.approve_purchase(purchase_id))
+    return moved
+
+
+async def per_page(db, ids):
+    moved = []
+    for start in range(0, len(ids), config.KEYBOARD_PAGE_SIZE):
+        moved += await db.approve_purchases(ids[start:start + config.KEYBOARD_PAGE_SIZE])
+    return moved
+
+
+async def all_at_once(db, ids):
+    return await db.approve_purchases(ids)
+
+
+async def main(args):
+    print(f'{args.pending:,} pending purchases from {args.users} users')
+    runs = (
+        ('one by one', one_by_one),
+        (f'bulk, {config.KEYBOARD_PAGE_SIZE} per selection', per_page),
+        ('bulk, all selected', all_at_once),
+    )
+    for label, approve in runs:
+        db, ids = await pending_database(args.pending, args.users)
+        try:
+            with Timer() as timer:
+                moved = await approve(db, ids)
+            assert len(moved) == len(ids) and all(moved), 'not every purchase was approved'
+            report(label, len(ids), timer, 'approvals')
+            async with db.reader() as conn:
+                async with conn.execute("SELECT COUNT(*) FROM purchases WHERE payment_status = 'pending'") as cursor:
+                    assert (await cursor.fetchone())[0] == 0
+        finally:
+            await db.close()
+    print(f'notifications: {len(ids):,} one by one, {len({row[1] for row in moved}):,} grouped per user in bulk')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pending', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
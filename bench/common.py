@@ -0,0 +1,60 @@
+"""Helpers shared by the benchmark scripts in this directory"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# The bot's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def temp_path(name: str) -> str:
+    """A path for `name` inside a fresh temporary directory"""
+    return os.path.join(tempfile.mkdtemp(prefix='bench-'), name)
+
+
+async def seeded_database(users: int = 100, courses: int = 5, episodes: int = 10) -> database.Database:
+    """A migrated database in a temporary directory with users, courses and episodes"""
+    db = database.Database()
+    db.db_path = temp_path('bot.db')
+    await db.init_db()
+    for user_id in range(1, users + 1):
+        await db.add_user(user_id, f'user{user_id}', 'User')
+    await db.flush_users()
+    for course in range(courses):
+        course_id = await db.add_course(f'Course {course}', None, 10)
+        for number in range(1, episodes + 1):
+            await db.add_episode(course_id, f'Episode {number}', None, f'file-{course}-{number}', 5, number)
+    return db
+
+
+class Timer:
+    """Wall time of a block, plus per-operation latencies recorded with `lap`"""
+
+    def __init__(self):
+        self.latencies = []
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+
+    async def lap(self, awaitable):
+        started = time.perf_counter()
+        result = await awaitable
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+
+def report(label: str, operations: int, timer: Timer, unit: str = 'ops'):
+    """Print throughput and, when laps were recorded, latency percentiles"""
+    line = f'{label:<28} {operations / timer.seconds:>12,.0f} {unit}/s  ({operations:,} in {timer.seconds:.2f}s)'
+    if timer.latencies:
+        cuts = statistics.quantiles(timer.latencies, n=100)
+        line += f'  p50 {cuts[49] * 1000:.2f}ms  p99 {cuts[98] * 1000:.2f}ms'
+    print(line)
@@ -0,0 +1,80 @@
+"""Pooled connections vs a new aiosqlite connection per call
+
+Runs the queries behind a /start plus an episode page (user row, episode
+row, approved purchases) from concurrent tasks, once opening a connection
+per query as Database used to and once borrowing pooled connections.
+
+    python bench/db_pool.py [--updates 2000] [--concurrency 50] [--pool-size 4]
+"""
+import argparse
+import asyncio
+import random
+
+import aiosqlite
+
+from common import Timer, report, seeded_database
+
+QUERIES = (
+    ('SELECT is_admin, is_blocked FROM users WHERE user_id = ?', 'user'),
+    ('SELECT title, video_path, price FROM episodes WHERE episode_id = ?', 'episode'),
+    ("SELECT episode_id FROM purchases WHERE user_id = ? AND payment_status = 'approved'", 'user'),
+)
+
+
+def update_args(users: int, episodes: int):
+    return {'user': (random.randint(1, users),), 'episode': (random.randint(1, episodes),)}
+
+
+async def per_call(db, args):
+    for sql, param in QUERIES:
+        async with aiosqlite.connect(db.db_path) as conn:
+            async with conn.execute(sql, args[param]) as cursor:
+                await cursor.fetchall()
+
+
+async def pooled(db, args):
+    for sql, param in QUERIES:
+        async with db.reader() as conn:
+            async with conn.execute(sql, args[param]) as cursor:
+                await cursor.fetchall()
+
+
+async def run(label, handle, db, updates, concurrency, users, episodes):
+    queue = asyncio.Queue()
+    for _ in range(updates):
+        queue.put_nowait(update_args(users, episodes))
+
+    async def worker(timer):
+        while not queue.empty():
+            await timer.lap(handle(db, queue.get_nowait()))
+
+    with Timer() as timer:
+        await asyncio.gather(*(worker(timer) for _ in range(concurrency)))
+    report(label, updates, timer, 'updates')
+
+
+async def main(args):
+    users, courses, episodes = 1000, 10, 20
+    db = await seeded_database(users, courses, episodes)
+    await db.close()
+    db.pool_size = args.pool_size
+    await db.connect()
+    try:
+        total_episodes = courses * episodes
+        for user_id in range(1, users + 1, 3):
+            purchase_id = await db.create_purchase(user_id, random.randint(1, total_episodes), 'receipt')
+            await db.approve_purchase(purchase_id)
+
+        print(f'{args.updates:,} updates x {len(QUERIES)} queries, {args.concurrency} concurrent')
+        await run('per-call connect', per_call, db, args.updates, args.concurrency, users, total_episodes)
+        await run(f'pooled ({args.pool_size} readers)', pooled, db, args.updates, args.concurrency, users, total_episodes)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--pool-size', type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
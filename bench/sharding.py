@@ -0,0 +1,199 @@
+"""Update throughput in one process vs BOT_WORKERS sharded worker processes
+
+Replays raw updates (by default a generated session per user: /start, the
+course list and a course page; or `--replay FILE` with one recorded update
+per line) through the real routers. Bot API calls go to a stand-in server
+in its own process, never to Telegram. Each run is timed from the first
+update handed over until every queue has drained.
+
+    python bench/sharding.py [--users 1000] [--workers 1,2,4] [--replay updates.jsonl]
+"""
+import os
+
+# Before config is imported, here and in the spawned workers
+os.environ['BOT_TOKEN'] = '123456:bench'
+os.environ['ADMIN_ID'] = '1'
+os.environ.setdefault('TELEGRAM_API_BASE', 'http://127.0.0.1:1')  # Replaced in main() with the stand-in
+os.environ['DB_CHECKPOINT_INTERVAL'] = '0'
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import multiprocessing  # noqa: E402
+import socket  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+
+from aiohttp import web  # noqa: E402
+
+import common  # noqa: E402,F401  (puts the repository root on sys.path)
+import config  # noqa: E402
+
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'sendPhoto', 'sendVideo', 'copyMessage'}
+
+
+def stand_in(sock: socket.socket, calls):
+    """A Bot API that accepts every call; counts them in `calls`"""
+    async def method(request: web.Request):
+        data = await request.post()
+        with calls.get_lock():
+            calls.value += 1
+        if request.match_info['method'] not in MESSAGE_METHODS:
+            return web.json_response({'ok': True, 'result': True})
+        chat_id = int(data.get('chat_id', 0))
+        return web.json_response({'ok': True, 'result': {
+            'message_id': 1, 'date': int(time.time()), 'text': data.get('text', ''),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }})
+
+    app = web.Application()
+    app.router.add_route('*', '/bot{token}/{method}', method)
+    web.run_app(app, sock=sock, print=None)
+
+
+def session_updates(users: int, courses: int) -> list:
+    """/start, browse_courses and course_<id> for each user, interleaved across users"""
+    updates = []
+    for step in range(3):
+        for user_id in range(1000, 1000 + users):
+            sender = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+            chat = {'id': user_id, 'type': 'private'}
+            update = {'update_id': len(updates) + 1}
+            if step == 0:
+                update['message'] = {'message_id': 1, 'date': 0, 'chat': chat, 'from': sender, 'text': '/start',
+                                     'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}
+            else:
+                update['callback_query'] = {
+                    'id': str(update['update_id']), 'from': sender, 'chat_instance': str(user_id),
+                    'data': 'browse_courses' if step == 1 else f'course_{user_id % courses + 1}',
+                    'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': 'menu',
+                                'from': {'id': 123456, 'is_bot': True, 'first_name': 'Bot'}},
+                }
+            updates.append(update)
+    return updates
+
+
+def warmup_updates(workers: int) -> list:
+    """One /start per shard, from users that are not in the replay"""
+    return [{'update_id': 0, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': '/start',
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Warmup'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    }} for user_id in range(10 ** 6, 10 ** 6 + workers)]
+
+
+async def wait_for_calls(calls, count: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while calls.value < count:
+        if time.monotonic() > deadline:
+            raise RuntimeError('the warm-up updates were not answered; run with a visible stderr to see why')
+        await asyncio.sleep(0.01)
+
+
+async def submit_all(submit, updates):
+    for update in updates:
+        while not submit(update):
+            await asyncio.sleep(0.001)
+
+
+async def single_process(updates, calls) -> float:
+    from bot import create_bot, create_dispatcher
+    from database import db
+    from webhook import UpdateLanes, feed_raw_update
+
+    bot = create_bot()
+    dp = create_dispatcher(manage_lifecycle=False)
+    await db.init_db()
+    await db.load_roles()
+    lanes = UpdateLanes(lambda data: feed_raw_update(bot, dp, data))
+    lanes.start()
+    try:
+        await submit_all(lanes.submit, warmup_updates(1))
+        await wait_for_calls(calls, calls.value + 1)
+        started = time.perf_counter()
+        await submit_all(lanes.submit, updates)
+        await lanes.stop()
+        return time.perf_counter() - started
+    finally:
+        await db.close()
+        await bot.session.close()
+
+
+async def sharded(updates, calls, workers: int) -> float:
+    from database import db
+    from sharding import ShardedWorkers
+
+    pool = ShardedWorkers(db, workers)
+    pool.start()
+    try:
+        expected = calls.value + workers
+        await submit_all(pool.submit, warmup_updates(workers))
+        await wait_for_calls(calls, expected)
+        started = time.perf_counter()
+        await submit_all(pool.submit, updates)
+        await pool.stop()
+        return time.perf_counter() - started
+    finally:
+        await db.close()
+
+
+async def seed(courses: int, episodes: int):
+    from database import db
+    await db.init_db()
+    for course in range(courses):
+        course_id = await db.add_course(f'Course {course}', None, 10)
+        for number in range(1, episodes + 1):
+            await db.add_episode(course_id, f'Episode {number}', None, f'file-{course}-{number}', 5, number)
+    await db.close()
+
+
+def main(args):
+    # DATABASE_PATH is relative, and the workers start in this directory
+    os.chdir(tempfile.mkdtemp(prefix='bench-'))
+    os.makedirs('data')
+
+    context = multiprocessing.get_context('fork')
+    calls = context.Value('q', 0)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    # The environment is for the spawned workers; this process has read config already
+    os.environ['TELEGRAM_API_BASE'] = config.TELEGRAM_API_BASE = f'http://127.0.0.1:{sock.getsockname()[1]}'
+    server = context.Process(target=stand_in, args=(sock, calls), daemon=True)
+    server.start()
+    sock.close()
+
+    if args.replay:
+        with open(args.replay) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = session_updates(args.users, courses=10)
+
+    # The routers log every update at INFO; keep that off the report
+    stderr = os.dup(2)
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 2)
+    try:
+        asyncio.run(seed(courses=10, episodes=12))
+        print(f'{len(updates):,} updates, CPU count {os.cpu_count()}', flush=True)
+        for workers in map(int, args.workers.split(',')):
+            before = calls.value
+            if workers == 1:
+                seconds = asyncio.run(single_process(updates, calls))
+                label = 'single process'
+            else:
+                seconds = asyncio.run(sharded(updates, calls, workers))
+                label = f'{workers} sharded workers'
+            print(f'{label:<22} {len(updates) / seconds:>8,.0f} updates/s  ({seconds:.2f}s, '
+                  f'{calls.value - before - workers:,} API calls)', flush=True)
+    finally:
+        os.dup2(stderr, 2)
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--replay', help='JSONL file of recorded raw updates')
+    main(parser.parse_args())
@@ -0,0 +1,137 @@
+"""Server memory while 50 viewers stream the same local video
+
+Starts a server process per mode that answers GET /video with
+webapp.streaming.send_file, then has every viewer request `Range: bytes=0-`
+and read the whole file. Reports the server's peak RSS above its idle RSS,
+its open descriptors for the video, and the total throughput.
+
+Modes: sendfile (STREAM_SENDFILE=1), chunked (STREAM_SENDFILE=0) and read,
+the old handler's f.read(length) of the whole range. read holds
+viewers x file size in memory, so it only runs when asked for.
+
+    python bench/streaming.py [--viewers 50] [--size-mb 128] [--modes sendfile,chunked,read]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import time
+
+import aiohttp
+from aiohttp import web
+
+from common import temp_path
+
+import config
+from webapp.streaming import send_file
+
+
+def proc_status(pid: int, field: str) -> int:
+    """A kB field of /proc/<pid>/status, such as VmRSS or VmHWM"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def open_descriptors(pid: int, path: str) -> int:
+    fd_dir = f'/proc/{pid}/fd'
+    count = 0
+    for fd in os.listdir(fd_dir):
+        try:
+            count += os.readlink(os.path.join(fd_dir, fd)) == path
+        except OSError:
+            pass
+    return count
+
+
+def serve(sock: socket.socket, path: str, mode: str):
+    config.STREAM_SENDFILE = mode == 'sendfile'
+
+    async def video(request: web.Request):
+        if mode != 'read':
+            return await send_file(request, path, content_type='video/mp4')
+        with open(path, 'rb') as f:
+            data = f.read()  # bytes=0- is the whole file
+        return web.Response(status=206, body=data, content_type='video/mp4', headers={
+            'Content-Range': f'bytes 0-{len(data) - 1}/{len(data)}',
+        })
+
+    app = web.Application()
+    app.router.add_get('/video', video)
+    web.run_app(app, sock=sock, print=None, handle_signals=True)
+
+
+async def watch(session: aiohttp.ClientSession, url: str) -> int:
+    received = 0
+    async with session.get(url, headers={'Range': 'bytes=0-'}) as response:
+        assert response.status == 206, response.status
+        async for chunk in response.content.iter_chunked(256 * 1024):
+            received += len(chunk)
+    return received
+
+
+async def measure(pid: int, url: str, path: str, viewers: int, size: int):
+    async with aiohttp.ClientSession() as session:
+        for _ in range(50):
+            try:
+                async with session.get(url, headers={'Range': 'bytes=0-0'}) as response:
+                    await response.read()
+                break
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+        idle = proc_status(pid, 'VmRSS')
+
+        descriptors = 0
+
+        async def sample():
+            nonlocal descriptors
+            while True:
+                descriptors = max(descriptors, open_descriptors(pid, path))
+                await asyncio.sleep(0.05)
+
+        sampler = asyncio.ensure_future(sample())
+        started = time.perf_counter()
+        received = await asyncio.gather(*(watch(session, url) for _ in range(viewers)))
+        seconds = time.perf_counter() - started
+        sampler.cancel()
+
+    assert received == [size] * viewers, 'a viewer got a short body'
+    return idle, proc_status(pid, 'VmHWM'), descriptors, seconds
+
+
+def main(args):
+    size = args.size_mb * 1024 * 1024
+    path = temp_path('lecture.mp4')
+    with open(path, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    print(f'{args.viewers} viewers x {args.size_mb} MB, Range: bytes=0-')
+    context = multiprocessing.get_context('fork')
+    for mode in args.modes.split(','):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+        url = f'http://127.0.0.1:{sock.getsockname()[1]}/video'
+        server = context.Process(target=serve, args=(sock, path, mode), daemon=True)
+        server.start()
+        sock.close()
+        try:
+            idle, peak, descriptors, seconds = asyncio.run(measure(server.pid, url, path, args.viewers, size))
+        finally:
+            server.terminate()
+            server.join()
+        print(f'{mode:<10} peak RSS +{(peak - idle) / 1024:>8.1f} MB over idle {idle / 1024:.1f} MB'
+              f'  {descriptors} open handle(s)  {args.viewers * size / seconds / 1024 ** 2:,.0f} MB/s')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--viewers', type=int, default=50)
+    parser.add_argument('--size-mb', type=int, default=128)
+    parser.add_argument('--modes', default='sendfile,chunked')
+    main(parser.parse_args())
@@ -0,0 +1,65 @@
+"""Signed vs database-backed video token validation
+
+Issues tokens in each VIDEO_TOKEN_MODE and validates them from concurrent
+tasks, the way /api/manifest and /api/media hits do. Signed validation is
+measured with the episode metadata cache cold and warm.
+
+    python bench/video_tokens.py [--tokens 2000] [--validations 20000] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import itertools
+import random
+
+from common import Timer, report, seeded_database
+
+import config
+
+
+async def validate_all(db, tokens, validations, concurrency):
+    picks = iter([random.choice(tokens) for _ in range(validations)])
+    valid = 0
+
+    async def worker(timer):
+        nonlocal valid
+        for token in picks:
+            if await timer.lap(db.validate_token(token)):
+                valid += 1
+
+    with Timer() as timer:
+        await asyncio.gather(*(worker(timer) for _ in range(concurrency)))
+    assert valid == validations, f'{validations - valid} tokens failed validation'
+    return timer
+
+
+async def main(args):
+    courses, episodes = 10, 20
+    db = await seeded_database(users=100, courses=courses, episodes=episodes)
+    try:
+        pairs = list(itertools.product(range(1, 101), range(1, courses * episodes + 1)))
+        random.shuffle(pairs)
+        pairs = pairs[:args.tokens]
+        print(f'{args.tokens:,} tokens, {args.validations:,} validations, {args.concurrency} concurrent')
+
+        for mode in ('db', 'signed'):
+            config.VIDEO_TOKEN_MODE = mode
+            tokens = [await db.create_video_token(user_id, episode_id) for user_id, episode_id in pairs]
+            if mode == 'signed':
+                db._episode_meta.clear()
+                config.EPISODE_META_CACHE_SIZE = 0
+                report('signed (no episode cache)', args.validations,
+                       await validate_all(db, tokens, args.validations, args.concurrency), 'validations')
+                config.EPISODE_META_CACHE_SIZE = courses * episodes
+                await validate_all(db, tokens, courses * episodes * 10, args.concurrency)  # Warm the cache
+            report(mode, args.validations, await validate_all(db, tokens, args.validations, args.concurrency),
+                   'validations')
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tokens', type=int, default=2000)
+    parser.add_argument('--validations', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
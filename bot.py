@@ -2,12 +2,19 @@ import asyncio
 import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 
 import config
+from broadcast import broadcaster
 from database import db
+from export import exporter
+from fsm_storage import SQLiteStorage
 from handlers import user, admin, payment
+from middlewares.role import RoleMiddleware
+from maintenance import scheduler
+from outbox import outbox
 
 # Configure logging
 logging.basicConfig(
@@ -17,29 +24,50 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-async def on_startup():
-    """Initialize database on startup"""
+async def on_startup(bot: Bot, send_broadcasts: bool = True):
+    """Initialize database on startup and resume interrupted broadcasts
+
+    With send_broadcasts=False (the front process of sharded mode) this
+    process leaves broadcasts to worker 0.
+    """
     logger.info("Initializing database...")
     await db.init_db()
+    await db.load_roles()
     logger.info("Database initialized successfully!")
+    scheduler.start()
+    if send_broadcasts:
+        await broadcaster.resume(bot)
     logger.info("Bot started!")
 
 
 async def on_shutdown():
     """Cleanup on shutdown"""
     logger.info("Bot shutting down...")
+    await broadcaster.stop()
+    await exporter.stop()
+    await outbox.stop()
+    await scheduler.stop()
+    await db.close()
 
 
-async def main():
-    """Main bot function"""
-    # Initialize bot and dispatcher
-    bot = Bot(
+def create_bot() -> Bot:
+    """Create the Bot client"""
+    return Bot(
         token=config.BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(config.TELEGRAM_API_BASE)),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
-    
-    storage = MemoryStorage()
+
+
+def create_dispatcher(manage_lifecycle: bool = True) -> Dispatcher:
+    """Create the dispatcher with middlewares and routers
+
+    With manage_lifecycle=False the caller runs on_startup/on_shutdown itself,
+    as start.py does to order them around the web server.
+    """
+    storage = SQLiteStorage(db)
     dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(RoleMiddleware())
     
     # Register routers
     dp.include_router(user.router)
@@ -47,8 +75,18 @@ async def main():
     dp.include_router(payment.router)
     
     # Register startup/shutdown handlers
-    dp.startup.register(on_startup)
-    dp.shutdown.register(on_shutdown)
+    if manage_lifecycle:
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
+    
+    return dp
+
+
+async def main():
+    """Main bot function (polling; see start.py for webhook mode)"""
+    # Initialize bot and dispatcher
+    bot = create_bot()
+    dp = create_dispatcher()
     
     # Start polling
     logger.info("Starting bot polling...")
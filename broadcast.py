@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import CopyMessage
+
+import config
+from database import db as default_db
+from outbox import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """Copy an admin's message to every reachable user
+
+    Recipients are read in user_id order, BROADCAST_BATCH_SIZE at a time,
+    and each batch goes through the outbox at LOW priority, so the outbox
+    paces it to Telegram's limits and replies to users still go first.
+    After each batch the broadcast's last_user_id and counters are saved
+    with the users found blocked (403), so a restart resumes after the last
+    finished batch and later broadcasts skip dead chats. Pausing and
+    cancelling go through the broadcast's status in the database and are
+    noticed between batches, whichever process runs it.
+
+    With sharded workers only worker 0 sends (see sharding.py): the others
+    have `sender` off and just record the status, and worker 0 picks up
+    running broadcasts every BROADCAST_POLL_INTERVAL seconds. So a
+    broadcast is never sent twice at once, and all of them stay within
+    worker 0's share of OUTBOX_GLOBAL_RATE.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or default_db
+        self.sender = True  # False where another process sends the broadcasts
+        self._tasks = {}  # broadcast_id -> task running it in this process
+        self._watcher = None
+
+    async def start(self, bot: Bot, from_chat_id: int, message_id: int, preview: str = None) -> int:
+        """Create a broadcast of a message and start sending it"""
+        broadcast_id = await self.db.create_broadcast(from_chat_id, message_id, preview)
+        self.run(bot, broadcast_id)
+        return broadcast_id
+
+    def run(self, bot: Bot, broadcast_id: int):
+        """Send a running broadcast in the background, unless this process already is"""
+        if not self.sender or broadcast_id in self._tasks:
+            return
+        task = asyncio.ensure_future(self._send(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda done: self._finished(broadcast_id, done))
+
+    async def resume(self, bot: Bot):
+        """Continue the broadcasts a restart interrupted"""
+        for broadcast_id in await self.db.get_running_broadcasts():
+            logger.info(f"Resuming broadcast {broadcast_id}")
+            self.run(bot, broadcast_id)
+
+    def watch(self, bot: Bot):
+        """Resume interrupted broadcasts, then keep picking up ones started elsewhere"""
+        if self._watcher is None:
+            self._watcher = asyncio.ensure_future(self._watch(bot))
+
+    async def _watch(self, bot: Bot):
+        while True:
+            try:
+                await self.resume(bot)
+            except Exception:
+                logger.exception("Checking for running broadcasts failed")
+            await asyncio.sleep(config.BROADCAST_POLL_INTERVAL)
+
+    async def stop(self):
+        """Stop sending; running broadcasts stay 'running' and resume on the next start"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _finished(self, broadcast_id: int, task: asyncio.Task):
+        self._tasks.pop(broadcast_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Broadcast {broadcast_id} failed", exc_info=task.exception())
+
+    async def _send(self, bot: Bot, broadcast_id: int):
+        while True:
+            broadcast = await self.db.get_broadcast(broadcast_id)
+            if broadcast is None or broadcast[4] != 'running':
+                return  # Paused or cancelled
+            _, from_chat_id, message_id, _, _, _, last_user_id = broadcast[:7]
+
+            recipients = await self.db.get_broadcast_recipients(last_user_id, config.BROADCAST_BATCH_SIZE)
+            if not recipients:
+                await self.db.set_broadcast_status(broadcast_id, 'done', from_status='running')
+                logger.info(f"Broadcast {broadcast_id} finished")
+                return
+
+            results = await asyncio.gather(*(
+                outbox.send(bot, CopyMessage(
+                    chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id
+                ), priority=outbox.LOW)
+                for user_id in recipients
+            ), return_exceptions=True)
+
+            blocked_ids = [
+                user_id for user_id, result in zip(recipients, results)
+                if isinstance(result, TelegramForbiddenError)
+            ]
+            failed = sum(isinstance(result, BaseException) for result in results) - len(blocked_ids)
+            await self.db.save_broadcast_progress(
+                broadcast_id, recipients[-1], len(recipients) - failed - len(blocked_ids), failed, blocked_ids
+            )
+
+
+def progress(broadcast) -> dict:
+    """Percent done, send rate and estimated seconds left for a broadcast row"""
+    _, _, _, _, status, total, _, sent, failed, blocked, created_at, finished_at = broadcast
+    done = sent + failed + blocked
+    elapsed = max(1, (finished_at or int(time.time())) - created_at)
+    rate = done / elapsed
+    remaining = max(0, total - done)
+    return {
+        'done': done,
+        'percent': min(100, done * 100 // total) if total else 100,
+        'rate': rate,
+        'eta': int(remaining / rate) if rate and status == 'running' else None,
+    }
+
+
+# Global broadcaster (broadcasts started in this process)
+broadcaster = Broadcaster()
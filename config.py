@@ -1,26 +1,142 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+
+def _secret(name: str, purpose: str) -> str:
+    """The secret set in `name`, else one derived from BOT_TOKEN"""
+    secret = os.getenv(name)
+    if secret:
+        return secret
+    if not BOT_TOKEN:
+        raise RuntimeError(f'Set {name} or BOT_TOKEN: without either the {purpose} secret would be public')
+    return hashlib.sha256(f'{purpose}:{BOT_TOKEN}'.encode()).hexdigest()
+
+
 # Bot Configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # 'polling' or 'webhook' (webhook needs start.py)
 
 # Web App Configuration
 WEBAPP_URL = os.getenv('WEBAPP_URL', 'http://localhost:5000')
 WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
 WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 5000))
+WEBAPP_WORKERS = int(os.getenv('WEBAPP_WORKERS', 1))  # Server processes sharing the port
+WEBAPP_KEEPALIVE_TIMEOUT = int(os.getenv('WEBAPP_KEEPALIVE_TIMEOUT', 75))  # Seconds an idle connection stays open
+WEBAPP_REQUEST_TIMEOUT = int(os.getenv('WEBAPP_REQUEST_TIMEOUT', 30))  # Seconds per API request (not video streams)
+WEBAPP_SHUTDOWN_TIMEOUT = int(os.getenv('WEBAPP_SHUTDOWN_TIMEOUT', 10))  # Seconds to let open requests finish
+
+# Webhook mode (served by start.py on the Web App's port)
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', WEBAPP_URL)  # Public HTTPS URL Telegram posts to
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = _secret('WEBHOOK_SECRET', 'webhook')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # Telegram's parallel deliveries
+
+# Update processing (start.py)
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))  # Updates waiting to be processed, per process
+UPDATE_LANES = int(os.getenv('UPDATE_LANES', 16))  # Processing lanes; one user's updates stay in order
+UPDATE_DRAIN_TIMEOUT = int(os.getenv('UPDATE_DRAIN_TIMEOUT', 10))  # Seconds to finish queued updates on shutdown
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))  # Worker processes for updates, sharded by user id
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 30))  # getUpdates long-poll seconds (sharded mode)
+
+# Outgoing messages (outbox.py); Telegram allows about 30 messages/s overall and 1/s per chat
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 25))  # Calls per second, shared by all BOT_WORKERS
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))  # Calls per second to one chat
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', 3))  # Calls one chat may get back to back
+OUTBOX_CHAT_BUCKETS = int(os.getenv('OUTBOX_CHAT_BUCKETS', 10000))  # Chats whose rate is tracked
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 8))  # Calls in flight at once
+OUTBOX_QUEUE_SIZE = int(os.getenv('OUTBOX_QUEUE_SIZE', 10000))  # Queued calls before new ones are dropped
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', 3))  # For flood waits, network and server errors
+OUTBOX_DRAIN_TIMEOUT = int(os.getenv('OUTBOX_DRAIN_TIMEOUT', 10))  # Seconds to send what is queued on shutdown
+
+# Broadcasts (broadcast.py; sent through the outbox at its pace)
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 100))  # Recipients per saved progress step
+BROADCAST_POLL_INTERVAL = int(os.getenv('BROADCAST_POLL_INTERVAL', 5))  # Seconds; how soon worker 0 picks up broadcasts started in another worker
+
+# Local video streaming
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 256 * 1024))  # Bytes per read when sendfile can't be used
+STREAM_SENDFILE = os.getenv('STREAM_SENDFILE', '1') == '1'
+STREAM_HANDLE_CACHE_SIZE = int(os.getenv('STREAM_HANDLE_CACHE_SIZE', 64))  # Open video files kept for reuse
+STREAM_STAT_TTL = int(os.getenv('STREAM_STAT_TTL', 5))  # Seconds before a cached file is re-stat'ed
+STREAM_MAX_RANGES = int(os.getenv('STREAM_MAX_RANGES', 8))  # More ranges than this get the whole file
+
+# Telegram file proxy (videos stored as file_ids)
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')  # Or a local Bot API server
+TELEGRAM_FILE_PATH_TTL = int(os.getenv('TELEGRAM_FILE_PATH_TTL', 3000))  # Seconds; Telegram keeps file paths valid for an hour
+TELEGRAM_CACHE_MAX_BYTES = int(os.getenv('TELEGRAM_CACHE_MAX_BYTES', 5 * 1024 ** 3))  # Disk cache size limit
+TELEGRAM_CACHE_DOWNLOADS = int(os.getenv('TELEGRAM_CACHE_DOWNLOADS', 2))  # Concurrent cache fills per process
 
 # Token Configuration
 TOKEN_EXPIRY_HOURS = int(os.getenv('TOKEN_EXPIRY_HOURS', 24))
+VIDEO_TOKEN_MODE = os.getenv('VIDEO_TOKEN_MODE', 'signed')  # 'signed' (no DB) or 'db'
+VIDEO_TOKEN_SECRET = _secret('VIDEO_TOKEN_SECRET', 'video-token')
+EPISODE_META_CACHE_SIZE = int(os.getenv('EPISODE_META_CACHE_SIZE', 256))
+EPISODE_META_CACHE_TTL = int(os.getenv('EPISODE_META_CACHE_TTL', 300))  # Seconds
+MEDIA_URL_TTL = int(os.getenv('MEDIA_URL_TTL', 3 * 3600))  # Seconds a manifest media URL stays valid (covers seeking through a long lecture)
 
 # Database Configuration
 DATABASE_PATH = 'data/bot.db'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 4))  # Reader connections kept open
+
+# SQLite tuning (WAL lets the bot and the Web App read while the other writes)
+DB_JOURNAL_MODE = os.getenv('DB_JOURNAL_MODE', 'WAL')
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 128 * 1024 * 1024))
+DB_TEMP_STORE = os.getenv('DB_TEMP_STORE', 'MEMORY')
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CHECKPOINT_INTERVAL = int(os.getenv('DB_CHECKPOINT_INTERVAL', 300))  # Seconds, 0 disables
+DB_CHECKPOINT_MODE = os.getenv('DB_CHECKPOINT_MODE', 'PASSIVE')
+DB_MIGRATION_BATCH_SIZE = int(os.getenv('DB_MIGRATION_BATCH_SIZE', 5000))  # Rows per table-rebuild transaction
+
+# User write-behind buffer (/start profile updates)
+USER_FLUSH_INTERVAL_MS = int(os.getenv('USER_FLUSH_INTERVAL_MS', 500))
+USER_FLUSH_BATCH_SIZE = int(os.getenv('USER_FLUSH_BATCH_SIZE', 200))
+USER_PROFILE_CACHE_SIZE = int(os.getenv('USER_PROFILE_CACHE_SIZE', 50000))  # Profiles remembered to skip no-op writes
+
+# Background maintenance (token and FSM state pruning, orphan sweep, rollups, ANALYZE, vacuum)
+MAINTENANCE_INTERVAL = int(os.getenv('MAINTENANCE_INTERVAL', 3600))  # Seconds between runs
+MAINTENANCE_START_DELAY = int(os.getenv('MAINTENANCE_START_DELAY', 60))  # Seconds after startup
+MAINTENANCE_BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', 500))  # Rows per transaction
+MAINTENANCE_TIME_BUDGET = float(os.getenv('MAINTENANCE_TIME_BUDGET', 2.0))  # Seconds per job per run
+MAINTENANCE_VACUUM_PAGES = int(os.getenv('MAINTENANCE_VACUUM_PAGES', 1000))
+MAINTENANCE_VACUUM_CONVERT_PAGES = int(os.getenv('MAINTENANCE_VACUUM_CONVERT_PAGES', 25000))  # Free pages that trigger the one-time VACUUM of an old file, 0 leaves it to /vacuum
+MAINTENANCE_ANALYSIS_LIMIT = int(os.getenv('MAINTENANCE_ANALYSIS_LIMIT', 400))  # Rows ANALYZE samples per index, 0 reads them all
+MAINTENANCE_REJECTED_RETENTION_DAYS = int(os.getenv('MAINTENANCE_REJECTED_RETENTION_DAYS', 30))
+
+# Conversation (FSM) state storage
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))  # Conversations kept in memory; 0 to always read SQLite
+FSM_DEFAULT_TTL = int(os.getenv('FSM_DEFAULT_TTL', 3600))  # Seconds an idle conversation is kept
+FSM_STATE_TTLS = {  # Per state or StatesGroup; a user may take a day to pay
+    'PurchaseStates:waiting_for_receipt': int(os.getenv('FSM_RECEIPT_TTL', 24 * 3600)),
+    'CourseStates': int(os.getenv('FSM_ADMIN_TTL', 3600)),
+    'EpisodeStates': int(os.getenv('FSM_ADMIN_TTL', 3600)),
+    'BroadcastStates': int(os.getenv('FSM_ADMIN_TTL', 3600)),
+}
+
+# Analytics (daily rollups, see analytics.py)
+ANALYTICS_DAYS = int(os.getenv('ANALYTICS_DAYS', 14))  # Days shown on the analytics screen
+ANALYTICS_TOP_COURSES = int(os.getenv('ANALYTICS_TOP_COURSES', 5))  # Courses ranked on the analytics screen
+ANALYTICS_BAR_WIDTH = int(os.getenv('ANALYTICS_BAR_WIDTH', 10))  # Characters in a full chart bar
+
+# Admin data exports (see export.py)
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))  # Rows read per query
+EXPORT_MAX_BYTES = int(os.getenv('EXPORT_MAX_BYTES', 50 * 1024 * 1024))  # Bot API upload limit
+
+# Inline keyboards
+KEYBOARD_PAGE_SIZE = int(os.getenv('KEYBOARD_PAGE_SIZE', 10))  # Items per page of a list keyboard
+
+# Cache Configuration
+ENTITLEMENT_CACHE_SIZE = int(os.getenv('ENTITLEMENT_CACHE_SIZE', 10000))  # Users kept in memory
+ENTITLEMENT_CACHE_TTL = int(os.getenv('ENTITLEMENT_CACHE_TTL', 600))  # Seconds
 
 # Directories
 VIDEOS_DIR = 'videos'
+TELEGRAM_CACHE_DIR = os.path.join(VIDEOS_DIR, 'telegram_cache')
 DATA_DIR = 'data'
 
 # Ensure directories exist
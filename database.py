@@ -1,226 +1,1106 @@
+import asyncio
 import aiosqlite
+import base64
+import bisect
 import config
-from datetime import datetime, timedelta
+import hashlib
+import hmac
+import json
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import secrets
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Secondary indexes; each comment names the queries the index serves
+INDEXES = [
+    # delete_course (course pages come from the catalog cache)
+    'CREATE INDEX IF NOT EXISTS idx_episodes_course ON episodes (course_id, episode_number)',
+    # get_pending_purchases_page (keyset on purchase_id without a sort), STATS_SQL status counts
+    'CREATE INDEX IF NOT EXISTS idx_purchases_status_id ON purchases (payment_status, purchase_id)',
+    # Stats triggers on episode delete and price change (approved sales of one episode)
+    'CREATE INDEX IF NOT EXISTS idx_purchases_episode_status ON purchases (episode_id, payment_status)',
+    # get_user_purchases_page, get_entitlements
+    'CREATE INDEX IF NOT EXISTS idx_purchases_user_status ON purchases (user_id, payment_status, episode_id)',
+    # Expired token cleanup
+    'CREATE INDEX IF NOT EXISTS idx_video_tokens_expires ON video_tokens (expires_at)',
+    # Expired FSM state cleanup
+    'CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)',
+]
+
+
+# Signed video tokens
+#
+# A token is "<payload>.<signature>", both base64url without padding. The
+# payload is "user_id:episode_id:expires_at:nonce" and the signature is a
+# truncated HMAC-SHA256 of the encoded payload under VIDEO_TOKEN_SECRET.
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _token_signature(payload: str) -> str:
+    digest = hmac.new(config.VIDEO_TOKEN_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    return _b64encode(digest[:16])
+
+
+def sign_video_token(user_id: int, episode_id: int, expires_at: int) -> str:
+    """Create a signed token granting `user_id` access to `episode_id`"""
+    payload = _b64encode(f'{user_id}:{episode_id}:{expires_at}:{secrets.token_hex(4)}'.encode())
+    return f'{payload}.{_token_signature(payload)}'
+
+
+def verify_video_token(token: str):
+    """Return (user_id, episode_id, expires_at) if the signature is genuine, else None"""
+    payload, _, signature = token.partition('.')
+    if not hmac.compare_digest(signature.encode(), _token_signature(payload).encode()):
+        return None
+    try:
+        user_id, episode_id, expires_at, _ = _b64decode(payload).decode().split(':')
+        return int(user_id), int(episode_id), int(expires_at)
+    except ValueError:
+        return None
+
+
+async def _pragma(db, statement: str):
+    """Run a PRAGMA and return its first row, closing the cursor right away"""
+    async with db.execute(f'PRAGMA {statement}') as cursor:
+        return await cursor.fetchone()
+
+
+# Schema migrations
+#
+# Each entry is a (prepare, apply) pair and its position in the list is its
+# version number, recorded in PRAGMA user_version. `apply(db, state)` runs
+# inside a single BEGIN IMMEDIATE transaction together with the version bump.
+# The optional `prepare(database, number)` runs before it in short
+# transactions of its own, so slow work (like copying a large table) does not
+# hold the write lock for its whole duration. Steps must be safe to re-run.
+
+async def _user_version(db) -> int:
+    return (await _pragma(db, 'user_version'))[0]
+
+
+async def _begin_migration(db, number: int) -> bool:
+    """Open a write transaction; False if migration `number` is already applied"""
+    await db.execute('BEGIN IMMEDIATE')
+    return await _user_version(db) < number
+
+
+async def _create_tables(db, state=None):
+    # Users table
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            is_admin INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Courses table
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS courses (
+            course_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            price REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Episodes table
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS episodes (
+            episode_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            course_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            video_path TEXT NOT NULL,
+            price REAL NOT NULL,
+            episode_number INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (course_id) REFERENCES courses (course_id)
+        )
+    ''')
+
+    # Purchases table
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            episode_id INTEGER NOT NULL,
+            purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            payment_status TEXT DEFAULT 'pending',
+            receipt_photo TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (episode_id) REFERENCES episodes (episode_id),
+            UNIQUE(user_id, episode_id)
+        )
+    ''')
+
+    # Video tokens table
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS video_tokens (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            episode_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (episode_id) REFERENCES episodes (episode_id)
+        )
+    ''')
+
+
+async def _create_indexes(db, state=None):
+    async with db.execute("SELECT name FROM sqlite_master WHERE type = 'table'") as cursor:
+        tables = {row[0] for row in await cursor.fetchall()}
+    for statement in INDEXES:
+        # Tables added by later migrations get their indexes from create_table()
+        if statement.split(' ON ', 1)[1].split(' ', 1)[0] in tables:
+            await db.execute(statement)
+
+
+# Materialized statistics
+#
+# stats_counters holds one row (id = 1) with the totals get_stats() shows.
+# The triggers below keep it current inside every write transaction, so
+# reading the stats costs one row lookup however large the tables grow.
+# Revenue follows get_stats' original definition: the current price of the
+# episode of every approved purchase whose episode still exists.
+
+STATS_COLUMNS = ('total_users', 'total_courses', 'total_episodes', 'total_sales', 'pending_purchases', 'total_revenue')
+
+# The same totals computed from the tables (backfill and check_stats)
+STATS_SQL = '''
+    SELECT
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM courses),
+        (SELECT COUNT(*) FROM episodes),
+        (SELECT COUNT(*) FROM purchases WHERE payment_status = 'approved'),
+        (SELECT COUNT(*) FROM purchases WHERE payment_status = 'pending'),
+        (SELECT COALESCE(SUM(e.price), 0)
+         FROM purchases p
+         JOIN episodes e ON p.episode_id = e.episode_id
+         WHERE p.payment_status = 'approved')
+'''
+
+# Price an approved purchase contributes to revenue
+_PURCHASE_PRICE = "CASE WHEN {row}.payment_status = 'approved' THEN COALESCE((SELECT price FROM episodes WHERE episode_id = {row}.episode_id), 0) ELSE 0 END"
+
+# Approved purchases of an episode, for changes to its price
+_EPISODE_SALES = "(SELECT COUNT(*) FROM purchases WHERE episode_id = {row}.episode_id AND payment_status = 'approved')"
+
+STATS_TRIGGERS = {
+    'stats_users_insert': 'AFTER INSERT ON users BEGIN UPDATE stats_counters SET total_users = total_users + 1; END',
+    'stats_users_delete': 'AFTER DELETE ON users BEGIN UPDATE stats_counters SET total_users = total_users - 1; END',
+    'stats_courses_insert': 'AFTER INSERT ON courses BEGIN UPDATE stats_counters SET total_courses = total_courses + 1; END',
+    'stats_courses_delete': 'AFTER DELETE ON courses BEGIN UPDATE stats_counters SET total_courses = total_courses - 1; END',
+    'stats_episodes_insert': 'AFTER INSERT ON episodes BEGIN UPDATE stats_counters SET total_episodes = total_episodes + 1; END',
+    # Approved purchases of a deleted episode stay sales but no longer count as revenue
+    'stats_episodes_delete': f'''AFTER DELETE ON episodes BEGIN
+        UPDATE stats_counters SET
+            total_episodes = total_episodes - 1,
+            total_revenue = total_revenue - old.price * {_EPISODE_SALES.format(row='old')};
+    END''',
+    'stats_episodes_price': f'''AFTER UPDATE OF price ON episodes BEGIN
+        UPDATE stats_counters SET
+            total_revenue = total_revenue + (new.price - old.price) * {_EPISODE_SALES.format(row='new')};
+    END''',
+    'stats_purchases_insert': f'''AFTER INSERT ON purchases BEGIN
+        UPDATE stats_counters SET
+            total_sales = total_sales + (new.payment_status = 'approved'),
+            pending_purchases = pending_purchases + (new.payment_status = 'pending'),
+            total_revenue = total_revenue + {_PURCHASE_PRICE.format(row='new')};
+    END''',
+    'stats_purchases_delete': f'''AFTER DELETE ON purchases BEGIN
+        UPDATE stats_counters SET
+            total_sales = total_sales - (old.payment_status = 'approved'),
+            pending_purchases = pending_purchases - (old.payment_status = 'pending'),
+            total_revenue = total_revenue - {_PURCHASE_PRICE.format(row='old')};
+    END''',
+    'stats_purchases_update': f'''AFTER UPDATE OF payment_status, episode_id ON purchases BEGIN
+        UPDATE stats_counters SET
+            total_sales = total_sales + (new.payment_status = 'approved') - (old.payment_status = 'approved'),
+            pending_purchases = pending_purchases + (new.payment_status = 'pending') - (old.payment_status = 'pending'),
+            total_revenue = total_revenue + {_PURCHASE_PRICE.format(row='new')} - {_PURCHASE_PRICE.format(row='old')};
+    END''',
+}
+
+
+async def _backfill_stats(db):
+    """Recompute the stats_counters row from the tables"""
+    await db.execute(f'''
+        INSERT OR REPLACE INTO stats_counters (id, {', '.join(STATS_COLUMNS)})
+        SELECT 1, * FROM ({STATS_SQL})
+    ''')
+
+
+async def _create_stats_counters(db, state=None):
+    await db.execute(f'''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            {', '.join(f'{name} INTEGER NOT NULL DEFAULT 0' for name in STATS_COLUMNS[:-1])},
+            total_revenue REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    for name, body in STATS_TRIGGERS.items():
+        await db.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+    # Same transaction as the triggers, so no write falls in between
+    await _backfill_stats(db)
+
+
+# Daily rollups (analytics.py)
+#
+# Reviewed purchases are folded into the daily_* sales tables exactly once.
+# analytics.rollup() walks purchase_id upwards from a high-water mark kept
+# in rollup_state, counting the reviewed rows and moving the mark past
+# pending ones; a purchase reviewed at or below the mark is counted by the
+# review itself, in the same transaction. New users have no ordered key to
+# track, so a trigger counts them into daily_users as they are inserted.
+
+
+def _rollup_sql(table: str, columns: dict, where: str) -> str:
+    """Upsert the reviewed purchases matching `where` into a daily sales table
+
+    `columns` maps the table's key columns (the first is the one the
+    primary key pairs with day) to the expressions that fill them.
+    """
+    names = ', '.join(columns)
+    exprs = ', '.join(columns.values())
+    key = next(iter(columns))
+    return f'''
+        INSERT INTO {table} (day, {names}, sales, revenue, rejected, approval_seconds, timed_approvals)
+        SELECT
+            date(COALESCE(p.reviewed_at, CAST(strftime('%s', p.purchased_at) AS INTEGER)), 'unixepoch') AS day,
+            {exprs},
+            SUM(p.payment_status = 'approved'),
+            SUM(CASE WHEN p.payment_status = 'approved' THEN e.price ELSE 0 END),
+            SUM(p.payment_status = 'rejected'),
+            SUM(CASE WHEN p.payment_status = 'approved' AND p.reviewed_at IS NOT NULL
+                     THEN p.reviewed_at - CAST(strftime('%s', p.purchased_at) AS INTEGER) ELSE 0 END),
+            SUM(p.payment_status = 'approved' AND p.reviewed_at IS NOT NULL)
+        FROM purchases p
+        JOIN episodes e ON p.episode_id = e.episode_id
+        WHERE p.payment_status IN ('approved', 'rejected') AND {where}
+        GROUP BY day, {columns[key]}
+        ON CONFLICT (day, {key}) DO UPDATE SET
+            sales = sales + excluded.sales,
+            revenue = revenue + excluded.revenue,
+            rejected = rejected + excluded.rejected,
+            approval_seconds = approval_seconds + excluded.approval_seconds,
+            timed_approvals = timed_approvals + excluded.timed_approvals
+    '''
+
+
+_ROLLUP_TABLES = (
+    ('daily_episode_sales', {'episode_id': 'p.episode_id', 'course_id': 'e.course_id'}),
+    ('daily_course_sales', {'course_id': 'e.course_id'}),
+)
+
+# Purchases in (?, ?] by purchase_id, for analytics.rollup()
+ROLLUP_RANGE_SQL = [
+    _rollup_sql(table, columns, 'p.purchase_id > ? AND p.purchase_id <= ?')
+    for table, columns in _ROLLUP_TABLES
+]
+
+# Purchases just reviewed (a JSON list of IDs) that the mark has already passed
+ROLLUP_REVIEWED_SQL = [
+    _rollup_sql(table, columns, '''p.purchase_id IN (SELECT value FROM json_each(?))
+        AND p.purchase_id <= (SELECT value FROM rollup_state WHERE name = 'purchases')''')
+    for table, columns in _ROLLUP_TABLES
+]
+
+
+async def _roll_up_reviewed(db, purchase_ids: list):
+    """Count purchases reviewed in the current transaction into the daily rollups"""
+    ids = json.dumps(purchase_ids)
+    for statement in ROLLUP_REVIEWED_SQL:
+        await db.execute(statement, (ids,))
+
+
+async def _create_rollups(db, state=None):
+    # day is the review date (UTC); approval_seconds sums purchase-to-approval
+    # time over the timed_approvals approvals that recorded reviewed_at
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS daily_episode_sales (
+            day TEXT NOT NULL,
+            episode_id INTEGER NOT NULL,
+            course_id INTEGER NOT NULL,
+            sales INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            approval_seconds INTEGER NOT NULL DEFAULT 0,
+            timed_approvals INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, episode_id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS daily_course_sales (
+            day TEXT NOT NULL,
+            course_id INTEGER NOT NULL,
+            sales INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            approval_seconds INTEGER NOT NULL DEFAULT 0,
+            timed_approvals INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, course_id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS daily_users (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    await db.execute("INSERT OR IGNORE INTO rollup_state (name, value) VALUES ('purchases', 0)")
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS rollup_users_insert AFTER INSERT ON users BEGIN
+            INSERT INTO daily_users (day, new_users) VALUES (date(COALESCE(new.created_at, 'now')), 1)
+            ON CONFLICT (day) DO UPDATE SET new_users = new_users + 1;
+        END
+    ''')
+    # Same transaction as the trigger, so no signup is counted twice or missed
+    await db.execute('DELETE FROM daily_users')
+    await db.execute('''
+        INSERT INTO daily_users (day, new_users)
+        SELECT date(COALESCE(created_at, 'now')), COUNT(*) FROM users GROUP BY 1
+    ''')
+
+
+async def _replace_status_index(db, state=None):
+    await db.execute('DROP INDEX IF EXISTS idx_purchases_status')
+    await _create_indexes(db)
+
+
+def rebuild_table(table: str, create_sql: str, columns: dict, batch_size: int = None):
+    """Build a migration step that rebuilds `table` from `create_sql` in batches
+
+    `columns` maps each new column to the SQL expression that fills it from the
+    old row. Rows are copied in rowid order in short transactions during the
+    prepare phase; the apply phase copies whatever arrived since, swaps the
+    tables and recreates the table's indexes from INDEXES. Rows already copied
+    are not re-read, so this suits append-only tables such as video_tokens.
+    """
+    new_table = f'{table}__rebuild'
+    names = ', '.join(columns)
+    exprs = ', '.join(columns.values())
+    copy_sql = (f'INSERT OR REPLACE INTO {new_table} (rowid, {names}) '
+                f'SELECT rowid, {exprs} FROM {table} WHERE rowid > ? AND rowid <= ?')
+
+    async def prepare(database, number):
+        size = batch_size or config.DB_MIGRATION_BATCH_SIZE
+        copied = 0
+        while True:
+            async with database.writer() as db:
+                if not await _begin_migration(db, number):
+                    return copied
+                await db.execute(create_sql.replace(table, new_table, 1))
+                async with db.execute(
+                    f'SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)',
+                    (copied, size)
+                ) as cursor:
+                    upper = (await cursor.fetchone())[0]
+                if upper is None:
+                    return copied
+                await db.execute(copy_sql, (copied, upper))
+            copied = upper
+            await asyncio.sleep(0)  # Let queued writers in between batches
+
+    async def apply(db, copied):
+        await db.execute(create_sql.replace(table, new_table, 1))
+        await db.execute(copy_sql, (copied or 0, 2 ** 63 - 1))
+        await db.execute(f'DROP TABLE {table}')
+        await db.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+        for statement in INDEXES:
+            if f' ON {table} ' in statement:
+                await db.execute(statement)
+
+    return prepare, apply
+
+
+def add_columns(table: str, columns: dict):
+    """Build a migration step that adds `columns` (name -> SQL type) to `table`"""
+    async def apply(db, state=None):
+        async with db.execute(f'PRAGMA table_info({table})') as cursor:
+            existing = {row[1] for row in await cursor.fetchall()}
+        for name, definition in columns.items():
+            if name not in existing:
+                await db.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+    return None, apply
+
+
+def create_table(table: str, create_sql: str):
+    """Build a migration step that creates `table` and its indexes from INDEXES"""
+    async def apply(db, state=None):
+        await db.execute(create_sql)
+        for statement in INDEXES:
+            if f' ON {table} ' in statement:
+                await db.execute(statement)
+
+    return None, apply
+
+
+MIGRATIONS = [
+    (None, _create_tables),
+    (None, _create_indexes),
+    # Token timestamps become epoch seconds so expiry checks are integer compares
+    rebuild_table('video_tokens', '''
+        CREATE TABLE IF NOT EXISTS video_tokens (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            episode_id INTEGER NOT NULL,
+            created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            expires_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (episode_id) REFERENCES episodes (episode_id)
+        )
+    ''', {
+        'token': 'token',
+        'user_id': 'user_id',
+        'episode_id': 'episode_id',
+        'created_at': "CAST(strftime('%s', created_at) AS INTEGER)",
+        # expires_at was written with datetime.now(), i.e. local time
+        'expires_at': "CAST(strftime('%s', expires_at, 'utc') AS INTEGER)",
+    }),
+    # Playback metadata for the Web App manifest, taken from the uploaded video
+    add_columns('episodes', {
+        'file_size': 'INTEGER',
+        'duration': 'INTEGER',
+        'poster': 'TEXT',
+    }),
+    # Conversation state (fsm_storage.SQLiteStorage), shared by every process
+    create_table('fsm_states', '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            expires_at INTEGER NOT NULL
+        )
+    '''),
+    # Users whose chat is gone (bot blocked, account deleted); broadcasts skip them
+    add_columns('users', {
+        'is_blocked': 'INTEGER NOT NULL DEFAULT 0',
+    }),
+    # Broadcasts and their progress (broadcast.py); last_user_id is the resume point
+    create_table('broadcasts', '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            preview TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            finished_at INTEGER
+        )
+    '''),
+    # Indexes added to INDEXES since (idx_purchases_status_id)
+    (None, _create_indexes),
+    # Trigger-maintained totals for get_stats
+    (None, _create_stats_counters),
+    # When a purchase was approved or rejected (epoch seconds), for approval latency
+    add_columns('purchases', {
+        'reviewed_at': 'INTEGER',
+    }),
+    # Daily rollups read by the analytics screen (analytics.py)
+    (None, _create_rollups),
+    # Pending pages and stats moved off idx_purchases_status; the stats triggers need episode_id
+    (None, _replace_status_index),
+]
+
+
+def _keyset_slice(rows: list, keys: list, key: tuple, forward: bool, limit: int):
+    """Keyset page of sorted in-memory rows, in the same order a SQL page would have"""
+    if forward:
+        start = 0 if key is None else bisect.bisect_right(keys, key)
+        return rows[start:start + limit]
+    end = len(keys) if key is None else bisect.bisect_left(keys, key)
+    return rows[max(0, end - limit):end][::-1]
+
+
+# Cache updates that apply_cache_change() accepts from other processes
+CACHE_CHANGES = {'_invalidate_catalog', '_update_entitlement', '_forget_episodes', '_forget_profiles'}
 
 
 class Database:
     def __init__(self):
         self.db_path = config.DATABASE_PATH
+        self.pool_size = config.DB_POOL_SIZE
+        self._opening = None
+        self._writer = None
+        self._write_lock = None
+        self._readers = None
+        self._reader_conns = []
+        self._checkpoint_task = None
 
-    async def init_db(self):
-        """Initialize database with all required tables"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Users table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    is_admin INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+        # Write-behind buffer for add_user
+        self._known_profiles = OrderedDict()  # user_id -> (username, first_name) last written
+        self._pending_profiles = {}  # user_id -> row waiting for flush_users()
+        self._profile_flush_task = None
 
-            # Courses table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS courses (
-                    course_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    title TEXT NOT NULL,
-                    description TEXT,
-                    price REAL DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+        # Role table: IDs of admin users, loaded by load_roles()
+        self._admin_ids = None
 
-            # Episodes table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS episodes (
-                    episode_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    course_id INTEGER NOT NULL,
-                    title TEXT NOT NULL,
-                    description TEXT,
-                    video_path TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    episode_number INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (course_id) REFERENCES courses (course_id)
-                )
-            ''')
+        # Catalog cache: courses and episodes, reloaded when catalog_version moves
+        self.catalog_version = 0
+        self.catalog_hits = 0
+        self.catalog_misses = 0
+        self._catalog = None
 
-            # Purchases table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS purchases (
-                    purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    episode_id INTEGER NOT NULL,
-                    purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    payment_status TEXT DEFAULT 'pending',
-                    receipt_photo TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (episode_id) REFERENCES episodes (episode_id),
-                    UNIQUE(user_id, episode_id)
-                )
-            ''')
+        # Entitlement cache: user_id -> (loaded_at, approved episode IDs), LRU ordered
+        self._entitlements = OrderedDict()
+        self._entitlement_generation = 0
+        self.entitlement_hits = 0
+        self.entitlement_misses = 0
 
-            # Video tokens table
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS video_tokens (
-                    token TEXT PRIMARY KEY,
-                    user_id INTEGER NOT NULL,
-                    episode_id INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (episode_id) REFERENCES episodes (episode_id)
-                )
-            ''')
+        # Signed video tokens: episode metadata LRU
+        self._episode_meta = OrderedDict()  # episode_id -> (loaded_at, (video_path, title))
+
+        # Called as on_cache_change(name, args) after a cache change, so other
+        # processes sharing the database can replay it (see sharding.py)
+        self.on_cache_change = None
+
+    # Connection pool
+    async def connect(self):
+        """Open the connection pool (safe to call more than once)"""
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._open_pool())
+        await self._opening
+
+    async def _open_pool(self):
+        """Open one writer connection and `pool_size` reader connections"""
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._writer = await aiosqlite.connect(self.db_path)
+        await self._tune_connection(self._writer)
+        # Only takes effect on a new file, so it must precede the WAL switch
+        await _pragma(self._writer, 'auto_vacuum = INCREMENTAL')
+        # journal_mode is persistent in the file, so the writer sets it once
+        await _pragma(self._writer, f'journal_mode = {config.DB_JOURNAL_MODE}')
+        for _ in range(max(1, self.pool_size)):
+            conn = await aiosqlite.connect(self.db_path)
+            await self._tune_connection(conn)
+            await _pragma(conn, 'query_only = 1')
+            self._reader_conns.append(conn)
+            self._readers.put_nowait(conn)
+        if config.DB_CHECKPOINT_INTERVAL > 0:
+            self._checkpoint_task = asyncio.ensure_future(self._checkpoint_loop())
+
+    async def _tune_connection(self, conn):
+        """Apply the per-connection storage settings from config"""
+        await _pragma(conn, f'busy_timeout = {int(config.DB_BUSY_TIMEOUT_MS)}')
+        await _pragma(conn, f'synchronous = {config.DB_SYNCHRONOUS}')
+        # Negative cache_size is measured in KiB rather than pages
+        await _pragma(conn, f'cache_size = -{int(config.DB_CACHE_SIZE_KB)}')
+        await _pragma(conn, f'mmap_size = {int(config.DB_MMAP_SIZE)}')
+        await _pragma(conn, f'temp_store = {config.DB_TEMP_STORE}')
 
-            await db.commit()
+    async def _checkpoint_loop(self):
+        """Periodically fold the WAL back into the main database file"""
+        while True:
+            await asyncio.sleep(config.DB_CHECKPOINT_INTERVAL)
+            try:
+                await self.checkpoint()
+            except Exception:
+                logger.exception("Error checkpointing database")
+
+    async def checkpoint(self):
+        """Run a WAL checkpoint on the writer connection"""
+        async with self._write_lock:
+            return await _pragma(self._writer, f'wal_checkpoint({config.DB_CHECKPOINT_MODE})')
+
+    async def close(self):
+        """Close all pooled connections"""
+        if self._opening is None:
+            return
+        await self._opening
+        if self._profile_flush_task:
+            self._profile_flush_task.cancel()
+            self._profile_flush_task = None
+        await self.flush_users()
+        if self._checkpoint_task:
+            self._checkpoint_task.cancel()
+            self._checkpoint_task = None
+        for conn in self._reader_conns:
+            await conn.close()
+        await self._writer.close()
+        self._reader_conns = []
+        self._writer = None
+        self._opening = None
+
+    @asynccontextmanager
+    async def reader(self):
+        """Borrow a reader connection from the pool"""
+        await self.connect()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Hold the writer connection; commits on success, rolls back on error"""
+        await self.connect()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
+
+    async def init_db(self):
+        """Initialize database, applying any pending schema migrations"""
+        await self.migrate()
+
+    # Schema migrations
+    async def schema_version(self) -> int:
+        """Return the number of migrations applied to the database file"""
+        async with self.writer() as db:
+            return await _user_version(db)
+
+    async def migrate(self):
+        """Apply the migrations in MIGRATIONS that the database has not seen yet"""
+        version = await self.schema_version()
+        for number, (prepare, apply) in enumerate(MIGRATIONS[version:], start=version + 1):
+            state = await prepare(self, number) if prepare else None
+            async with self.writer() as db:
+                if not await _begin_migration(db, number):
+                    continue  # Another process applied it first
+                await apply(db, state)
+                await db.execute(f'PRAGMA user_version = {number}')
 
     # User methods
     async def add_user(self, user_id: int, username: str = None, first_name: str = None):
-        """Add or update user in database"""
-        async with aiosqlite.connect(self.db_path) as db:
-            is_admin = 1 if user_id == config.ADMIN_ID else 0
-            await db.execute('''
-                INSERT OR REPLACE INTO users (user_id, username, first_name, is_admin)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, is_admin))
-            await db.commit()
+        """Add or update user in database
+
+        Writes are buffered and flushed in batches by flush_users(); a profile
+        that has not changed since it was last written is not written again.
+        """
+        is_admin = 1 if user_id == config.ADMIN_ID else 0
+        if is_admin and self._admin_ids is not None:
+            self._admin_ids.add(user_id)
+
+        profile = (username, first_name)
+        if self._known_profiles.get(user_id) == profile:
+            self._known_profiles.move_to_end(user_id)
+            return
+        self._known_profiles[user_id] = profile
+        self._known_profiles.move_to_end(user_id)
+        while len(self._known_profiles) > config.USER_PROFILE_CACHE_SIZE:
+            self._known_profiles.popitem(last=False)
+
+        self._pending_profiles[user_id] = (user_id, username, first_name, is_admin)
+        if len(self._pending_profiles) >= config.USER_FLUSH_BATCH_SIZE:
+            await self.flush_users()
+        elif self._profile_flush_task is None:
+            self._profile_flush_task = asyncio.ensure_future(self._flush_users_later())
+
+    async def _flush_users_later(self):
+        """Flush the user buffer once the flush interval has passed"""
+        try:
+            await asyncio.sleep(config.USER_FLUSH_INTERVAL_MS / 1000)
+            await self.flush_users()
+        except Exception:
+            logger.exception("Error flushing users")
+        finally:
+            self._profile_flush_task = None
+
+    async def flush_users(self):
+        """Write all buffered user profiles in one transaction"""
+        if not self._pending_profiles:
+            return
+        pending, self._pending_profiles = self._pending_profiles, {}
+        try:
+            async with self.writer() as db:
+                # Upsert rather than REPLACE so created_at and a granted
+                # is_admin survive a profile update
+                await db.executemany('''
+                    INSERT INTO users (user_id, username, first_name, is_admin)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        is_admin = MAX(users.is_admin, excluded.is_admin),
+                        is_blocked = 0
+                ''', list(pending.values()))
+        except BaseException:
+            # Keep the rows for the next flush unless newer ones arrived
+            self._pending_profiles = {**pending, **self._pending_profiles}
+            raise
+
+    def _forget_profiles(self, user_ids):
+        """Make the next add_user of these users write, e.g. to clear is_blocked"""
+        for user_id in user_ids:
+            self._known_profiles.pop(user_id, None)
+        self._publish_cache_change('_forget_profiles', list(user_ids))
+
+    async def load_roles(self):
+        """Load the IDs of all admin users into the in-memory role table"""
+        async with self.reader() as db:
+            async with db.execute('SELECT user_id FROM users WHERE is_admin = 1') as cursor:
+                self._admin_ids = {row[0] for row in await cursor.fetchall()}
 
     async def is_admin(self, user_id: int) -> bool:
         """Check if user is admin"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT is_admin FROM users WHERE user_id = ?', (user_id,)) as cursor:
-                result = await cursor.fetchone()
-                return result[0] == 1 if result else False
+        if self._admin_ids is None:
+            await self.load_roles()
+        return user_id in self._admin_ids
 
-    async def get_all_users(self):
-        """Get all users"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT user_id, username, first_name, is_admin, created_at FROM users') as cursor:
+    async def get_users_page(self, key: tuple, forward: bool, limit: int):
+        """Up to `limit` users after (or before) the (user_id,) key, in user_id order"""
+        condition, order = ('>', 'ASC') if forward else ('<', 'DESC')
+        async with self.reader() as db:
+            async with db.execute(f'''
+                SELECT user_id, username, first_name, is_admin, is_blocked, created_at
+                FROM users
+                WHERE user_id {condition} ?
+                ORDER BY user_id {order}
+                LIMIT ?
+            ''', (key[0] if key else (0 if forward else 2 ** 63 - 1), limit)) as cursor:
                 return await cursor.fetchall()
 
+    # Exports (export.py); each reads the next `limit` rows after a key, in key order
+    async def export_users(self, key: tuple, limit: int):
+        """Users after the (user_id,) key"""
+        return await self.get_users_page(key, True, limit)
+
+    async def export_purchases(self, key: tuple, limit: int):
+        """Purchases after the (purchase_id,) key, with their user, episode and course"""
+        async with self.reader() as db:
+            async with db.execute('''
+                SELECT p.purchase_id, p.user_id, u.username, p.episode_id, e.title,
+                       e.course_id, c.title, e.price, p.payment_status, p.purchased_at,
+                       datetime(p.reviewed_at, 'unixepoch')
+                FROM purchases p
+                LEFT JOIN users u ON p.user_id = u.user_id
+                LEFT JOIN episodes e ON p.episode_id = e.episode_id
+                LEFT JOIN courses c ON e.course_id = c.course_id
+                WHERE p.purchase_id > ?
+                ORDER BY p.purchase_id
+                LIMIT ?
+            ''', (key[0] if key else 0, limit)) as cursor:
+                return await cursor.fetchall()
+
+    async def export_daily_sales(self, key: tuple, limit: int):
+        """Daily per-episode sales rollups after the (day, episode_id) key"""
+        async with self.reader() as db:
+            async with db.execute('''
+                SELECT s.day, s.episode_id, e.title, s.course_id, c.title,
+                       s.sales, s.revenue, s.rejected, s.approval_seconds, s.timed_approvals
+                FROM daily_episode_sales s
+                LEFT JOIN episodes e ON s.episode_id = e.episode_id
+                LEFT JOIN courses c ON s.course_id = c.course_id
+                WHERE (s.day, s.episode_id) > (?, ?)
+                ORDER BY s.day, s.episode_id
+                LIMIT ?
+            ''', (*(key or ('', 0)), limit)) as cursor:
+                return await cursor.fetchall()
+
+    async def export_daily_users(self, key: tuple, limit: int):
+        """Daily new user counts after the (day,) key"""
+        async with self.reader() as db:
+            async with db.execute(
+                'SELECT day, new_users FROM daily_users WHERE day > ? ORDER BY day LIMIT ?',
+                (key[0] if key else '', limit)
+            ) as cursor:
+                return await cursor.fetchall()
+
+    # Catalog cache
+    async def _get_catalog(self):
+        """Return the in-memory catalog, reloading it if catalog_version moved"""
+        catalog = self._catalog
+        if catalog is not None and catalog['version'] == self.catalog_version:
+            self.catalog_hits += 1
+            return catalog
+
+        self.catalog_misses += 1
+        version = self.catalog_version
+        async with self.reader() as db:
+            async with db.execute('SELECT course_id, title, description, price FROM courses ORDER BY course_id') as cursor:
+                courses = await cursor.fetchall()
+            async with db.execute('''
+                SELECT episode_id, course_id, title, description, video_path, price, episode_number
+                FROM episodes
+                ORDER BY course_id, episode_number, episode_id
+            ''') as cursor:
+                episodes = await cursor.fetchall()
+
+        catalog = {
+            'version': version,
+            'courses': courses,
+            'course_by_id': {course[0]: course for course in courses},
+            'course_keys': [(course[0],) for course in courses],
+            'episodes_by_course': {},
+            'episode_keys_by_course': {},
+            'episode_by_id': {},
+        }
+        for episode in episodes:
+            episode_id, course_id, title, description, video_path, price, episode_number = episode
+            catalog['episode_by_id'][episode_id] = episode
+            catalog['episodes_by_course'].setdefault(course_id, []).append(
+                (episode_id, title, description, price, episode_number)
+            )
+            catalog['episode_keys_by_course'].setdefault(course_id, []).append((episode_number, episode_id))
+
+        # A write during the reload bumped the version, so this copy is
+        # already stale and the next read reloads again
+        self._catalog = catalog
+        return catalog
+
+    def _invalidate_catalog(self):
+        """Mark the cached catalog stale after a course or episode change"""
+        self.catalog_version += 1
+        self._publish_cache_change('_invalidate_catalog')
+
+    def _publish_cache_change(self, name: str, *args):
+        if self.on_cache_change is not None:
+            self.on_cache_change(name, args)
+
+    def apply_cache_change(self, name: str, args):
+        """Replay a cache change published by another process"""
+        if name not in CACHE_CHANGES:
+            return
+        callback, self.on_cache_change = self.on_cache_change, None
+        try:
+            getattr(self, name)(*args)
+        finally:
+            self.on_cache_change = callback
+
+    def cache_stats(self):
+        """Hit/miss counters for the in-memory caches"""
+        entitlement_bytes = sys.getsizeof(self._entitlements) + sum(
+            sys.getsizeof(episode_set) for _, episode_set in self._entitlements.values()
+        )
+        return {
+            'catalog_version': self.catalog_version,
+            'catalog_hits': self.catalog_hits,
+            'catalog_misses': self.catalog_misses,
+            'entitlement_users': len(self._entitlements),
+            'entitlement_hits': self.entitlement_hits,
+            'entitlement_misses': self.entitlement_misses,
+            'entitlement_bytes': entitlement_bytes,
+        }
+
     # Course methods
     async def add_course(self, title: str, description: str = None, price: float = 0):
         """Add a new course"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             cursor = await db.execute('''
                 INSERT INTO courses (title, description, price)
                 VALUES (?, ?, ?)
             ''', (title, description, price))
-            await db.commit()
-            return cursor.lastrowid
+        self._invalidate_catalog()
+        return cursor.lastrowid
 
-    async def get_all_courses(self):
-        """Get all courses"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT course_id, title, description, price FROM courses ORDER BY course_id') as cursor:
-                return await cursor.fetchall()
+    async def get_courses_page(self, key: tuple, forward: bool, limit: int):
+        """Up to `limit` courses after (or before) the (course_id,) key"""
+        catalog = await self._get_catalog()
+        return _keyset_slice(catalog['courses'], catalog['course_keys'], key, forward, limit)
+
+    async def count_courses(self) -> int:
+        """Number of courses"""
+        return len((await self._get_catalog())['courses'])
 
     async def get_course(self, course_id: int):
         """Get course by ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT course_id, title, description, price FROM courses WHERE course_id = ?', (course_id,)) as cursor:
-                return await cursor.fetchone()
+        return (await self._get_catalog())['course_by_id'].get(course_id)
 
     async def delete_course(self, course_id: int):
         """Delete a course and its episodes"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('DELETE FROM episodes WHERE course_id = ?', (course_id,))
+        async with self.writer() as db:
+            async with db.execute('DELETE FROM episodes WHERE course_id = ? RETURNING episode_id', (course_id,)) as cursor:
+                episode_ids = [row[0] for row in await cursor.fetchall()]
             await db.execute('DELETE FROM courses WHERE course_id = ?', (course_id,))
-            await db.commit()
+        self._invalidate_catalog()
+        self._forget_episodes(episode_ids)
 
     # Episode methods
-    async def add_episode(self, course_id: int, title: str, description: str, video_path: str, price: float, episode_number: int):
+    async def add_episode(self, course_id: int, title: str, description: str, video_path: str, price: float, episode_number: int,
+                          file_size: int = None, duration: int = None, poster: str = None):
         """Add a new episode"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             cursor = await db.execute('''
-                INSERT INTO episodes (course_id, title, description, video_path, price, episode_number)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (course_id, title, description, video_path, price, episode_number))
-            await db.commit()
-            return cursor.lastrowid
-
-    async def get_course_episodes(self, course_id: int):
-        """Get all episodes for a course"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT episode_id, title, description, price, episode_number
-                FROM episodes
-                WHERE course_id = ?
-                ORDER BY episode_number
-            ''', (course_id,)) as cursor:
-                return await cursor.fetchall()
+                INSERT INTO episodes (course_id, title, description, video_path, price, episode_number, file_size, duration, poster)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (course_id, title, description, video_path, price, episode_number, file_size, duration, poster))
+        self._invalidate_catalog()
+        return cursor.lastrowid
+
+    async def count_course_episodes(self, course_id: int) -> int:
+        """Number of episodes in a course"""
+        return len((await self._get_catalog())['episodes_by_course'].get(course_id, []))
+
+    async def get_course_episodes_page(self, course_id: int, key: tuple, forward: bool, limit: int):
+        """Up to `limit` episodes of a course after (or before) the (episode_number, episode_id) key"""
+        catalog = await self._get_catalog()
+        return _keyset_slice(
+            catalog['episodes_by_course'].get(course_id, []),
+            catalog['episode_keys_by_course'].get(course_id, []),
+            key, forward, limit
+        )
 
     async def get_episode(self, episode_id: int):
         """Get episode by ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT episode_id, course_id, title, description, video_path, price, episode_number
-                FROM episodes
-                WHERE episode_id = ?
-            ''', (episode_id,)) as cursor:
-                return await cursor.fetchone()
+        return (await self._get_catalog())['episode_by_id'].get(episode_id)
 
     async def delete_episode(self, episode_id: int):
         """Delete an episode"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             await db.execute('DELETE FROM episodes WHERE episode_id = ?', (episode_id,))
-            await db.commit()
+        self._invalidate_catalog()
+        self._forget_episodes([episode_id])
 
     # Purchase methods
     async def create_purchase(self, user_id: int, episode_id: int, receipt_photo: str):
         """Create a new purchase request"""
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
+        if user_id in self._pending_profiles:
+            await self.flush_users()  # The pending queue joins on users
+        try:
+            async with self.writer() as db:
                 await db.execute('''
                     INSERT INTO purchases (user_id, episode_id, receipt_photo, payment_status)
                     VALUES (?, ?, ?, 'pending')
                 ''', (user_id, episode_id, receipt_photo))
-                await db.commit()
-                return True
-            except aiosqlite.IntegrityError:
-                return False  # Already purchased
-
-    async def get_pending_purchases(self):
-        """Get all pending purchase requests"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT p.purchase_id, p.user_id, p.episode_id, p.receipt_photo, 
+            return True
+        except aiosqlite.IntegrityError:
+            return False  # Already purchased
+
+    async def get_pending_purchases_page(self, key: tuple, forward: bool, limit: int):
+        """Up to `limit` pending purchases, newest first, after (or before) the (purchase_id,) key"""
+        # Newest first, so "after" means a smaller purchase_id
+        condition, order = ('<', 'DESC') if forward else ('>', 'ASC')
+        async with self.reader() as db:
+            async with db.execute(f'''
+                SELECT p.purchase_id, p.user_id, p.episode_id, p.receipt_photo,
                        u.username, e.title, e.price
                 FROM purchases p
                 JOIN users u ON p.user_id = u.user_id
                 JOIN episodes e ON p.episode_id = e.episode_id
-                WHERE p.payment_status = 'pending'
-                ORDER BY p.purchased_at DESC
-            ''') as cursor:
+                WHERE p.payment_status = 'pending' AND p.purchase_id {condition} ?
+                ORDER BY p.purchase_id {order}
+                LIMIT ?
+            ''', (key[0] if key else (2 ** 63 - 1 if forward else 0), limit)) as cursor:
                 return await cursor.fetchall()
 
-    async def approve_purchase(self, purchase_id: int):
-        """Approve a purchase"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
+    async def count_pending_purchases(self) -> int:
+        """Number of pending purchase requests"""
+        async with self.reader() as db:
+            async with db.execute('SELECT pending_purchases FROM stats_counters WHERE id = 1') as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def _transition_purchase(self, purchase_id: int, status: str):
+        """Move a pending purchase to `status` in one statement
+
+        The status check is part of the UPDATE, so of two concurrent taps
+        only one gets a row back. Returns (user_id, episode_id,
+        episode_title, price), or None if the purchase is not pending.
+        """
+        async with self.writer() as db:
+            async with db.execute('''
                 UPDATE purchases
-                SET payment_status = 'approved'
-                WHERE purchase_id = ?
-            ''', (purchase_id,))
-            await db.commit()
+                SET payment_status = ?, reviewed_at = CAST(strftime('%s', 'now') AS INTEGER)
+                WHERE purchase_id = ? AND payment_status = 'pending'
+                RETURNING user_id, episode_id,
+                    (SELECT title FROM episodes WHERE episode_id = purchases.episode_id),
+                    (SELECT price FROM episodes WHERE episode_id = purchases.episode_id)
+            ''', (status, purchase_id)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                await _roll_up_reviewed(db, [purchase_id])
+        if row:
+            self._update_entitlement(row[0], row[1], granted=status == 'approved')
+        return row
+
+    async def approve_purchase(self, purchase_id: int):
+        """Approve a pending purchase; (user_id, episode_id, episode_title, price) or None"""
+        return await self._transition_purchase(purchase_id, 'approved')
 
     async def reject_purchase(self, purchase_id: int):
-        """Reject a purchase"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                UPDATE purchases
-                SET payment_status = 'rejected'
-                WHERE purchase_id = ?
-            ''', (purchase_id,))
-            await db.commit()
+        """Reject a pending purchase; (user_id, episode_id, episode_title, price) or None"""
+        return await self._transition_purchase(purchase_id, 'rejected')
+
+    async def _transition_purchases(self, purchase_ids: list, status: str):
+        """Move every still-pending purchase in `purchase_ids` to `status` in one transaction
+
+        Returns (purchase_id, user_id, episode_id, episode_title, price) for
+        the purchases that moved; IDs already reviewed are skipped.
+        """
+        moved = []
+        async with self.writer() as db:
+            # Taken up front so no other process reviews these rows in between
+            await db.execute('BEGIN IMMEDIATE')
+            for start in range(0, len(purchase_ids), 500):
+                chunk = purchase_ids[start:start + 500]
+                async with db.execute(f'''
+                    SELECT p.purchase_id, p.user_id, p.episode_id, e.title, e.price
+                    FROM purchases p
+                    LEFT JOIN episodes e ON p.episode_id = e.episode_id
+                    WHERE p.purchase_id IN ({', '.join('?' * len(chunk))})
+                      AND p.payment_status = 'pending'
+                ''', chunk) as cursor:
+                    moved += await cursor.fetchall()
+            await db.executemany(
+                '''
+                    UPDATE purchases SET payment_status = ?, reviewed_at = CAST(strftime('%s', 'now') AS INTEGER)
+                    WHERE purchase_id = ? AND payment_status = 'pending'
+                ''',
+                [(status, row[0]) for row in moved]
+            )
+            if moved:
+                await _roll_up_reviewed(db, [row[0] for row in moved])
+        for row in moved:
+            self._update_entitlement(row[1], row[2], granted=status == 'approved')
+        return moved
+
+    async def approve_purchases(self, purchase_ids: list):
+        """Approve many pending purchases at once; rows as in _transition_purchases"""
+        return await self._transition_purchases(purchase_ids, 'approved')
+
+    async def reject_purchases(self, purchase_ids: list):
+        """Reject many pending purchases at once; rows as in _transition_purchases"""
+        return await self._transition_purchases(purchase_ids, 'rejected')
+
+    async def get_purchase_detail(self, purchase_id: int):
+        """Get a purchase with its user and episode for the review screen"""
+        async with self.reader() as db:
+            async with db.execute('''
+                SELECT p.purchase_id, p.user_id, p.episode_id, p.receipt_photo, p.payment_status,
+                       u.username, e.title, e.price
+                FROM purchases p
+                JOIN users u ON p.user_id = u.user_id
+                JOIN episodes e ON p.episode_id = e.episode_id
+                WHERE p.purchase_id = ?
+            ''', (purchase_id,)) as cursor:
+                return await cursor.fetchone()
 
     async def get_purchase(self, purchase_id: int):
         """Get purchase by ID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.reader() as db:
             async with db.execute('''
                 SELECT purchase_id, user_id, episode_id, payment_status
                 FROM purchases
@@ -228,49 +1108,99 @@ class Database:
             ''', (purchase_id,)) as cursor:
                 return await cursor.fetchone()
 
-    async def get_user_purchases(self, user_id: int):
-        """Get all approved purchases for a user"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT e.episode_id, e.title, c.title as course_title, e.episode_number
+    async def get_user_purchases_page(self, user_id: int, key: tuple, forward: bool, limit: int):
+        """Up to `limit` approved purchases after (or before) the (course_id, episode_number, episode_id) key"""
+        condition, order = ('>', 'ASC') if forward else ('<', 'DESC')
+        async with self.reader() as db:
+            async with db.execute(f'''
+                SELECT e.episode_id, e.title, c.title as course_title, e.episode_number, c.course_id
                 FROM purchases p
                 JOIN episodes e ON p.episode_id = e.episode_id
                 JOIN courses c ON e.course_id = c.course_id
                 WHERE p.user_id = ? AND p.payment_status = 'approved'
-                ORDER BY c.course_id, e.episode_number
-            ''', (user_id,)) as cursor:
+                  AND (c.course_id, e.episode_number, e.episode_id) {condition} (?, ?, ?)
+                ORDER BY c.course_id {order}, e.episode_number {order}, e.episode_id {order}
+                LIMIT ?
+            ''', (user_id, *(key or ((-1, -1, -1) if forward else (2 ** 63 - 1,) * 3)), limit)) as cursor:
                 return await cursor.fetchall()
 
     async def has_access(self, user_id: int, episode_id: int) -> bool:
         """Check if user has access to an episode"""
-        async with aiosqlite.connect(self.db_path) as db:
+        return episode_id in await self.get_entitlements(user_id)
+
+    # Entitlement cache
+    async def get_entitlements(self, user_id: int) -> set:
+        """Get the IDs of all episodes a user has an approved purchase for"""
+        entry = self._entitlements.get(user_id)
+        if entry and time.monotonic() - entry[0] < config.ENTITLEMENT_CACHE_TTL:
+            self._entitlements.move_to_end(user_id)
+            self.entitlement_hits += 1
+            return entry[1]
+
+        self.entitlement_misses += 1
+        generation = self._entitlement_generation
+        async with self.reader() as db:
             async with db.execute('''
-                SELECT COUNT(*) FROM purchases
-                WHERE user_id = ? AND episode_id = ? AND payment_status = 'approved'
-            ''', (user_id, episode_id)) as cursor:
-                result = await cursor.fetchone()
-                return result[0] > 0
+                SELECT episode_id FROM purchases
+                WHERE user_id = ? AND payment_status = 'approved'
+            ''', (user_id,)) as cursor:
+                episode_ids = {row[0] for row in await cursor.fetchall()}
+
+        # Only cache the set if no approval/rejection raced with the query
+        if generation == self._entitlement_generation:
+            self._entitlements[user_id] = (time.monotonic(), episode_ids)
+            self._entitlements.move_to_end(user_id)
+            while len(self._entitlements) > config.ENTITLEMENT_CACHE_SIZE:
+                self._entitlements.popitem(last=False)
+        return episode_ids
+
+    def _update_entitlement(self, user_id: int, episode_id: int, granted: bool):
+        """Apply an approval or rejection to the cached set, if the user is cached"""
+        self._entitlement_generation += 1
+        entry = self._entitlements.get(user_id)
+        if entry:
+            if granted:
+                entry[1].add(episode_id)
+            else:
+                entry[1].discard(episode_id)
+        self._publish_cache_change('_update_entitlement', user_id, episode_id, granted)
+
+    def _forget_episodes(self, episode_ids):
+        """Drop deleted episodes from every cached entitlement set"""
+        self._entitlement_generation += 1
+        for episode_id in episode_ids:
+            self._episode_meta.pop(episode_id, None)
+        for _, episode_set in self._entitlements.values():
+            episode_set.difference_update(episode_ids)
+        self._publish_cache_change('_forget_episodes', list(episode_ids))
 
     # Token methods
     async def create_video_token(self, user_id: int, episode_id: int) -> str:
         """Create a video access token"""
+        expires_at = int(time.time()) + config.TOKEN_EXPIRY_HOURS * 3600
+        if config.VIDEO_TOKEN_MODE == 'signed':
+            return sign_video_token(user_id, episode_id, expires_at)
+
         token = secrets.token_urlsafe(32)
-        expires_at = datetime.now() + timedelta(hours=config.TOKEN_EXPIRY_HOURS)
-        
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             await db.execute('''
                 INSERT INTO video_tokens (token, user_id, episode_id, expires_at)
                 VALUES (?, ?, ?, ?)
-            ''', (token, user_id, episode_id, expires_at.isoformat()))
-            await db.commit()
+            ''', (token, user_id, episode_id, expires_at))
         
         return token
 
     async def validate_token(self, token: str):
         """Validate a video token and return episode info"""
-        async with aiosqlite.connect(self.db_path) as db:
+        # Signed tokens contain a '.', which token_urlsafe() never produces,
+        # so tokens issued in either mode stay valid after switching modes
+        if '.' in token:
+            return await self._validate_signed_token(token)
+
+        async with self.reader() as db:
             async with db.execute('''
-                SELECT vt.user_id, vt.episode_id, vt.expires_at, e.video_path, e.title
+                SELECT vt.user_id, vt.episode_id, vt.expires_at, e.video_path, e.title,
+                       e.file_size, e.duration, e.poster
                 FROM video_tokens vt
                 JOIN episodes e ON vt.episode_id = e.episode_id
                 WHERE vt.token = ?
@@ -280,59 +1210,193 @@ class Database:
                 if not result:
                     return None
                 
-                user_id, episode_id, expires_at, video_path, title = result
+                user_id, episode_id, expires_at, video_path, title, file_size, duration, poster = result
                 
                 # Check if token is expired
-                if datetime.fromisoformat(expires_at) < datetime.now():
+                if expires_at < time.time():
                     return None
                 
                 return {
                     'user_id': user_id,
                     'episode_id': episode_id,
+                    'expires_at': expires_at,
                     'video_path': video_path,
-                    'title': title
+                    'title': title,
+                    'file_size': file_size,
+                    'duration': duration,
+                    'poster': poster
                 }
 
-    async def get_stats(self):
-        """Get bot statistics"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Total users
-            async with db.execute('SELECT COUNT(*) FROM users') as cursor:
-                total_users = (await cursor.fetchone())[0]
-            
-            # Total courses
-            async with db.execute('SELECT COUNT(*) FROM courses') as cursor:
-                total_courses = (await cursor.fetchone())[0]
-            
-            # Total episodes
-            async with db.execute('SELECT COUNT(*) FROM episodes') as cursor:
-                total_episodes = (await cursor.fetchone())[0]
-            
-            # Total sales
-            async with db.execute('SELECT COUNT(*) FROM purchases WHERE payment_status = "approved"') as cursor:
-                total_sales = (await cursor.fetchone())[0]
-            
-            # Pending purchases
-            async with db.execute('SELECT COUNT(*) FROM purchases WHERE payment_status = "pending"') as cursor:
-                pending_purchases = (await cursor.fetchone())[0]
-            
-            # Total revenue
+    async def _validate_signed_token(self, token: str):
+        """Validate a signed token without touching the video_tokens table"""
+        claims = verify_video_token(token)
+        if not claims:
+            return None
+
+        user_id, episode_id, expires_at = claims
+        if expires_at < time.time():
+            return None
+
+        # Deleting the episode ends access, within EPISODE_META_CACHE_TTL
+        episode = await self._get_episode_meta(episode_id)
+        if not episode:
+            return None
+
+        video_path, title, file_size, duration, poster = episode
+        return {
+            'user_id': user_id,
+            'episode_id': episode_id,
+            'expires_at': expires_at,
+            'video_path': video_path,
+            'title': title,
+            'file_size': file_size,
+            'duration': duration,
+            'poster': poster
+        }
+
+    async def _get_episode_meta(self, episode_id: int):
+        """(video_path, title, file_size, duration, poster) from a small TTL'd LRU
+
+        The Web App process does not see the bot's catalog invalidations, so
+        this reads the episodes table directly and re-checks after the TTL.
+        """
+        entry = self._episode_meta.get(episode_id)
+        if entry and time.monotonic() - entry[0] < config.EPISODE_META_CACHE_TTL:
+            self._episode_meta.move_to_end(episode_id)
+            return entry[1]
+
+        async with self.reader() as db:
             async with db.execute('''
-                SELECT SUM(e.price)
-                FROM purchases p
-                JOIN episodes e ON p.episode_id = e.episode_id
-                WHERE p.payment_status = 'approved'
-            ''') as cursor:
-                total_revenue = (await cursor.fetchone())[0] or 0
-            
-            return {
-                'total_users': total_users,
-                'total_courses': total_courses,
-                'total_episodes': total_episodes,
-                'total_sales': total_sales,
-                'pending_purchases': pending_purchases,
-                'total_revenue': total_revenue
+                SELECT video_path, title, file_size, duration, poster
+                FROM episodes WHERE episode_id = ?
+            ''', (episode_id,)) as cursor:
+                episode = await cursor.fetchone()
+        if episode is None:
+            self._episode_meta.pop(episode_id, None)
+            return None
+
+        self._episode_meta[episode_id] = (time.monotonic(), episode)
+        self._episode_meta.move_to_end(episode_id)
+        while len(self._episode_meta) > config.EPISODE_META_CACHE_SIZE:
+            self._episode_meta.popitem(last=False)
+        return episode
+
+    # Broadcast methods
+    async def set_user_blocked(self, user_id: int, blocked: bool = True):
+        """Mark whether the bot can still message a user"""
+        async with self.writer() as db:
+            await db.execute('UPDATE users SET is_blocked = ? WHERE user_id = ?', (int(blocked), user_id))
+        if blocked:
+            # add_user skips unchanged profiles, and its write is what unblocks
+            self._forget_profiles([user_id])
+
+    async def count_reachable_users(self) -> int:
+        """Count users a broadcast would go to"""
+        async with self.reader() as db:
+            async with db.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 0') as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        """Next `limit` reachable user IDs after `after_user_id`, in ID order"""
+        async with self.reader() as db:
+            async with db.execute('''
+                SELECT user_id FROM users
+                WHERE user_id > ? AND is_blocked = 0
+                ORDER BY user_id
+                LIMIT ?
+            ''', (after_user_id, limit)) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def create_broadcast(self, from_chat_id: int, message_id: int, preview: str = None) -> int:
+        """Record a new broadcast of a message and return its ID"""
+        if self._pending_profiles:
+            await self.flush_users()  # Recently joined users should get it too
+        async with self.writer() as db:
+            async with db.execute('''
+                INSERT INTO broadcasts (from_chat_id, message_id, preview, total)
+                VALUES (?, ?, ?, (SELECT COUNT(*) FROM users WHERE is_blocked = 0))
+            ''', (from_chat_id, message_id, preview)) as cursor:
+                return cursor.lastrowid
+
+    async def get_broadcast(self, broadcast_id: int):
+        """Get a broadcast by ID"""
+        async with self.reader() as db:
+            async with db.execute('''
+                SELECT broadcast_id, from_chat_id, message_id, preview, status, total,
+                       last_user_id, sent, failed, blocked, created_at, finished_at
+                FROM broadcasts
+                WHERE broadcast_id = ?
+            ''', (broadcast_id,)) as cursor:
+                return await cursor.fetchone()
+
+    async def get_latest_broadcast(self):
+        """Get the most recent broadcast, or None"""
+        async with self.reader() as db:
+            async with db.execute('SELECT MAX(broadcast_id) FROM broadcasts') as cursor:
+                broadcast_id = (await cursor.fetchone())[0]
+        return await self.get_broadcast(broadcast_id) if broadcast_id else None
+
+    async def get_running_broadcasts(self):
+        """Get the IDs of broadcasts that have not finished or been stopped"""
+        async with self.reader() as db:
+            async with db.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running'") as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int,
+                                      sent: int, failed: int, blocked_ids: list):
+        """Record one delivered batch and mark its dead chats, in one transaction"""
+        async with self.writer() as db:
+            if blocked_ids:
+                await db.executemany(
+                    'UPDATE users SET is_blocked = 1 WHERE user_id = ?',
+                    [(user_id,) for user_id in blocked_ids]
+                )
+            await db.execute('''
+                UPDATE broadcasts
+                SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+                WHERE broadcast_id = ?
+            ''', (last_user_id, sent, failed, len(blocked_ids), broadcast_id))
+        if blocked_ids:
+            self._forget_profiles(blocked_ids)
+
+    async def set_broadcast_status(self, broadcast_id: int, status: str, from_status: str = None) -> bool:
+        """Move a broadcast to `status`; with from_status, only from that status"""
+        finished = "CAST(strftime('%s', 'now') AS INTEGER)" if status in ('done', 'cancelled') else 'NULL'
+        async with self.writer() as db:
+            async with db.execute(f'''
+                UPDATE broadcasts SET status = ?, finished_at = {finished}
+                WHERE broadcast_id = ? AND status = COALESCE(?, status)
+            ''', (status, broadcast_id, from_status)) as cursor:
+                return cursor.rowcount > 0
+
+    async def get_stats(self):
+        """Get bot statistics from the trigger-maintained counters row"""
+        async with self.reader() as db:
+            async with db.execute(f'SELECT {", ".join(STATS_COLUMNS)} FROM stats_counters WHERE id = 1') as cursor:
+                row = await cursor.fetchone()
+        return dict(zip(STATS_COLUMNS, row or (0,) * len(STATS_COLUMNS)))
+
+    async def check_stats(self, repair: bool = False):
+        """Compare the counters row with totals computed from the tables
+
+        Returns {column: (stored, actual)} for the columns that differ; with
+        repair, the row is recomputed in the same transaction.
+        """
+        async with self.writer() as db:
+            await db.execute('BEGIN IMMEDIATE')
+            async with db.execute(f'SELECT {", ".join(STATS_COLUMNS)} FROM stats_counters WHERE id = 1') as cursor:
+                stored = await cursor.fetchone() or (0,) * len(STATS_COLUMNS)
+            async with db.execute(STATS_SQL) as cursor:
+                actual = await cursor.fetchone()
+            mismatches = {
+                name: (have, want)
+                for name, have, want in zip(STATS_COLUMNS, stored, actual)
+                # Revenue is summed in floating point in a different order
+                if abs(have - want) > 0.005
             }
+            if mismatches and repair:
+                await _backfill_stats(db)
+        return mismatches
 
 
 # Global database instance
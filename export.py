@@ -0,0 +1,163 @@
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+
+from aiogram import Bot
+from aiogram.methods import SendDocument
+from aiogram.types import FSInputFile
+
+import config
+from database import db as default_db
+from outbox import outbox
+
+logger = logging.getLogger(__name__)
+
+
+# Exportable datasets: name -> (column names, Database method, key columns)
+#
+# The method returns the next `limit` rows after a key in key order, and a
+# row's key is made of the columns at the key positions.
+DATASETS = {
+    'users': (
+        ('user_id', 'username', 'first_name', 'is_admin', 'is_blocked', 'created_at'),
+        'export_users', (0,),
+    ),
+    'purchases': (
+        ('purchase_id', 'user_id', 'username', 'episode_id', 'episode_title', 'course_id',
+         'course_title', 'price', 'payment_status', 'purchased_at', 'reviewed_at'),
+        'export_purchases', (0,),
+    ),
+    'sales': (
+        ('day', 'episode_id', 'episode_title', 'course_id', 'course_title',
+         'sales', 'revenue', 'rejected', 'approval_seconds', 'timed_approvals'),
+        'export_daily_sales', (0, 1),
+    ),
+    'signups': (
+        ('day', 'new_users'),
+        'export_daily_users', (0,),
+    ),
+}
+
+FORMATS = ('csv', 'jsonl')
+
+
+def _open_output(path: str, fmt: str, columns: tuple):
+    """Open a gzip file for `fmt`; returns (file, function writing a batch of rows)"""
+    if fmt == 'csv':
+        # The BOM lets spreadsheet programs detect UTF-8 (Arabic names)
+        out = gzip.open(path, 'wt', encoding='utf-8-sig', newline='')
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        return out, writer.writerows
+
+    out = gzip.open(path, 'wt', encoding='utf-8')
+
+    def write_lines(rows):
+        out.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+    return out, write_lines
+
+
+class Exporter:
+    """Write a dataset to a gzip-compressed CSV or JSONL temporary file
+
+    Rows are read EXPORT_BATCH_SIZE at a time by key, each batch in its own
+    short read, and compressed to disk before the next one is read, so
+    memory use does not grow with the table and no read transaction stays
+    open for the length of the export. Compression and disk writes run in
+    the default executor to keep the event loop free.
+
+    send() runs the export and the upload as a background task, like the
+    broadcaster, so the update that asked for it is finished right away;
+    a failure is reported to the admin's chat.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or default_db
+        self._tasks = {}  # (chat_id, name, fmt) -> task exporting it in this process
+
+    def send(self, bot: Bot, chat_id: int, name: str, fmt: str = 'csv') -> bool:
+        """Export a dataset and upload it to `chat_id` in the background; False if already underway"""
+        key = (chat_id, name, fmt)
+        if key in self._tasks:
+            return False
+        task = asyncio.ensure_future(self._send(bot, chat_id, name, fmt))
+        self._tasks[key] = task
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return True
+
+    async def stop(self):
+        """Cancel the exports still running; their temporary files are removed"""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _finished(self, key: tuple, task: asyncio.Task):
+        self._tasks.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Export {key[1]} for chat {key[0]} failed", exc_info=task.exception())
+
+    async def _send(self, bot: Bot, chat_id: int, name: str, fmt: str):
+        try:
+            path, rows = await self.export(name, fmt)
+        except Exception:
+            logger.exception(f"Exporting {name} failed")
+            await bot.send_message(chat_id, "❌ فشل التصدير، حاول مرة أخرى لاحقاً.")
+            return
+
+        try:
+            size = os.path.getsize(path)
+            if size > config.EXPORT_MAX_BYTES:
+                await bot.send_message(
+                    chat_id,
+                    f"❌ حجم الملف ({size / 1024 / 1024:.1f} MB) أكبر من الحد المسموح للرفع."
+                )
+                return
+            filename = f"{name}-{time.strftime('%Y%m%d')}.{fmt}.gz"
+            try:
+                # Waits for the upload, so the file is not deleted under it
+                await outbox.send(bot, SendDocument(
+                    chat_id=chat_id,
+                    document=FSInputFile(path, filename=filename),
+                    caption=f"📤 {filename}\nعدد الصفوف: {rows}"
+                ), priority=outbox.HIGH)
+            except Exception:
+                logger.exception(f"Uploading the {name} export failed")
+                await bot.send_message(chat_id, "❌ تعذّر رفع ملف التصدير، حاول مرة أخرى.")
+        finally:
+            os.remove(path)
+
+    async def export(self, name: str, fmt: str = 'csv'):
+        """Export dataset `name`; returns (path, rows). The caller deletes the file"""
+        columns, method, key_columns = DATASETS[name]
+        fetch = getattr(self.db, method)
+        loop = asyncio.get_running_loop()
+        fd, path = tempfile.mkstemp(prefix=f'{name}-', suffix=f'.{fmt}.gz')
+        os.close(fd)
+        rows = 0
+        try:
+            out, write = _open_output(path, fmt, columns)
+            try:
+                key = None
+                while True:
+                    batch = await fetch(key, config.EXPORT_BATCH_SIZE)
+                    if batch:
+                        await loop.run_in_executor(None, write, batch)
+                        rows += len(batch)
+                        key = tuple(batch[-1][column] for column in key_columns)
+                    if len(batch) < config.EXPORT_BATCH_SIZE:
+                        break
+            finally:
+                await loop.run_in_executor(None, out.close)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path, rows
+
+
+# Global exporter instance
+exporter = Exporter()
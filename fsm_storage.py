@@ -0,0 +1,116 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import config
+from database import db as default_db
+
+
+def state_ttl(state: Optional[str]) -> int:
+    """Seconds a conversation may sit idle in `state` before it is dropped
+
+    Looked up by full state name, then by its StatesGroup, then
+    FSM_DEFAULT_TTL.
+    """
+    if state is None:
+        return config.FSM_DEFAULT_TTL
+    if state in config.FSM_STATE_TTLS:
+        return config.FSM_STATE_TTLS[state]
+    return config.FSM_STATE_TTLS.get(state.split(':', 1)[0], config.FSM_DEFAULT_TTL)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in the bot database's fsm_states table
+
+    Writes go straight to SQLite and into an in-memory LRU of FSM_CACHE_SIZE
+    entries that serves reads. The cache assumes a key is only handled by one
+    process at a time, which holds for a single process and for the sharded
+    workers (users are pinned to a worker); set FSM_CACHE_SIZE=0 for any
+    other multi-process layout. Every write pushes the entry's expiry
+    state_ttl() seconds ahead; expired rows read as empty and are deleted by
+    the maintenance sweeper.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or default_db
+        self._cache = OrderedDict()  # key -> (state, data, expires_at)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny,
+        ))
+
+    async def _load(self, key: str):
+        """(state, data) for a key, from the cache or the database"""
+        entry = self._cache.get(key)
+        if entry is None:
+            async with self.db.reader() as conn:
+                async with conn.execute(
+                    'SELECT state, data, expires_at FROM fsm_states WHERE storage_key = ?', (key,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            entry = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, None)
+            self._remember(key, entry)
+        else:
+            self._cache.move_to_end(key)
+
+        state, data, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            return None, {}
+        return state, data
+
+    def _remember(self, key: str, entry):
+        if config.FSM_CACHE_SIZE <= 0:
+            return
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > config.FSM_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def _save(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        if state is None and not data:
+            # Nothing left to remember, so drop the row instead of storing an empty one
+            async with self.db.writer() as conn:
+                await conn.execute('DELETE FROM fsm_states WHERE storage_key = ?', (key,))
+            self._remember(key, (None, {}, None))
+            return
+
+        expires_at = int(time.time()) + state_ttl(state)
+        async with self.db.writer() as conn:
+            await conn.execute('''
+                INSERT INTO fsm_states (storage_key, state, data, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(storage_key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    expires_at = excluded.expires_at
+            ''', (key, state, json.dumps(data, ensure_ascii=False), expires_at))
+        self._remember(key, (state, data, expires_at))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = self._key(key)
+        _, data = await self._load(name)
+        await self._save(name, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        name = self._key(key)
+        state, _ = await self._load(name)
+        await self._save(name, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        """Nothing to close; the database pool belongs to `db`"""
+        self._cache.clear()
@@ -1,13 +1,23 @@
 from aiogram import Router, F
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from analytics import analytics, bar
+from broadcast import broadcaster, progress
 from database import db
+from export import DATASETS, FORMATS, exporter
+from functools import partial
 from keyboards import admin_kb, user_kb
+from keyboards.pagination import fetch_page
+from maintenance import scheduler
+from middlewares.role import AdminGuardMiddleware
 import config
 
 router = Router()
+router.message.middleware(AdminGuardMiddleware())
+router.callback_query.middleware(AdminGuardMiddleware())
 
 
 class CourseStates(StatesGroup):
@@ -24,18 +34,13 @@ class EpisodeStates(StatesGroup):
     waiting_for_episode_video = State()
 
 
-async def is_admin_check(user_id: int) -> bool:
-    """Check if user is admin"""
-    return await db.is_admin(user_id)
+class BroadcastStates(StatesGroup):
+    waiting_for_message = State()
 
 
 @router.message(Command("admin"))
 async def cmd_admin(message: Message):
     """Admin panel command"""
-    if not await is_admin_check(message.from_user.id):
-        await message.answer("❌ هذا الأمر متاح للمسؤولين فقط.")
-        return
-    
     await message.answer(
         "🔑 لوحة التحكم\n\nاختر من القائمة:",
         reply_markup=admin_kb.admin_main_menu_keyboard()
@@ -45,10 +50,6 @@ async def cmd_admin(message: Message):
 @router.callback_query(F.data == "admin_panel")
 async def show_admin_panel(callback: CallbackQuery):
     """Show admin panel"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     await callback.message.edit_text(
         "🔑 لوحة التحكم\n\nاختر من القائمة:",
         reply_markup=admin_kb.admin_main_menu_keyboard()
@@ -57,23 +58,21 @@ async def show_admin_panel(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "admin_courses")
+@router.callback_query(F.data.startswith("admin_courses_"))
 async def show_admin_courses(callback: CallbackQuery):
     """Show courses management"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
-    courses = await db.get_all_courses()
+    token = callback.data[len("admin_courses_"):] if callback.data.startswith("admin_courses_") else None
+    page = await fetch_page(db.get_courses_page, user_kb.course_key, token)
     
     text = "📚 إدارة الكورسات\n\n"
-    if courses:
-        text += f"عدد الكورسات: {len(courses)}"
+    if page.rows:
+        text += f"عدد الكورسات: {await db.count_courses()}"
     else:
         text += "لا توجد كورسات. أضف كورس جديد!"
     
     await callback.message.edit_text(
         text,
-        reply_markup=admin_kb.admin_courses_keyboard(courses)
+        reply_markup=admin_kb.admin_courses_keyboard(page)
     )
     await callback.answer()
 
@@ -81,10 +80,6 @@ async def show_admin_courses(callback: CallbackQuery):
 @router.callback_query(F.data == "admin_add_course")
 async def add_course_start(callback: CallbackQuery, state: FSMContext):
     """Start adding a new course"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     await callback.message.edit_text("📝 أدخل عنوان الكورس:")
     await state.set_state(CourseStates.waiting_for_course_title)
     await callback.answer()
@@ -136,12 +131,10 @@ async def receive_course_price(message: Message, state: FSMContext):
 
 @router.callback_query(F.data.startswith("admin_course_"))
 async def show_course_detail(callback: CallbackQuery):
-    """Show course details and episodes"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
-    course_id = int(callback.data.split("_")[2])
+    """Show course details and a page of its episodes"""
+    parts = callback.data.split("_")
+    course_id = int(parts[2])
+    token = parts[3] if len(parts) > 3 else None
     
     course = await db.get_course(course_id)
     if not course:
@@ -149,18 +142,18 @@ async def show_course_detail(callback: CallbackQuery):
         return
     
     course_id, title, description, price = course
-    episodes = await db.get_course_episodes(course_id)
+    page = await fetch_page(partial(db.get_course_episodes_page, course_id), user_kb.episode_key, token)
     
     text = f"📖 {title}\n\n"
     if description:
         text += f"{description}\n\n"
     text += f"💰 السعر: ${price:.2f}\n"
-    text += f"🎬 عدد الحلقات: {len(episodes)}\n\n"
+    text += f"🎬 عدد الحلقات: {await db.count_course_episodes(course_id)}\n\n"
     text += "إدارة الحلقات:"
     
     await callback.message.edit_text(
         text,
-        reply_markup=admin_kb.admin_course_detail_keyboard(course_id, episodes)
+        reply_markup=admin_kb.admin_course_detail_keyboard(course_id, page)
     )
     await callback.answer()
 
@@ -168,10 +161,6 @@ async def show_course_detail(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("admin_add_episode_"))
 async def add_episode_start(callback: CallbackQuery, state: FSMContext):
     """Start adding a new episode"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     course_id = int(callback.data.split("_")[3])
     
     await state.update_data(course_id=course_id)
@@ -249,7 +238,10 @@ async def receive_episode_video(message: Message, state: FSMContext):
         description=description,
         video_path=video_path,
         price=price,
-        episode_number=episode_number
+        episode_number=episode_number,
+        file_size=video.file_size,
+        duration=video.duration,
+        poster=video.thumbnail.file_id if video.thumbnail else None
     )
     
     await message.answer(
@@ -265,10 +257,6 @@ async def receive_episode_video(message: Message, state: FSMContext):
 @router.callback_query(F.data.startswith("admin_delete_course_"))
 async def confirm_delete_course(callback: CallbackQuery):
     """Confirm course deletion"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     course_id = int(callback.data.split("_")[3])
     
     course = await db.get_course(course_id)
@@ -287,10 +275,6 @@ async def confirm_delete_course(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("confirm_delete_course_"))
 async def delete_course(callback: CallbackQuery):
     """Delete course"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     course_id = int(callback.data.split("_")[3])
     
     await db.delete_course(course_id)
@@ -315,10 +299,6 @@ async def cancel_delete(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("admin_delete_episode_"))
 async def confirm_delete_episode(callback: CallbackQuery):
     """Confirm episode deletion"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     episode_id = int(callback.data.split("_")[3])
     
     episode = await db.get_episode(episode_id)
@@ -336,10 +316,6 @@ async def confirm_delete_episode(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("confirm_delete_episode_"))
 async def delete_episode(callback: CallbackQuery):
     """Delete episode"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     episode_id = int(callback.data.split("_")[3])
     
     await db.delete_episode(episode_id)
@@ -352,40 +328,74 @@ async def delete_episode(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "admin_users")
+@router.callback_query(F.data.startswith("admin_users_"))
 async def show_users(callback: CallbackQuery):
-    """Show all users"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
-    users = await db.get_all_users()
+    """Show a page of users"""
+    prefix = "admin_users_"
+    token = callback.data[len(prefix):] if callback.data.startswith(prefix) else None
+    page = await fetch_page(db.get_users_page, admin_kb.user_key, token)
     
     text = "👥 المستخدمين\n\n"
-    text += f"عدد المستخدمين: {len(users)}\n\n"
+    text += f"عدد المستخدمين: {(await db.get_stats())['total_users']}\n\n"
     
-    for user in users[:20]:  # Show first 20 users
-        user_id, username, first_name, is_admin, created_at = user
+    for user in page.rows:
+        user_id, username, first_name, is_admin, is_blocked, created_at = user
         admin_badge = "🔑 " if is_admin else ""
+        blocked_badge = " 🚫" if is_blocked else ""
         username_display = f"@{username}" if username else f"ID: {user_id}"
-        text += f"{admin_badge}{first_name} ({username_display})\n"
-    
-    if len(users) > 20:
-        text += f"\n... و {len(users) - 20} مستخدم آخر"
+        text += f"{admin_badge}{first_name} ({username_display}){blocked_badge}\n"
     
     await callback.message.edit_text(
         text,
-        reply_markup=admin_kb.back_to_admin_keyboard()
+        reply_markup=admin_kb.admin_users_keyboard(page)
+    )
+    await callback.answer()
+
+
+@router.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject):
+    """Export a dataset: /export <users|purchases|sales|signups> [csv|jsonl]"""
+    args = (command.args or "").split()
+    if not args or args[0] not in DATASETS or (len(args) > 1 and args[1] not in FORMATS):
+        await message.answer(
+            "📤 تصدير البيانات\n\nاختر البيانات والصيغة (ملف مضغوط gzip):",
+            reply_markup=admin_kb.export_keyboard()
+        )
+        return
+    
+    if exporter.send(message.bot, message.chat.id, args[0], args[1] if len(args) > 1 else 'csv'):
+        await message.answer("⏳ جارٍ التصدير، سيصلك الملف عند اكتماله...")
+    else:
+        await message.answer("⏳ هذا التصدير قيد التنفيذ بالفعل.")
+
+
+@router.callback_query(F.data == "admin_export")
+async def show_export(callback: CallbackQuery):
+    """Show the data export menu"""
+    await callback.message.edit_text(
+        "📤 تصدير البيانات\n\nاختر البيانات والصيغة (ملف مضغوط gzip):",
+        reply_markup=admin_kb.export_keyboard()
     )
     await callback.answer()
 
 
+@router.callback_query(F.data.startswith("export_"))
+async def export_dataset(callback: CallbackQuery):
+    """Export the chosen dataset and send it as a document"""
+    _, name, fmt = callback.data.split("_")
+    if name not in DATASETS or fmt not in FORMATS:
+        await callback.answer("❌ خيار غير معروف", show_alert=True)
+        return
+    
+    if exporter.send(callback.bot, callback.message.chat.id, name, fmt):
+        await callback.answer("⏳ جارٍ التصدير، سيصلك الملف عند اكتماله...")
+    else:
+        await callback.answer("⏳ هذا التصدير قيد التنفيذ بالفعل.")
+
+
 @router.callback_query(F.data == "admin_stats")
 async def show_stats(callback: CallbackQuery):
     """Show bot statistics"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     stats = await db.get_stats()
     
     text = "📊 الإحصائيات\n\n"
@@ -394,10 +404,268 @@ async def show_stats(callback: CallbackQuery):
     text += f"🎬 إجمالي الحلقات: {stats['total_episodes']}\n"
     text += f"✅ إجمالي المبيعات: {stats['total_sales']}\n"
     text += f"⏳ طلبات معلقة: {stats['pending_purchases']}\n"
-    text += f"💰 إجمالي الإيرادات: ${stats['total_revenue']:.2f}"
+    text += f"💰 إجمالي الإيرادات: ${stats['total_revenue']:.2f}\n\n"
+    
+    cache = db.cache_stats()
+    text += f"🗂 ذاكرة الكتالوج: {cache['catalog_hits']} إصابة / {cache['catalog_misses']} تحميل\n"
+    text += (f"🔐 ذاكرة الصلاحيات: {cache['entitlement_users']} مستخدم, "
+             f"{cache['entitlement_bytes'] / 1024:.1f} KB")
     
     await callback.message.edit_text(
         text,
         reply_markup=admin_kb.back_to_admin_keyboard()
     )
     await callback.answer()
+
+
+STATS_LABELS = {
+    'total_users': "👥 المستخدمين",
+    'total_courses': "📚 الكورسات",
+    'total_episodes': "🎬 الحلقات",
+    'total_sales': "✅ المبيعات",
+    'pending_purchases': "⏳ الطلبات المعلقة",
+    'total_revenue': "💰 الإيرادات",
+}
+
+
+@router.message(Command("stats_check"))
+async def cmd_stats_check(message: Message):
+    """Check the statistics counters against the tables and repair them if they drifted"""
+    mismatches = await db.check_stats(repair=True)
+    if not mismatches:
+        await message.answer("✅ عدادات الإحصائيات مطابقة للبيانات.")
+        return
+    
+    text = "⚠️ عدادات الإحصائيات لم تكن مطابقة وتم تصحيحها:\n\n"
+    for name, (stored, actual) in mismatches.items():
+        text += f"{STATS_LABELS[name]}: المسجل {stored}، الفعلي {actual}\n"
+    await message.answer(text)
+
+
+@router.message(Command("vacuum"))
+async def cmd_vacuum(message: Message):
+    """Switch an old database file to incremental auto_vacuum (one full VACUUM)"""
+    if (await scheduler.vacuum_mode()) == 2:
+        await message.answer("✅ الضغط التدريجي لقاعدة البيانات مفعّل بالفعل.")
+        return
+    
+    await message.answer("⏳ جارٍ ضغط قاعدة البيانات، قد تتأخر الردود قليلاً حتى ينتهي...")
+    result = await scheduler.enable_auto_vacuum()
+    await message.answer(
+        f"✅ تم ضغط قاعدة البيانات وتفعيل الضغط التدريجي.\n"
+        f"الصفحات المحررة: {result['freed_pages']}"
+    )
+
+
+def format_latency(seconds, approvals):
+    """Average approval time in minutes or hours, or '-' without timed approvals"""
+    if not approvals:
+        return "-"
+    minutes = seconds / approvals / 60
+    return f"{minutes:.0f} دقيقة" if minutes < 120 else f"{minutes / 60:.1f} ساعة"
+
+
+async def analytics_text():
+    """Daily sales, signups and top courses, drawn from the rollup tables"""
+    days = analytics.days()
+    totals = await analytics.daily_totals(days)
+    courses = await analytics.top_courses(days)
+    peak_revenue = max(row[2] for row in totals)
+    peak_users = max(row[3] for row in totals)
+    
+    text = f"📈 التحليلات - آخر {len(days)} يوم (UTC)\n\n"
+    text += "💰 المبيعات اليومية:\n"
+    for day, sales, revenue, new_users, seconds, timed in totals:
+        text += f"{day[5:]} {bar(revenue, peak_revenue)} ${revenue:.2f} ({sales})\n"
+    text += f"\nالإجمالي: {sum(row[1] for row in totals)} مبيعة، ${sum(row[2] for row in totals):.2f}\n"
+    text += (f"⏱ متوسط وقت الموافقة: "
+             f"{format_latency(sum(row[4] for row in totals), sum(row[5] for row in totals))}\n\n")
+    
+    text += "👥 المستخدمون الجدد:\n"
+    for day, sales, revenue, new_users, seconds, timed in totals:
+        text += f"{day[5:]} {bar(new_users, peak_users)} {new_users}\n"
+    
+    ranked = []
+    if courses:
+        text += "\n🏆 أعلى الكورسات:\n"
+        peak_course = courses[0][2]
+        for position, (course_id, sales, revenue, seconds, timed) in enumerate(courses, start=1):
+            course = await db.get_course(course_id)
+            title = course[1] if course else f"كورس {course_id}"
+            ranked.append((course_id, title))
+            text += f"{position}. {title}\n   {bar(revenue, peak_course)} ${revenue:.2f} ({sales})\n"
+    
+    text += f"\nℹ️ محتسب حتى الطلب #{await analytics.high_water_mark()}"
+    return text, ranked
+
+
+@router.callback_query(F.data == "admin_analytics")
+async def show_analytics(callback: CallbackQuery):
+    """Show the analytics screen"""
+    text, courses = await analytics_text()
+    try:
+        await callback.message.edit_text(text, reply_markup=admin_kb.analytics_keyboard(courses))
+    except TelegramBadRequest:
+        pass  # Nothing changed since it was last shown
+    await callback.answer()
+
+
+@router.callback_query(F.data == "analytics_refresh")
+async def refresh_analytics(callback: CallbackQuery):
+    """Roll up the purchases reviewed since the last run, then show the analytics screen"""
+    result = await analytics.rollup()
+    text, courses = await analytics_text()
+    try:
+        await callback.message.edit_text(text, reply_markup=admin_kb.analytics_keyboard(courses))
+    except TelegramBadRequest:
+        pass  # Nothing changed since it was last shown
+    await callback.answer(f"🔄 تمت إضافة {result['purchases']} طلب")
+
+
+@router.callback_query(F.data.startswith("analytics_course_"))
+async def show_course_analytics(callback: CallbackQuery):
+    """Show daily sales and the per-episode breakdown of one course"""
+    course_id = int(callback.data.split("_")[2])
+    course = await db.get_course(course_id)
+    days = analytics.days()
+    daily = await analytics.course_daily(course_id, days)
+    episodes = await analytics.course_episodes(course_id, days)
+    peak = max(row[2] for row in daily)
+    
+    title = course[1] if course else f"كورس {course_id}"
+    text = f"📖 {title} - آخر {len(days)} يوم (UTC)\n\n"
+    text += "💰 المبيعات اليومية:\n"
+    for day, sales, revenue in daily:
+        text += f"{day[5:]} {bar(revenue, peak)} ${revenue:.2f} ({sales})\n"
+    
+    if episodes:
+        text += "\n🎬 الحلقات:\n"
+        peak_episode = max(row[2] for row in episodes)
+        for episode_id, sales, revenue, seconds, timed in episodes:
+            episode = await db.get_episode(episode_id)
+            episode_title = episode[2] if episode else f"حلقة {episode_id}"
+            text += (f"• {episode_title}\n   {bar(revenue, peak_episode)} ${revenue:.2f} ({sales}) "
+                     f"⏱ {format_latency(seconds, timed)}\n")
+    
+    await callback.message.edit_text(text, reply_markup=admin_kb.analytics_course_keyboard())
+    await callback.answer()
+
+
+BROADCAST_STATUS = {
+    'running': "⏳ جارٍ الإرسال",
+    'paused': "⏸ متوقفة مؤقتاً",
+    'done': "✅ اكتملت",
+    'cancelled': "⛔ ملغاة",
+}
+
+
+def broadcast_text(broadcast):
+    """Progress report for a broadcast row"""
+    broadcast_id, _, _, preview, status, total, _, sent, failed, blocked = broadcast[:10]
+    info = progress(broadcast)
+    filled = info['percent'] // 10
+    
+    text = f"📣 الرسالة الجماعية #{broadcast_id}\n\n"
+    if preview:
+        text += f"📝 {preview}\n\n"
+    text += f"الحالة: {BROADCAST_STATUS.get(status, status)}\n"
+    text += f"{'█' * filled}{'░' * (10 - filled)} {info['percent']}%\n\n"
+    text += f"👥 المستلمون: {total}\n"
+    text += f"✅ تم الإرسال: {sent}\n"
+    text += f"🚫 حظروا البوت: {blocked}\n"
+    text += f"❌ فشل: {failed}\n"
+    text += f"⚡ السرعة: {info['rate']:.1f} رسالة/ثانية\n"
+    if info['eta'] is not None:
+        text += f"⏱️ الوقت المتبقي: ~{info['eta'] // 60} د {info['eta'] % 60} ث\n"
+    return text
+
+
+@router.callback_query(F.data == "admin_broadcast")
+async def show_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Show the latest broadcast and its progress"""
+    await state.clear()
+    broadcast = await db.get_latest_broadcast()
+    
+    if broadcast:
+        text = broadcast_text(broadcast)
+        markup = admin_kb.broadcast_keyboard(broadcast[0], broadcast[4])
+    else:
+        text = "📣 الرسائل الجماعية\n\nلم يتم إرسال أي رسالة جماعية بعد."
+        markup = admin_kb.broadcast_keyboard()
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest:
+        pass  # Refreshed with no progress since the last view
+    await callback.answer()
+
+
+@router.callback_query(F.data == "broadcast_new")
+async def new_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Ask for the message to broadcast"""
+    await callback.message.edit_text(
+        "✉️ أرسل الرسالة التي تريد إرسالها لجميع المستخدمين\n"
+        "(نص، صورة، فيديو...):"
+    )
+    await state.set_state(BroadcastStates.waiting_for_message)
+    await callback.answer()
+
+
+@router.message(BroadcastStates.waiting_for_message)
+async def receive_broadcast_message(message: Message, state: FSMContext):
+    """Receive the broadcast message and ask for confirmation"""
+    preview = (message.text or message.caption or "")[:100]
+    await state.update_data(message_id=message.message_id, preview=preview)
+    
+    recipients = await db.count_reachable_users()
+    await message.answer(
+        f"📣 سيتم إرسال هذه الرسالة إلى {recipients} مستخدم.\n\nهل تريد المتابعة؟",
+        reply_markup=admin_kb.confirm_broadcast_keyboard()
+    )
+
+
+@router.callback_query(F.data == "broadcast_send")
+async def send_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Start the confirmed broadcast"""
+    data = await state.get_data()
+    await state.clear()
+    if 'message_id' not in data:
+        await callback.answer("❌ انتهت صلاحية الطلب", show_alert=True)
+        return
+    
+    broadcast_id = await broadcaster.start(
+        callback.bot, callback.from_user.id, data['message_id'], data.get('preview')
+    )
+    broadcast = await db.get_broadcast(broadcast_id)
+    
+    await callback.message.edit_text(
+        broadcast_text(broadcast),
+        reply_markup=admin_kb.broadcast_keyboard(broadcast_id, broadcast[4])
+    )
+    await callback.answer("✅ بدأ الإرسال")
+
+
+@router.callback_query(F.data.startswith("broadcast_pause_"))
+async def pause_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Pause a running broadcast after its current batch"""
+    broadcast_id = int(callback.data.split("_")[2])
+    await db.set_broadcast_status(broadcast_id, 'paused', from_status='running')
+    await show_broadcast(callback, state)
+
+
+@router.callback_query(F.data.startswith("broadcast_resume_"))
+async def resume_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Continue a paused broadcast where it stopped"""
+    broadcast_id = int(callback.data.split("_")[2])
+    if await db.set_broadcast_status(broadcast_id, 'running', from_status='paused'):
+        broadcaster.run(callback.bot, broadcast_id)
+    await show_broadcast(callback, state)
+
+
+@router.callback_query(F.data.startswith("broadcast_cancel_"))
+async def cancel_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Stop a broadcast for good"""
+    broadcast_id = int(callback.data.split("_")[2])
+    if not await db.set_broadcast_status(broadcast_id, 'cancelled', from_status='running'):
+        await db.set_broadcast_status(broadcast_id, 'cancelled', from_status='paused')
+    await show_broadcast(callback, state)
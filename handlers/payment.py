@@ -1,63 +1,143 @@
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.context import FSMContext
+from aiogram.methods import SendMessage
 from aiogram.types import CallbackQuery
 from database import db
 from keyboards import admin_kb
+from keyboards.pagination import fetch_page
+from middlewares.role import AdminGuardMiddleware
+from outbox import outbox
 import config
 
 router = Router()
+router.callback_query.middleware(AdminGuardMiddleware())
 
 
-async def is_admin_check(user_id: int) -> bool:
-    """Check if user is admin"""
-    return await db.is_admin(user_id)
-
-
-@router.callback_query(F.data == "admin_pending_purchases")
-async def show_pending_purchases(callback: CallbackQuery):
-    """Show all pending purchase requests"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
-    purchases = await db.get_pending_purchases()
+async def render_pending_purchases(callback: CallbackQuery, state: FSMContext, token=None):
+    """Show a page of pending purchase requests with the admin's current selection"""
+    page = await fetch_page(db.get_pending_purchases_page, admin_kb.pending_purchase_key, token)
+    selected = set((await state.get_data()).get('selected_purchases', []))
     
     text = "💰 طلبات الشراء المعلقة\n\n"
     
-    if not purchases:
+    if not page.rows:
         text += "✅ لا توجد طلبات معلقة حالياً."
     else:
-        text += f"عدد الطلبات: {len(purchases)}\n\n"
-        text += "اختر طلب للمراجعة:"
+        text += f"عدد الطلبات: {await db.count_pending_purchases()}\n"
+        if selected:
+            text += f"المحدد: {len(selected)}\n"
+        text += "\nاختر طلب للمراجعة، أو حدد عدة طلبات لقبولها أو رفضها معاً:"
     
-    await callback.message.edit_text(
-        text,
-        reply_markup=admin_kb.pending_purchases_keyboard(purchases)
-    )
+    try:
+        await callback.message.edit_text(
+            text,
+            reply_markup=admin_kb.pending_purchases_keyboard(page, selected)
+        )
+    except TelegramBadRequest:
+        pass  # Nothing changed on screen
+
+
+@router.callback_query(F.data == "admin_pending_purchases")
+@router.callback_query(F.data.startswith("admin_pending_purchases_"))
+async def show_pending_purchases(callback: CallbackQuery, state: FSMContext):
+    """Show a page of pending purchase requests"""
+    prefix = "admin_pending_purchases_"
+    token = callback.data[len(prefix):] if callback.data.startswith(prefix) else None
+    await render_pending_purchases(callback, state, token)
     await callback.answer()
 
 
+@router.callback_query(F.data.startswith("select_payment_"))
+async def toggle_selection(callback: CallbackQuery, state: FSMContext):
+    """Add a pending purchase to the bulk selection, or take it out"""
+    _, _, purchase_id, token = callback.data.split("_", 3)
+    selected = set((await state.get_data()).get('selected_purchases', []))
+    selected ^= {int(purchase_id)}
+    await state.update_data(selected_purchases=sorted(selected))
+    await render_pending_purchases(callback, state, token)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("select_page_"))
+async def select_page(callback: CallbackQuery, state: FSMContext):
+    """Select every purchase on the current page"""
+    token = callback.data[len("select_page_"):]
+    page = await fetch_page(db.get_pending_purchases_page, admin_kb.pending_purchase_key, token)
+    selected = set((await state.get_data()).get('selected_purchases', []))
+    selected.update(purchase[0] for purchase in page.rows)
+    await state.update_data(selected_purchases=sorted(selected))
+    await render_pending_purchases(callback, state, token)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("clear_selection_"))
+async def clear_selection(callback: CallbackQuery, state: FSMContext):
+    """Empty the bulk selection"""
+    await state.update_data(selected_purchases=[])
+    await render_pending_purchases(callback, state, callback.data[len("clear_selection_"):])
+    await callback.answer()
+
+
+def notify_reviewed(bot, purchases, approved: bool):
+    """Queue one message per user covering all their reviewed purchases"""
+    titles_by_user = {}
+    for purchase_id, user_id, episode_id, episode_title, price in purchases:
+        titles_by_user.setdefault(user_id, []).append(episode_title or "غير معروف")
+    
+    for user_id, titles in titles_by_user.items():
+        if approved:
+            text = "✅ تم قبول طلب الشراء!\n\n"
+        else:
+            text = "❌ تم رفض طلب الشراء\n\n"
+        if len(titles) == 1:
+            text += f"🎬 الحلقة: {titles[0]}\n\n"
+        else:
+            text += "🎬 الحلقات:\n" + "".join(f"• {title}\n" for title in titles) + "\n"
+        if approved:
+            text += f"يمكنك الآن مشاهدة {'الحلقة' if len(titles) == 1 else 'الحلقات'} من قسم 'مشترياتي'."
+        else:
+            text += "يرجى التواصل مع الإدارة للمزيد من المعلومات."
+        # The outbox paces these to Telegram's limits and sends them concurrently
+        outbox.send(bot, SendMessage(chat_id=user_id, text=text))
+
+
+@router.callback_query(F.data.in_({"bulk_approve", "bulk_reject"}))
+async def bulk_review(callback: CallbackQuery, state: FSMContext):
+    """Approve or reject every selected purchase in one transaction"""
+    approved = callback.data == "bulk_approve"
+    selected = (await state.get_data()).get('selected_purchases', [])
+    if not selected:
+        await callback.answer("❌ لم يتم تحديد أي طلب", show_alert=True)
+        return
+    
+    if approved:
+        purchases = await db.approve_purchases(selected)
+    else:
+        purchases = await db.reject_purchases(selected)
+    await state.update_data(selected_purchases=[])
+    notify_reviewed(callback.bot, purchases, approved)
+    
+    await render_pending_purchases(callback, state)
+    if approved:
+        await callback.answer(f"✅ تم قبول {len(purchases)} طلب")
+    else:
+        await callback.answer(f"❌ تم رفض {len(purchases)} طلب")
+
+
 @router.callback_query(F.data.startswith("review_payment_"))
 async def review_payment(callback: CallbackQuery):
     """Review a specific payment request"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     purchase_id = int(callback.data.split("_")[2])
     
     # Get purchase details
-    purchases = await db.get_pending_purchases()
-    purchase = None
-    for p in purchases:
-        if p[0] == purchase_id:
-            purchase = p
-            break
+    purchase = await db.get_purchase_detail(purchase_id)
     
-    if not purchase:
+    if not purchase or purchase[4] != 'pending':
         await callback.answer("❌ الطلب غير موجود", show_alert=True)
         return
     
-    purchase_id, user_id, episode_id, receipt_photo, username, episode_title, price = purchase
+    purchase_id, user_id, episode_id, receipt_photo, payment_status, username, episode_title, price = purchase
     
     user_display = username if username else f"User {user_id}"
     
@@ -83,41 +163,27 @@ async def review_payment(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("approve_payment_"))
 async def approve_payment(callback: CallbackQuery):
     """Approve a payment request"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     purchase_id = int(callback.data.split("_")[2])
     
-    # Get purchase info before approval
-    purchase = await db.get_purchase(purchase_id)
+    # Approve purchase; only succeeds while it is still pending
+    purchase = await db.approve_purchase(purchase_id)
     if not purchase:
-        await callback.answer("❌ الطلب غير موجود", show_alert=True)
-        return
-    
-    purchase_id, user_id, episode_id, payment_status = purchase
-    
-    if payment_status != 'pending':
-        await callback.answer("❌ تم معالجة هذا الطلب مسبقاً", show_alert=True)
+        if await db.get_purchase(purchase_id):
+            await callback.answer("❌ تم معالجة هذا الطلب مسبقاً", show_alert=True)
+        else:
+            await callback.answer("❌ الطلب غير موجود", show_alert=True)
         return
     
-    # Approve purchase
-    await db.approve_purchase(purchase_id)
+    user_id, episode_id, episode_title, price = purchase
+    episode_title = episode_title or "غير معروف"
     
-    # Get episode info
-    episode = await db.get_episode(episode_id)
-    episode_title = episode[2] if episode else "غير معروف"
-    
-    # Notify user
-    try:
-        await callback.bot.send_message(
-            chat_id=user_id,
-            text=f"✅ تم قبول طلب الشراء!\n\n"
-                 f"🎬 الحلقة: {episode_title}\n\n"
-                 f"يمكنك الآن مشاهدة الحلقة من قسم 'مشترياتي'."
-        )
-    except Exception as e:
-        print(f"Error notifying user: {e}")
+    # Notify user (sent in the background)
+    outbox.send(callback.bot, SendMessage(
+        chat_id=user_id,
+        text=f"✅ تم قبول طلب الشراء!\n\n"
+             f"🎬 الحلقة: {episode_title}\n\n"
+             f"يمكنك الآن مشاهدة الحلقة من قسم 'مشترياتي'."
+    ))
     
     await callback.message.edit_caption(
         caption=f"✅ تم قبول الطلب بنجاح!\n\n"
@@ -130,41 +196,27 @@ async def approve_payment(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("reject_payment_"))
 async def reject_payment(callback: CallbackQuery):
     """Reject a payment request"""
-    if not await is_admin_check(callback.from_user.id):
-        await callback.answer("❌ غير مصرح لك", show_alert=True)
-        return
-    
     purchase_id = int(callback.data.split("_")[2])
     
-    # Get purchase info before rejection
-    purchase = await db.get_purchase(purchase_id)
+    # Reject purchase; only succeeds while it is still pending
+    purchase = await db.reject_purchase(purchase_id)
     if not purchase:
-        await callback.answer("❌ الطلب غير موجود", show_alert=True)
+        if await db.get_purchase(purchase_id):
+            await callback.answer("❌ تم معالجة هذا الطلب مسبقاً", show_alert=True)
+        else:
+            await callback.answer("❌ الطلب غير موجود", show_alert=True)
         return
     
-    purchase_id, user_id, episode_id, payment_status = purchase
+    user_id, episode_id, episode_title, price = purchase
+    episode_title = episode_title or "غير معروف"
     
-    if payment_status != 'pending':
-        await callback.answer("❌ تم معالجة هذا الطلب مسبقاً", show_alert=True)
-        return
-    
-    # Reject purchase
-    await db.reject_purchase(purchase_id)
-    
-    # Get episode info
-    episode = await db.get_episode(episode_id)
-    episode_title = episode[2] if episode else "غير معروف"
-    
-    # Notify user
-    try:
-        await callback.bot.send_message(
-            chat_id=user_id,
-            text=f"❌ تم رفض طلب الشراء\n\n"
-                 f"🎬 الحلقة: {episode_title}\n\n"
-                 f"يرجى التواصل مع الإدارة للمزيد من المعلومات."
-        )
-    except Exception as e:
-        print(f"Error notifying user: {e}")
+    # Notify user (sent in the background)
+    outbox.send(callback.bot, SendMessage(
+        chat_id=user_id,
+        text=f"❌ تم رفض طلب الشراء\n\n"
+             f"🎬 الحلقة: {episode_title}\n\n"
+             f"يرجى التواصل مع الإدارة للمزيد من المعلومات."
+    ))
     
     await callback.message.edit_caption(
         caption=f"❌ تم رفض الطلب\n\n"
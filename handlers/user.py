@@ -1,10 +1,14 @@
 from aiogram import Router, F
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.methods import SendMessage, SendPhoto, SendVideo
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from database import db
+from functools import partial
 from keyboards import user_kb
+from keyboards.pagination import fetch_page
+from outbox import outbox
 import config
 
 router = Router()
@@ -24,7 +28,7 @@ async def cmd_start(message: Message):
         first_name=message.from_user.first_name
     )
     
-    # Check if user is admin
+    # Check if user is admin (add_user may have just changed the role)
     is_admin = await db.is_admin(message.from_user.id)
     
     welcome_text = f"مرحباً {message.from_user.first_name}! 👋\n\n"
@@ -41,10 +45,8 @@ async def cmd_start(message: Message):
 
 
 @router.callback_query(F.data == "back_to_main")
-async def back_to_main(callback: CallbackQuery):
+async def back_to_main(callback: CallbackQuery, is_admin: bool):
     """Return to main menu"""
-    is_admin = await db.is_admin(callback.from_user.id)
-    
     welcome_text = f"مرحباً {callback.from_user.first_name}! 👋\n\n"
     
     if is_admin:
@@ -57,11 +59,13 @@ async def back_to_main(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "browse_courses")
+@router.callback_query(F.data.startswith("courses_page_"))
 async def browse_courses(callback: CallbackQuery):
-    """Show all available courses"""
-    courses = await db.get_all_courses()
+    """Show a page of available courses"""
+    token = callback.data[len("courses_page_"):] if callback.data.startswith("courses_page_") else None
+    page = await fetch_page(db.get_courses_page, user_kb.course_key, token)
     
-    if not courses:
+    if not page.rows:
         await callback.message.edit_text(
             "📚 لا توجد كورسات متاحة حالياً.\n\nتابعنا للحصول على التحديثات!",
             reply_markup=user_kb.back_to_main_keyboard()
@@ -69,7 +73,7 @@ async def browse_courses(callback: CallbackQuery):
     else:
         await callback.message.edit_text(
             "📚 الكورسات المتاحة:\n\nاختر كورس لعرض الحلقات:",
-            reply_markup=user_kb.courses_keyboard(courses)
+            reply_markup=user_kb.courses_keyboard(page)
         )
     
     await callback.answer()
@@ -77,8 +81,10 @@ async def browse_courses(callback: CallbackQuery):
 
 @router.callback_query(F.data.startswith("course_"))
 async def show_course_episodes(callback: CallbackQuery):
-    """Show episodes for a specific course"""
-    course_id = int(callback.data.split("_")[1])
+    """Show a page of episodes for a specific course"""
+    parts = callback.data.split("_")
+    course_id = int(parts[1])
+    token = parts[2] if len(parts) > 2 else None
     
     # Get course info
     course = await db.get_course(course_id)
@@ -89,9 +95,9 @@ async def show_course_episodes(callback: CallbackQuery):
     course_id, title, description, price = course
     
     # Get episodes
-    episodes = await db.get_course_episodes(course_id)
+    page = await fetch_page(partial(db.get_course_episodes_page, course_id), user_kb.episode_key, token)
     
-    if not episodes:
+    if not page.rows:
         await callback.message.edit_text(
             f"📖 {title}\n\n{description or 'لا يوجد وصف'}\n\n❌ لا توجد حلقات متاحة حالياً.",
             reply_markup=user_kb.back_to_main_keyboard()
@@ -100,8 +106,7 @@ async def show_course_episodes(callback: CallbackQuery):
         return
     
     # Get user's purchased episodes
-    user_purchases = await db.get_user_purchases(callback.from_user.id)
-    purchased_episode_ids = [p[0] for p in user_purchases]
+    purchased_episode_ids = await db.get_entitlements(callback.from_user.id)
     
     course_text = f"📖 {title}\n\n"
     if description:
@@ -110,7 +115,7 @@ async def show_course_episodes(callback: CallbackQuery):
     
     await callback.message.edit_text(
         course_text,
-        reply_markup=user_kb.episodes_keyboard(episodes, course_id, callback.from_user.id, purchased_episode_ids)
+        reply_markup=user_kb.episodes_keyboard(page, course_id, callback.from_user.id, purchased_episode_ids)
     )
     await callback.answer()
 
@@ -210,35 +215,35 @@ async def receive_receipt(message: Message, state: FSMContext):
         reply_markup=user_kb.back_to_main_keyboard()
     )
     
-    # Notify admin
-    try:
-        admin_text = f"🔔 طلب شراء جديد!\n\n"
-        admin_text += f"👤 المستخدم: {message.from_user.first_name}"
-        if message.from_user.username:
-            admin_text += f" (@{message.from_user.username})"
-        admin_text += f"\n🎬 الحلقة: {episode_title}\n"
-        admin_text += f"💰 السعر: ${episode[5]:.2f}\n\n"
-        admin_text += "استخدم /admin للمراجعة"
-        
-        from aiogram import Bot
-        bot = message.bot
-        await bot.send_photo(
-            chat_id=config.ADMIN_ID,
-            photo=photo_id,
-            caption=admin_text
-        )
-    except Exception as e:
-        print(f"Error notifying admin: {e}")
+    # Notify admin (sent in the background)
+    admin_text = f"🔔 طلب شراء جديد!\n\n"
+    admin_text += f"👤 المستخدم: {message.from_user.first_name}"
+    if message.from_user.username:
+        admin_text += f" (@{message.from_user.username})"
+    admin_text += f"\n🎬 الحلقة: {episode_title}\n"
+    if episode:
+        admin_text += f"💰 السعر: ${episode[5]:.2f}\n"
+    admin_text += "\nاستخدم /admin للمراجعة"
+    
+    outbox.send(message.bot, SendPhoto(
+        chat_id=config.ADMIN_ID,
+        photo=photo_id,
+        caption=admin_text
+    ))
     
     await state.clear()
 
 
 @router.callback_query(F.data == "my_purchases")
+@router.callback_query(F.data.startswith("my_purchases_"))
 async def show_my_purchases(callback: CallbackQuery):
-    """Show user's purchased episodes"""
-    purchases = await db.get_user_purchases(callback.from_user.id)
+    """Show a page of the user's purchased episodes"""
+    token = callback.data[len("my_purchases_"):] if callback.data.startswith("my_purchases_") else None
+    page = await fetch_page(
+        partial(db.get_user_purchases_page, callback.from_user.id), user_kb.purchase_key, token
+    )
     
-    if not purchases:
+    if not page.rows:
         text = "🎬 مشترياتي\n\n"
         text += "ليس لديك أي مشتريات حتى الآن.\n\n"
         text += "تصفح الكورسات المتاحة وابدأ التعلم!"
@@ -248,7 +253,7 @@ async def show_my_purchases(callback: CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=user_kb.my_purchases_keyboard(purchases)
+        reply_markup=user_kb.my_purchases_keyboard(page)
     )
     await callback.answer()
 
@@ -274,41 +279,46 @@ async def watch_episode(callback: CallbackQuery):
     episode_id, course_id, title, description, video_path, price, episode_number = episode
     
     # Send video directly with protection
-    try:
-        await callback.message.answer("⏳ جاري إرسال الفيديو...")
-        
-        # Create watermark caption with username
-        username = callback.from_user.username or callback.from_user.first_name
-        user_id = callback.from_user.id
-        
-        caption = f"🎬 {title}\n\n"
-        if description:
-            caption += f"{description}\n\n"
-        caption += "━━━━━━━━━━━━━━━\n"
-        caption += f"👤 مشتراة بواسطة: @{username}\n" if callback.from_user.username else f"👤 مشتراة بواسطة: {username}\n"
-        caption += f"🆔 ID: {user_id}\n"
-        caption += "━━━━━━━━━━━━━━━\n\n"
-        caption += "⚠️ هذا الفيديو للاستخدام الشخصي فقط\n"
-        caption += "🚫 ممنوع المشاركة أو إعادة التوزيع\n"
-        caption += "⚖️ انتهاك الشروط يؤدي للحظر الدائم"
-        
-        # Send video using file_id with protection
-        await callback.bot.send_video(
-            chat_id=callback.from_user.id,
-            video=video_path,  # This is the file_id from Telegram
-            caption=caption,
-            protect_content=True,  # Prevents forwarding, saving, and screenshots
-            reply_markup=user_kb.back_to_main_keyboard()
-        )
-        
-        await callback.answer("✅ تم إرسال الفيديو!")
-        
-    except Exception as e:
-        print(f"Error sending video: {e}")
-        await callback.answer("❌ حدث خطأ في إرسال الفيديو", show_alert=True)
+    await callback.message.answer("⏳ جاري إرسال الفيديو...")
+    
+    # Create watermark caption with username
+    username = callback.from_user.username or callback.from_user.first_name
+    user_id = callback.from_user.id
+    
+    caption = f"🎬 {title}\n\n"
+    if description:
+        caption += f"{description}\n\n"
+    caption += "━━━━━━━━━━━━━━━\n"
+    caption += f"👤 مشتراة بواسطة: @{username}\n" if callback.from_user.username else f"👤 مشتراة بواسطة: {username}\n"
+    caption += f"🆔 ID: {user_id}\n"
+    caption += "━━━━━━━━━━━━━━━\n\n"
+    caption += "⚠️ هذا الفيديو للاستخدام الشخصي فقط\n"
+    caption += "🚫 ممنوع المشاركة أو إعادة التوزيع\n"
+    caption += "⚖️ انتهاك الشروط يؤدي للحظر الدائم"
+    
+    # Send video using file_id with protection; queued ahead of notifications
+    outbox.send(callback.bot, SendVideo(
+        chat_id=user_id,
+        video=video_path,  # This is the file_id from Telegram
+        caption=caption,
+        protect_content=True,  # Prevents forwarding, saving, and screenshots
+        reply_markup=user_kb.back_to_main_keyboard()
+    ), priority=outbox.HIGH, fallback=SendMessage(
+        chat_id=user_id,
+        text="❌ حدث خطأ في إرسال الفيديو",
+        reply_markup=user_kb.back_to_main_keyboard()
+    ))
+    
+    await callback.answer("✅ جاري إرسال الفيديو!")
 
 
 @router.callback_query(F.data == "noop")
 async def noop_callback(callback: CallbackQuery):
     """No operation callback for headers"""
     await callback.answer()
+
+
+@router.my_chat_member(F.chat.type == "private")
+async def chat_member_changed(event: ChatMemberUpdated):
+    """Track whether the user has blocked the bot, so broadcasts skip them"""
+    await db.set_user_blocked(event.from_user.id, event.new_chat_member.status == "kicked")
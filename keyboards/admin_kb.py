@@ -1,4 +1,5 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from keyboards.pagination import nav_row
 
 
 def admin_main_menu_keyboard():
@@ -8,39 +9,66 @@ def admin_main_menu_keyboard():
         [InlineKeyboardButton(text="💰 طلبات الشراء المعلقة", callback_data="admin_pending_purchases")],
         [InlineKeyboardButton(text="👥 المستخدمين", callback_data="admin_users")],
         [InlineKeyboardButton(text="📊 الإحصائيات", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="📈 التحليلات", callback_data="admin_analytics")],
+        [InlineKeyboardButton(text="📣 رسالة جماعية", callback_data="admin_broadcast")],
         [InlineKeyboardButton(text="🔙 القائمة الرئيسية", callback_data="back_to_main")],
     ])
     return keyboard
 
 
-def admin_courses_keyboard(courses):
-    """Admin courses management"""
+def analytics_keyboard(courses):
+    """Analytics screen: a button per ranked course, refresh and back"""
+    buttons = [
+        [InlineKeyboardButton(text=f"📖 {title}", callback_data=f"analytics_course_{course_id}")]
+        for course_id, title in courses
+    ]
+    buttons.append([InlineKeyboardButton(text="🔄 تحديث البيانات", callback_data="analytics_refresh")])
+    buttons.append([InlineKeyboardButton(text="🔙 لوحة التحكم", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def analytics_course_keyboard():
+    """Back to the analytics screen"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 التحليلات", callback_data="admin_analytics")]
+    ])
+
+
+def pending_purchase_key(purchase):
+    """Page key of a pending purchase row"""
+    return (purchase[0],)
+
+
+def admin_courses_keyboard(page):
+    """Admin courses management, one page of courses"""
     buttons = []
     
-    for course in courses:
+    for course in page.rows:
         course_id, title, description, price = course
         buttons.append([
             InlineKeyboardButton(text=f"📖 {title}", callback_data=f"admin_course_{course_id}"),
             InlineKeyboardButton(text="🗑️", callback_data=f"admin_delete_course_{course_id}")
         ])
     
+    buttons += nav_row(page, "admin_courses_")
     buttons.append([InlineKeyboardButton(text="➕ إضافة كورس جديد", callback_data="admin_add_course")])
     buttons.append([InlineKeyboardButton(text="🔙 لوحة التحكم", callback_data="admin_panel")])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def admin_course_detail_keyboard(course_id, episodes):
-    """Admin course detail with episodes"""
+def admin_course_detail_keyboard(course_id, page):
+    """Admin course detail with one page of episodes"""
     buttons = []
     
-    for episode in episodes:
+    for episode in page.rows:
         episode_id, title, description, price, episode_number = episode
         buttons.append([
             InlineKeyboardButton(text=f"الحلقة {episode_number}: {title}", callback_data=f"admin_episode_{episode_id}"),
             InlineKeyboardButton(text="🗑️", callback_data=f"admin_delete_episode_{episode_id}")
         ])
     
+    buttons += nav_row(page, f"admin_course_{course_id}_")
     buttons.append([InlineKeyboardButton(text="➕ إضافة حلقة جديدة", callback_data=f"admin_add_episode_{course_id}")])
     buttons.append([InlineKeyboardButton(text="🔙 رجوع للكورسات", callback_data="admin_courses")])
     
@@ -59,18 +87,33 @@ def payment_verification_keyboard(purchase_id):
     return keyboard
 
 
-def pending_purchases_keyboard(purchases):
-    """Display pending purchases for admin"""
+def pending_purchases_keyboard(page, selected=()):
+    """Display one page of pending purchases for admin, with multi-select for bulk review"""
     buttons = []
     
-    if not purchases:
+    if not page.rows:
         buttons.append([InlineKeyboardButton(text="✅ لا توجد طلبات معلقة", callback_data="noop")])
     else:
-        for purchase in purchases:
+        for purchase in page.rows:
             purchase_id, user_id, episode_id, receipt_photo, username, episode_title, price = purchase
             user_display = username if username else f"User {user_id}"
             button_text = f"👤 {user_display} - {episode_title} (${price:.2f})"
-            buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"review_payment_{purchase_id}")])
+            mark = "☑️" if purchase_id in selected else "⬜"
+            buttons.append([
+                InlineKeyboardButton(text=mark, callback_data=f"select_payment_{purchase_id}_{page.token}"),
+                InlineKeyboardButton(text=button_text, callback_data=f"review_payment_{purchase_id}")
+            ])
+        
+        buttons += nav_row(page, "admin_pending_purchases_")
+        buttons.append([
+            InlineKeyboardButton(text="☑️ تحديد الصفحة", callback_data=f"select_page_{page.token}"),
+            InlineKeyboardButton(text="🧹 إلغاء التحديد", callback_data=f"clear_selection_{page.token}")
+        ])
+        if selected:
+            buttons.append([
+                InlineKeyboardButton(text=f"✅ قبول المحدد ({len(selected)})", callback_data="bulk_approve"),
+                InlineKeyboardButton(text=f"❌ رفض المحدد ({len(selected)})", callback_data="bulk_reject")
+            ])
     
     buttons.append([InlineKeyboardButton(text="🔙 لوحة التحكم", callback_data="admin_panel")])
     
@@ -88,6 +131,70 @@ def confirm_delete_keyboard(item_type, item_id):
     return keyboard
 
 
+def broadcast_keyboard(broadcast_id=None, status=None):
+    """Controls for the latest broadcast"""
+    buttons = []
+    
+    if status == 'running':
+        buttons.append([InlineKeyboardButton(text="🔄 تحديث", callback_data="admin_broadcast")])
+        buttons.append([
+            InlineKeyboardButton(text="⏸ إيقاف مؤقت", callback_data=f"broadcast_pause_{broadcast_id}"),
+            InlineKeyboardButton(text="⛔ إلغاء", callback_data=f"broadcast_cancel_{broadcast_id}")
+        ])
+    elif status == 'paused':
+        buttons.append([
+            InlineKeyboardButton(text="▶️ استئناف", callback_data=f"broadcast_resume_{broadcast_id}"),
+            InlineKeyboardButton(text="⛔ إلغاء", callback_data=f"broadcast_cancel_{broadcast_id}")
+        ])
+    else:
+        buttons.append([InlineKeyboardButton(text="✉️ رسالة جديدة", callback_data="broadcast_new")])
+    
+    buttons.append([InlineKeyboardButton(text="🔙 لوحة التحكم", callback_data="admin_panel")])
+    
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def confirm_broadcast_keyboard():
+    """Confirm sending a broadcast"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ إرسال", callback_data="broadcast_send"),
+            InlineKeyboardButton(text="❌ إلغاء", callback_data="admin_broadcast")
+        ]
+    ])
+    return keyboard
+
+
+def user_key(user):
+    """Page key of a user row"""
+    return (user[0],)
+
+
+def admin_users_keyboard(page):
+    """One page of the users list, with the data export menu"""
+    buttons = nav_row(page, "admin_users_")
+    buttons.append([InlineKeyboardButton(text="📤 تصدير البيانات", callback_data="admin_export")])
+    buttons.append([InlineKeyboardButton(text="🔙 لوحة التحكم", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def export_keyboard():
+    """Pick a dataset and a format to export"""
+    buttons = []
+    for name, label in (
+        ('users', "👥 المستخدمون"),
+        ('purchases', "💳 المشتريات"),
+        ('sales', "📈 المبيعات اليومية"),
+        ('signups', "🆕 التسجيلات اليومية"),
+    ):
+        buttons.append([
+            InlineKeyboardButton(text=f"{label} CSV", callback_data=f"export_{name}_csv"),
+            InlineKeyboardButton(text=f"{label} JSONL", callback_data=f"export_{name}_jsonl")
+        ])
+    buttons.append([InlineKeyboardButton(text="🔙 لوحة التحكم", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
 def back_to_admin_keyboard():
     """Back to admin panel"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -0,0 +1,63 @@
+from aiogram.types import InlineKeyboardButton
+import config
+
+
+class Page:
+    """One page of keyset-paginated rows and the tokens of its neighbours"""
+
+    def __init__(self, rows, prev_token=None, next_token=None, token=None):
+        self.rows = rows
+        self.token = token or ''  # The token this page was loaded with
+        self.prev_token = prev_token
+        self.next_token = next_token
+
+
+def make_token(forward, key):
+    """Page token for callback_data: '>' (after) or '<' (before) and the key"""
+    return ('>' if forward else '<') + '.'.join(str(part) for part in key)
+
+
+def parse_token(token):
+    """(forward, key) from a page token; no token means the first page"""
+    if not token:
+        return True, None
+    return token[0] == '>', tuple(int(part) for part in token[1:].split('.'))
+
+
+async def fetch_page(fetch, key, token=None, limit=None):
+    """Load the page `token` points to
+
+    fetch(after_or_before_key, forward, count) returns up to `count` rows
+    following the key in the direction asked (in that direction's order);
+    key(row) gives a row's key. One extra row is asked for to tell whether
+    another page exists that way.
+    """
+    limit = limit or config.KEYBOARD_PAGE_SIZE
+    forward, cursor = parse_token(token)
+    rows = list(await fetch(cursor, forward, limit + 1))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+    if not rows:
+        return Page(rows, token=token)
+
+    # Coming from a neighbouring page means that page still exists
+    has_prev = more if not forward else cursor is not None
+    has_next = more if forward else True
+    return Page(
+        rows,
+        make_token(False, key(rows[0])) if has_prev else None,
+        make_token(True, key(rows[-1])) if has_next else None,
+        token,
+    )
+
+
+def nav_row(page, prefix):
+    """Previous/next buttons for a page, or [] if it is the only one"""
+    row = []
+    if page.prev_token:
+        row.append(InlineKeyboardButton(text="◀️ السابق", callback_data=f"{prefix}{page.prev_token}"))
+    if page.next_token:
+        row.append(InlineKeyboardButton(text="التالي ▶️", callback_data=f"{prefix}{page.next_token}"))
+    return [row] if row else []
@@ -1,4 +1,5 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from keyboards.pagination import nav_row
 import config
 
 
@@ -11,23 +12,39 @@ def main_menu_keyboard():
     return keyboard
 
 
-def courses_keyboard(courses):
-    """Display all available courses"""
+def course_key(course):
+    """Page key of a course row"""
+    return (course[0],)
+
+
+def episode_key(episode):
+    """Page key of an episode row: (episode_number, episode_id)"""
+    return (episode[4], episode[0])
+
+
+def purchase_key(purchase):
+    """Page key of a purchased episode row: (course_id, episode_number, episode_id)"""
+    return (purchase[4], purchase[3], purchase[0])
+
+
+def courses_keyboard(page):
+    """Display one page of available courses"""
     buttons = []
-    for course in courses:
+    for course in page.rows:
         course_id, title, description, price = course
         buttons.append([InlineKeyboardButton(text=f"📖 {title}", callback_data=f"course_{course_id}")])
     
+    buttons += nav_row(page, "courses_page_")
     buttons.append([InlineKeyboardButton(text="🔙 رجوع", callback_data="back_to_main")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def episodes_keyboard(episodes, course_id, user_id=None, purchased_episodes=None):
-    """Display all episodes for a course"""
+def episodes_keyboard(page, course_id, user_id=None, purchased_episodes=None):
+    """Display one page of episodes for a course"""
     buttons = []
     purchased_episodes = purchased_episodes or []
     
-    for episode in episodes:
+    for episode in page.rows:
         episode_id, title, description, price, episode_number = episode
         
         # Check if user has purchased this episode
@@ -43,6 +60,7 @@ def episodes_keyboard(episodes, course_id, user_id=None, purchased_episodes=None
         button_text = f"{emoji} الحلقة {episode_number}: {title} - ${price:.2f}"
         buttons.append([InlineKeyboardButton(text=button_text, callback_data=callback)])
     
+    buttons += nav_row(page, f"course_{course_id}_")
     buttons.append([InlineKeyboardButton(text="🔙 رجوع للكورسات", callback_data="browse_courses")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
@@ -67,16 +85,16 @@ def video_access_keyboard(episode_id, user_id, token):
     return keyboard
 
 
-def my_purchases_keyboard(purchases):
-    """Display user's purchased episodes"""
+def my_purchases_keyboard(page):
+    """Display one page of the user's purchased episodes"""
     buttons = []
     
-    if not purchases:
+    if not page.rows:
         buttons.append([InlineKeyboardButton(text="📚 تصفح الكورسات", callback_data="browse_courses")])
     else:
         current_course = None
-        for purchase in purchases:
-            episode_id, episode_title, course_title, episode_number = purchase
+        for purchase in page.rows:
+            episode_id, episode_title, course_title, episode_number, course_id = purchase
             
             # Add course header if it's a new course
             if course_title != current_course:
@@ -85,6 +103,8 @@ def my_purchases_keyboard(purchases):
             
             button_text = f"▶️ الحلقة {episode_number}: {episode_title}"
             buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"watch_{episode_id}")])
+        
+        buttons += nav_row(page, "my_purchases_")
     
     buttons.append([InlineKeyboardButton(text="🔙 القائمة الرئيسية", callback_data="back_to_main")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
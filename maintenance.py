@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+
+import config
+from analytics import analytics
+from database import db as default_db
+
+logger = logging.getLogger(__name__)
+
+
+class MaintenanceScheduler:
+    """Periodic database housekeeping, done in small time-boxed batches
+
+    Every job takes the writer for one short transaction per batch and yields
+    between batches, so bot writes never wait behind a long sweep. A job that
+    runs out of its time budget simply continues on the next run.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or default_db
+        self._task = None
+        self._purchase_cursor = 0  # Orphan sweep resumes from this purchase_id
+        self._vacuum_warned = False
+
+    def start(self):
+        """Start the background loop"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run_forever())
+
+    async def stop(self):
+        """Stop the background loop, waiting for the current batch to finish"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run_forever(self):
+        await asyncio.sleep(config.MAINTENANCE_START_DELAY)
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Maintenance run failed")
+            await asyncio.sleep(config.MAINTENANCE_INTERVAL)
+
+    async def run_once(self) -> dict:
+        """Run every job once and log what each one did"""
+        metrics = {}
+        for name, job in (
+            ('expired_tokens', self.prune_expired_tokens),
+            ('expired_fsm_states', self.prune_fsm_states),
+            ('rollups', analytics.rollup),
+            ('orphans', self.sweep_orphans),
+            ('optimize', self.optimize),
+            ('vacuum', self.incremental_vacuum),
+        ):
+            started = time.monotonic()
+            result = await job()
+            metrics[name] = {**result, 'seconds': round(time.monotonic() - started, 3)}
+        logger.info("Maintenance run: %s", metrics)
+        return metrics
+
+    async def _delete_in_batches(self, sql: str, params: tuple = ()) -> dict:
+        """Repeat a `... LIMIT ?` delete until it runs dry or the time budget is spent"""
+        deadline = time.monotonic() + config.MAINTENANCE_TIME_BUDGET
+        deleted = batches = 0
+        while True:
+            async with self.db.writer() as db:
+                async with db.execute(sql, params + (config.MAINTENANCE_BATCH_SIZE,)) as cursor:
+                    count = cursor.rowcount
+            deleted += count
+            batches += 1
+            if count < config.MAINTENANCE_BATCH_SIZE or time.monotonic() > deadline:
+                return {'deleted': deleted, 'batches': batches}
+            await asyncio.sleep(0)
+
+    async def prune_expired_tokens(self) -> dict:
+        """Delete expired rows from video_tokens"""
+        return await self._delete_in_batches('''
+            DELETE FROM video_tokens WHERE rowid IN (
+                SELECT rowid FROM video_tokens WHERE expires_at < ? LIMIT ?
+            )
+        ''', (int(time.time()),))
+
+    async def prune_fsm_states(self) -> dict:
+        """Delete abandoned conversations from fsm_states"""
+        return await self._delete_in_batches('''
+            DELETE FROM fsm_states WHERE rowid IN (
+                SELECT rowid FROM fsm_states WHERE expires_at < ? LIMIT ?
+            )
+        ''', (int(time.time()),))
+
+    async def sweep_orphans(self) -> dict:
+        """Delete rows left behind by deleted episodes, and old rejected purchases
+
+        Purchases are walked in purchase_id windows so each transaction only
+        looks at MAINTENANCE_BATCH_SIZE rows however large the table is.
+        """
+        deadline = time.monotonic() + config.MAINTENANCE_TIME_BUDGET
+        purchases = 0
+        while time.monotonic() <= deadline:
+            async with self.db.writer() as db:
+                async with db.execute('''
+                    SELECT MAX(purchase_id) FROM (
+                        SELECT purchase_id FROM purchases
+                        WHERE purchase_id > ?
+                        ORDER BY purchase_id
+                        LIMIT ?
+                    )
+                ''', (self._purchase_cursor, config.MAINTENANCE_BATCH_SIZE)) as cursor:
+                    upper = (await cursor.fetchone())[0]
+                if upper is None:
+                    self._purchase_cursor = 0  # Full pass done; start over next run
+                    break
+                async with db.execute('''
+                    DELETE FROM purchases
+                    WHERE purchase_id > ? AND purchase_id <= ?
+                      -- Rows the analytics rollup has not counted yet stay until it has
+                      AND purchase_id <= (SELECT value FROM rollup_state WHERE name = 'purchases')
+                      AND (
+                        episode_id NOT IN (SELECT episode_id FROM episodes)
+                        OR (payment_status = 'rejected' AND purchased_at < datetime('now', ?))
+                      )
+                ''', (self._purchase_cursor, upper, f'-{config.MAINTENANCE_REJECTED_RETENTION_DAYS} days')) as cursor:
+                    purchases += cursor.rowcount
+            self._purchase_cursor = upper
+            await asyncio.sleep(0)
+
+        tokens = await self._delete_in_batches('''
+            DELETE FROM video_tokens WHERE rowid IN (
+                SELECT vt.rowid FROM video_tokens vt
+                LEFT JOIN episodes e ON vt.episode_id = e.episode_id
+                WHERE e.episode_id IS NULL
+                LIMIT ?
+            )
+        ''')
+        return {'purchases': purchases, 'tokens': tokens['deleted']}
+
+    async def optimize(self) -> dict:
+        """Refresh planner statistics where SQLite thinks they are stale"""
+        async with self.db.writer() as db:
+            async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'") as cursor:
+                analyzed = await cursor.fetchone() is not None
+            # Sample each index instead of reading it whole, so the run stays
+            # short however large purchases and video_tokens grow
+            await db.execute(f'PRAGMA analysis_limit = {int(config.MAINTENANCE_ANALYSIS_LIMIT)}')
+            # The first run has no statistics at all, so build them once
+            await db.execute('PRAGMA optimize' if analyzed else 'ANALYZE')
+        return {'analyze': not analyzed}
+
+    async def vacuum_mode(self) -> int:
+        """PRAGMA auto_vacuum of the database file: 0 none, 1 full, 2 incremental"""
+        # Readers keep the value from when they last read the file header
+        async with self.db.writer() as db:
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def incremental_vacuum(self) -> dict:
+        """Return free pages to the filesystem, a few at a time"""
+        mode = await self.vacuum_mode()
+        async with self.db.writer() as db:
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                free_before = (await cursor.fetchone())[0]
+        if mode != 2:
+            # Files created before auto_vacuum was enabled need one full VACUUM
+            # to switch over; it rewrites the whole file, so only once enough
+            # pages are free to be worth it
+            threshold = config.MAINTENANCE_VACUUM_CONVERT_PAGES
+            if threshold > 0 and free_before >= threshold:
+                return await self.enable_auto_vacuum()
+            if not self._vacuum_warned:
+                self._vacuum_warned = True
+                logger.warning(
+                    "auto_vacuum is off for %s (%d free pages); incremental vacuum is skipped "
+                    "until /vacuum converts the file", self.db.db_path, free_before,
+                )
+            return {'free_pages': free_before, 'skipped': 'auto_vacuum is off'}
+        async with self.db.writer() as db:
+            async with db.execute(f'PRAGMA incremental_vacuum({config.MAINTENANCE_VACUUM_PAGES})') as cursor:
+                await cursor.fetchall()
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                free_after = (await cursor.fetchone())[0]
+        return {'freed_pages': free_before - free_after, 'free_pages': free_after}
+
+    async def enable_auto_vacuum(self) -> dict:
+        """Switch an existing file to incremental auto_vacuum with one full VACUUM
+
+        VACUUM cannot run inside a transaction and blocks other writers until
+        it has rewritten the file, so this is a one-off, not a periodic job.
+        """
+        async with self.db.writer() as db:
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                free_before = (await cursor.fetchone())[0]
+            started = time.monotonic()
+            # The new mode is only recorded in the file by the VACUUM itself
+            await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            await db.execute('VACUUM')
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                mode = (await cursor.fetchone())[0]
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                free_after = (await cursor.fetchone())[0]
+        logger.info("VACUUM of %s took %.1fs: auto_vacuum=%d, %d free pages released",
+                    self.db.db_path, time.monotonic() - started, mode, free_before - free_after)
+        return {'converted': mode == 2, 'freed_pages': free_before - free_after, 'free_pages': free_after}
+
+
+# Global scheduler instance
+scheduler = MaintenanceScheduler()
@@ -0,0 +1,38 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Message, CallbackQuery
+from database import db
+
+
+class RoleMiddleware(BaseMiddleware):
+    """Resolve the caller's role once per update and pass it to handlers"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        is_admin = user is not None and await db.is_admin(user.id)
+        data['is_admin'] = is_admin
+        data['role'] = 'admin' if is_admin else 'user'
+        return await handler(event, data)
+
+
+class AdminGuardMiddleware(BaseMiddleware):
+    """Reject non-admins before any handler of an admin router runs"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if data.get('is_admin'):
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery):
+            await event.answer("❌ غير مصرح لك", show_alert=True)
+        elif isinstance(event, Message):
+            await event.answer("❌ هذا الأمر متاح للمسؤولين فقط.")
@@ -0,0 +1,223 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.methods import TelegramMethod
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """`rate` tokens per second, up to `burst` saved up
+
+    reserve() always takes a token, going into debt when none is left, and
+    returns how long the caller must wait for it. Callers that reserve in
+    turn are therefore served in turn.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token; seconds until it is actually available"""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def hold(self, seconds: float):
+        """Hand out no token for the next `seconds`"""
+        self._refill()
+        # The next reserve() takes this token and waits exactly `seconds`
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ('bot', 'method', 'chat_id', 'priority', 'future', 'fallback', 'attempts', 'chat_ready')
+
+    def __init__(self, bot, method, chat_id, priority, future, fallback):
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = future
+        self.fallback = fallback
+        self.attempts = 0
+        self.chat_ready = False  # Already holds its chat's token
+
+
+class Outbox:
+    """Paced queue for outgoing Bot API calls
+
+    Handlers call send() and move on; the call is made in the background.
+    Lower priorities go first. Each call waits for a token from its chat's
+    bucket (OUTBOX_CHAT_RATE) and then from the global bucket
+    (OUTBOX_GLOBAL_RATE, split between BOT_WORKERS), and at most
+    OUTBOX_CONCURRENCY calls are in flight. A flood-wait reply
+    (TelegramRetryAfter) pauses sending for the time Telegram asks and the
+    call is retried, as are network and server errors, up to
+    OUTBOX_MAX_RETRIES times.
+    """
+
+    HIGH = 0  # Replies the user is waiting for
+    NORMAL = 1  # Notifications
+    LOW = 2  # Broadcasts
+
+    def __init__(self):
+        self._queue = None
+        self._order = itertools.count()
+        self._chats = {}  # chat_id -> TokenBucket
+        self._global = None
+        self._paused_until = 0.0
+        self._slots = None
+        self._sending = set()  # Calls in flight
+        self._unsent = 0  # Queued, waiting or in flight
+        self._task = None
+
+    def send(self, bot: Bot, method: TelegramMethod, priority: int = NORMAL,
+             fallback: TelegramMethod = None) -> asyncio.Future:
+        """Queue `method`; the future resolves with its result
+
+        If the call finally fails, `fallback` (e.g. an error message to the
+        same user) is queued in its place.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(bot, method, getattr(method, 'chat_id', None), priority, future, fallback)
+        if self._queue.qsize() >= config.OUTBOX_QUEUE_SIZE:
+            logger.warning(f"Outbox full, dropping {type(method).__name__} to {job.chat_id}")
+            future.set_exception(asyncio.QueueFull())
+            future.exception()  # Nobody may be waiting for it
+        else:
+            self._unsent += 1
+            self._queue.put_nowait((priority, next(self._order), job))
+        return future
+
+    def start(self):
+        """Start the sending loop (send() does this on first use)"""
+        if self._task is not None:
+            return
+        # Bounded in send(), so retries can always go back in
+        self._queue = asyncio.PriorityQueue()
+        self._slots = asyncio.Semaphore(config.OUTBOX_CONCURRENCY)
+        self._global = TokenBucket(config.OUTBOX_GLOBAL_RATE / max(1, config.BOT_WORKERS), 1)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Send what is queued (up to OUTBOX_DRAIN_TIMEOUT), then stop"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + config.OUTBOX_DRAIN_TIMEOUT
+        while self._unsent and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._unsent:
+            logger.warning(f"Dropping {self._unsent} unsent messages")
+        self._task.cancel()
+        for task in list(self._sending):
+            task.cancel()
+        await asyncio.gather(self._task, *self._sending, return_exceptions=True)
+        self._task = None
+        self._unsent = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= config.OUTBOX_CHAT_BUCKETS:
+                # Idle buckets are full, so forgetting them changes nothing
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle}
+            bucket = self._chats[chat_id] = TokenBucket(config.OUTBOX_CHAT_RATE, config.OUTBOX_CHAT_BURST)
+        return bucket
+
+    def _requeue(self, job: _Job, order: int):
+        self._queue.put_nowait((job.priority, order, job))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, order, job = await self._queue.get()
+            if not job.chat_ready and job.chat_id is not None:
+                job.chat_ready = True
+                delay = self._chat_bucket(job.chat_id).reserve()
+                if delay > 0:
+                    # Step aside for other chats; keeps its place among equals
+                    loop.call_later(delay, self._requeue, job, order)
+                    continue
+
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            delay = self._global.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            await self._slots.acquire()
+            task = asyncio.ensure_future(self._call(job, order))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _call(self, job: _Job, order: int):
+        try:
+            result = await job.bot(job.method)
+        except TelegramRetryAfter as e:
+            self._retry(job, order, e.retry_after, e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry(job, order, 2 ** job.attempts, e)
+        except TelegramAPIError as e:
+            self._fail(job, e)
+        except Exception as e:
+            logger.exception(f"{type(job.method).__name__} to {job.chat_id} failed")
+            self._fail(job, e)
+        else:
+            self._unsent -= 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._slots.release()
+
+    def _retry(self, job: _Job, order: int, delay: float, error: Exception):
+        job.attempts += 1
+        if job.attempts > config.OUTBOX_MAX_RETRIES:
+            self._fail(job, error)
+            return
+        logger.info(f"{type(job.method).__name__} to {job.chat_id} retrying in {delay}s: {error}")
+        if isinstance(error, TelegramRetryAfter):
+            # Flood control: hold the chat and everything else for as long as Telegram says
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            if job.chat_id is not None:
+                self._chat_bucket(job.chat_id).hold(delay)
+            job.chat_ready = False
+            self._requeue(job, order)
+        else:
+            asyncio.get_running_loop().call_later(delay, self._requeue, job, order)
+
+    def _fail(self, job: _Job, error: Exception):
+        logger.warning(f"{type(job.method).__name__} to {job.chat_id} failed: {error}")
+        self._unsent -= 1
+        if not job.future.done():
+            job.future.set_exception(error)
+            job.future.exception()  # Failures are logged here; awaiting is optional
+        if job.fallback is not None:
+            self.send(job.bot, job.fallback, job.priority)
+
+
+# Global outbox (one per bot process)
+outbox = Outbox()
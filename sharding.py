@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+
+import aiohttp
+
+import config
+from webhook import UpdateLanes, feed_raw_update, update_user_id
+
+logger = logging.getLogger(__name__)
+
+# Spawned rather than forked: the front process already runs an event loop,
+# threads and open sockets that a forked child must not inherit
+_context = multiprocessing.get_context('spawn')
+
+
+class ShardedWorkers:
+    """Run the routers in BOT_WORKERS processes, each owning a set of users
+
+    Every update goes to worker `from_user.id % BOT_WORKERS`, so a user's
+    updates always reach the same process (keeping its FSM state there) and
+    are handled in order. Workers report cache changes (catalog edits,
+    approvals) back here, and they are relayed to every other worker and to
+    this process. A worker that dies is restarted on the same inbox, so its
+    queued updates are not lost. Worker 0 also sends every broadcast.
+    """
+
+    def __init__(self, database, workers: int = None):
+        self.db = database
+        self.count = workers or config.BOT_WORKERS
+        self._inboxes = [_context.Queue(maxsize=config.UPDATE_QUEUE_SIZE) for _ in range(self.count)]
+        self._events = _context.Queue()
+        self._processes = [None] * self.count
+        self._relay = None
+        self._supervisor = None
+        self._stopping = False
+
+    def start(self):
+        """Start the worker processes, the event relay and the supervisor"""
+        loop = asyncio.get_running_loop()
+        for index in range(self.count):
+            self._spawn(index)
+        self._relay = threading.Thread(target=self._relay_events, args=(loop,), daemon=True)
+        self._relay.start()
+        self._supervisor = asyncio.ensure_future(self._supervise())
+
+    def _spawn(self, index: int):
+        process = _context.Process(
+            target=run_worker,
+            args=(index, self._inboxes[index], self._events),
+            name=f'bot-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive() and not self._stopping:
+                    logger.error(f"Bot worker {index} exited with code {process.exitcode}, restarting")
+                    self._spawn(index)
+
+    def _relay_events(self, loop):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            sender, name, args = event
+            for index, inbox in enumerate(self._inboxes):
+                if index != sender:
+                    inbox.put(('cache', name, args))
+            loop.call_soon_threadsafe(self.db.apply_cache_change, name, args)
+
+    def submit(self, data: dict) -> bool:
+        """Route a raw update to its user's worker; False if that worker is backed up"""
+        try:
+            self._inboxes[update_user_id(data) % self.count].put_nowait(('update', data))
+        except queue.Full:
+            return False
+        return True
+
+    async def stop(self):
+        """Let every worker finish its queue and exit"""
+        self._stopping = True
+        if self._supervisor:
+            self._supervisor.cancel()
+        for inbox in self._inboxes:
+            inbox.put(('stop',))
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, config.UPDATE_DRAIN_TIMEOUT + 5)
+            if process.is_alive():
+                process.terminate()
+        self._events.put(None)
+
+
+def run_worker(index: int, inbox, events):
+    """Entry point of a worker process"""
+    # The front process handles Ctrl+C and tells workers to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_worker_main(index, inbox, events))
+
+
+async def _worker_main(index: int, inbox, events):
+    # Imported here so the front process does not build a second dispatcher
+    from bot import create_bot, create_dispatcher
+    from broadcast import broadcaster
+    from database import db
+    from export import exporter
+    from outbox import outbox
+
+    bot = create_bot()
+    dp = create_dispatcher(manage_lifecycle=False)
+    await db.init_db()
+    await db.load_roles()
+    db.on_cache_change = lambda name, args: events.put((index, name, args))
+    if index == 0:
+        # The only process sending broadcasts, within its outbox's share of the rate
+        broadcaster.watch(bot)
+    else:
+        broadcaster.sender = False
+
+    lanes = UpdateLanes(lambda data: feed_raw_update(bot, dp, data))
+    lanes.start()
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+
+    def read_inbox():
+        # Blocks in a thread; waiting on lanes.put() pushes back on the inbox
+        while True:
+            message = inbox.get()
+            if message[0] == 'stop':
+                loop.call_soon_threadsafe(stopped.set_result, None)
+                return
+            if message[0] == 'cache':
+                loop.call_soon_threadsafe(db.apply_cache_change, message[1], message[2])
+            else:
+                asyncio.run_coroutine_threadsafe(lanes.put(message[1]), loop).result()
+
+    threading.Thread(target=read_inbox, daemon=True).start()
+    await stopped
+    await lanes.stop()
+    await broadcaster.stop()
+    await exporter.stop()
+    await outbox.stop()
+    await db.close()
+    await bot.session.close()
+
+
+class RawPoller:
+    """getUpdates loop that hands raw updates to `submit` without parsing them
+
+    Parsing happens in the workers; the front only reads the user id.
+    """
+
+    def __init__(self, submit, allowed_updates: list):
+        self.submit = submit
+        self.allowed_updates = allowed_updates
+        self._offset = None
+
+    async def run(self):
+        url = f'{config.TELEGRAM_API_BASE}/bot{config.BOT_TOKEN}/getUpdates'
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=config.POLLING_TIMEOUT + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                params = {'timeout': config.POLLING_TIMEOUT, 'allowed_updates': self.allowed_updates}
+                if self._offset is not None:
+                    params['offset'] = self._offset
+                try:
+                    async with session.post(url, json=params) as response:
+                        data = await response.json(content_type=None)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logger.warning(f"getUpdates failed: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not data.get('ok'):
+                    logger.warning(f"getUpdates failed: {data.get('description')}")
+                    await asyncio.sleep(data.get('parameters', {}).get('retry_after', 1))
+                    continue
+
+                for update in data['result']:
+                    # Only confirmed (offset moved past) once a worker took it
+                    while not self.submit(update):
+                        await asyncio.sleep(0.1)
+                    self._offset = update['update_id'] + 1
@@ -1,22 +1,122 @@
 import asyncio
-import threading
-import os
-import sys
+import logging
+import signal
 
-def run_bot():
-    """Run the Telegram bot"""
-    print("Starting Telegram bot...")
-    os.system('python bot.py')
+from aiohttp import web
+
+import config
+from bot import create_bot, create_dispatcher, on_startup, on_shutdown
+from database import db
+from sharding import RawPoller, ShardedWorkers
+from webapp.server import create_app
+from webhook import UpdateLanes, WebhookIntake, feed_raw_update
+
+logger = logging.getLogger(__name__)
+
+
+def stop_after_polling(task: asyncio.Task, stop: asyncio.Event):
+    """Shut the process down if polling ends on its own"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Polling failed", exc_info=task.exception())
+    stop.set()
+
+
+async def main():
+    """Run the bot and the Web App in one process on one event loop
+
+    Startup: database and maintenance, then the HTTP server, then update
+    processing (in this process, or in BOT_WORKERS sharded worker
+    processes), then update intake (webhook registration or polling).
+    Shutdown runs in reverse: stop taking updates and HTTP requests, finish
+    queued updates, then stop maintenance and close the database.
+    """
+    bot = create_bot()
+    dp = create_dispatcher(manage_lifecycle=False)
+    app = create_app(manage_database=False)
+    allowed_updates = dp.resolve_used_update_types()
+
+    workers = lanes = None
+    if config.BOT_WORKERS > 1:
+        workers = ShardedWorkers(db)
+        submit = workers.submit
+    elif config.BOT_MODE == 'webhook':
+        lanes = UpdateLanes(lambda data: feed_raw_update(bot, dp, data))
+        submit = lanes.submit
+
+    intake = None
+    if config.BOT_MODE == 'webhook':
+        intake = WebhookIntake(bot, submit, allowed_updates)
+        app.router.add_post(config.WEBHOOK_PATH, intake.handle)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows: Ctrl+C arrives as KeyboardInterrupt instead
+
+    await on_startup(bot, send_broadcasts=workers is None)
+    runner = web.AppRunner(
+        app,
+        keepalive_timeout=config.WEBAPP_KEEPALIVE_TIMEOUT,
+        shutdown_timeout=config.WEBAPP_SHUTDOWN_TIMEOUT
+    )
+    polling = None
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, config.WEBAPP_HOST, config.WEBAPP_PORT).start()
+        logger.info(f"Web App listening on {config.WEBAPP_HOST}:{config.WEBAPP_PORT}")
+
+        if workers:
+            workers.start()
+            logger.info(f"Processing updates in {workers.count} worker processes")
+        elif lanes:
+            lanes.start()
+
+        if intake:
+            await intake.register()
+            logger.info("Receiving updates by webhook")
+        else:
+            # A webhook left over from webhook mode would make getUpdates fail
+            await bot.delete_webhook()
+            if workers:
+                polling = asyncio.ensure_future(RawPoller(submit, allowed_updates).run())
+            else:
+                polling = asyncio.ensure_future(
+                    dp.start_polling(bot, handle_signals=False, close_bot_session=False)
+                )
+            polling.add_done_callback(lambda task: stop_after_polling(task, stop))
+            logger.info("Receiving updates by polling")
+
+        await stop.wait()
+    finally:
+        logger.info("Shutting down...")
+        if polling:
+            if workers:
+                polling.cancel()
+            else:
+                try:
+                    await dp.stop_polling()
+                except RuntimeError:
+                    pass  # Polling already ended
+            await asyncio.gather(polling, return_exceptions=True)
+        # Stops accepting connections and waits for in-flight requests
+        await runner.cleanup()
+        if workers:
+            await workers.stop()
+        elif lanes:
+            await lanes.stop()
+        await on_shutdown()
+        await bot.session.close()
 
-def run_webapp():
-    """Run the Flask web app"""
-    print("Starting Web App...")
-    os.system('python webapp/server.py')
 
 if __name__ == '__main__':
-    # Start bot in a separate thread
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
-    
-    # Run webapp in main thread
-    run_webapp()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Stopped by user")
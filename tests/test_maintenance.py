@@ -0,0 +1,73 @@
+"""Converting a database file created before auto_vacuum was enabled"""
+import asyncio
+import logging
+import sqlite3
+
+import config
+import database
+from maintenance import MaintenanceScheduler
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def old_database(path) -> database.Database:
+    """A migrated database in a file that predates auto_vacuum, with free pages"""
+    sqlite3.connect(path).execute('CREATE TABLE legacy (x)').connection.close()
+    db = database.Database()
+    db.db_path = str(path)
+    await db.init_db()
+    async with db.writer() as conn:
+        await conn.executemany('INSERT INTO legacy VALUES (?)', [('x' * 1000,) for _ in range(500)])
+    async with db.writer() as conn:
+        await conn.execute('DELETE FROM legacy')
+    return db
+
+
+def test_old_file_is_skipped_below_the_threshold(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(config, 'MAINTENANCE_VACUUM_CONVERT_PAGES', 0)
+
+    async def test():
+        db = await old_database(tmp_path / 'bot.db')
+        scheduler = MaintenanceScheduler(db)
+        try:
+            with caplog.at_level(logging.WARNING, logger='maintenance'):
+                first = await scheduler.incremental_vacuum()
+                await scheduler.incremental_vacuum()
+            assert first['skipped'] == 'auto_vacuum is off'
+            assert first['free_pages'] > 0
+            assert len([r for r in caplog.records if 'auto_vacuum is off' in r.getMessage()]) == 1
+            assert await scheduler.vacuum_mode() == 0
+        finally:
+            await db.close()
+
+    run(test())
+
+
+def test_old_file_is_converted_once_enough_pages_are_free(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'MAINTENANCE_VACUUM_CONVERT_PAGES', 100)
+
+    async def test():
+        db = await old_database(tmp_path / 'bot.db')
+        scheduler = MaintenanceScheduler(db)
+        try:
+            result = await scheduler.incremental_vacuum()
+            assert result['converted']
+            assert result['freed_pages'] >= 100
+            assert result['free_pages'] == 0
+            assert await scheduler.vacuum_mode() == 2
+
+            # From now on the regular job runs, and keeps the file incremental
+            async with db.writer() as conn:
+                await conn.executemany('INSERT INTO legacy VALUES (?)', [('x' * 1000,) for _ in range(500)])
+            async with db.writer() as conn:
+                await conn.execute('DELETE FROM legacy')
+            result = await scheduler.incremental_vacuum()
+            assert result['freed_pages'] > 0
+            assert 'skipped' not in result
+            assert (await db.get_stats())['total_users'] == 0  # Still a working database
+        finally:
+            await db.close()
+
+    run(test())
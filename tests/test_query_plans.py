@@ -0,0 +1,179 @@
+"""EXPLAIN QUERY PLAN checks for the hot queries in database.py
+
+Each case runs a Database method against a temporary database with SQL
+tracing on, then asks SQLite for the plan of every statement it ran. A
+plan that scans purchases, episodes or video_tokens fails the test.
+
+Deliberately left out: the catalog load (reads every course and episode
+once per catalog version), STATS_SQL (the counters backfill and
+/stats_check) and the video token orphan sweep, which walk whole tables by
+design.
+"""
+import asyncio
+import re
+
+import pytest
+
+import config
+import database
+from analytics import Analytics
+from maintenance import MaintenanceScheduler
+
+WATCHED_TABLES = ('purchases', 'episodes', 'video_tokens')
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def open_database(path) -> database.Database:
+    """A migrated database with a few users, courses, episodes and purchases"""
+    db = database.Database()
+    db.db_path = str(path)
+    await db.init_db()
+    for user_id in range(1, 6):
+        await db.add_user(user_id, f'user{user_id}', 'User')
+    await db.flush_users()
+    for course in range(2):
+        course_id = await db.add_course(f'Course {course}', None, 10)
+        for number in range(1, 4):
+            episode_id = await db.add_episode(course_id, f'Episode {number}', None, 'file', 5, number)
+            for user_id in range(1, 6):
+                await db.create_purchase(user_id, episode_id, 'receipt')
+    await db.approve_purchases(list(range(1, 10)))
+    await db.reject_purchases(list(range(10, 13)))
+    await db.get_stats()
+    await db.get_course(1)  # Load the catalog outside the traced calls
+    return db
+
+
+def watched_names(sql: str) -> set:
+    """Names the watched tables go by in `sql`: their own and their aliases"""
+    names = set()
+    for table, alias in re.findall(rf'\b({"|".join(WATCHED_TABLES)})\b(?:\s+(?:AS\s+)?(\w+))?', sql, re.I):
+        names.add(table)
+        if alias and alias.upper() not in ('WHERE', 'ON', 'SET', 'JOIN', 'LEFT', 'GROUP', 'ORDER', 'LIMIT', 'VALUES'):
+            names.add(alias)
+    return names
+
+
+async def traced_plans(db: database.Database, call) -> list:
+    """(statement, plan details) for every statement `call()` runs"""
+    statements = []
+    connections = [db._writer, *db._reader_conns]
+    for conn in connections:
+        await conn.set_trace_callback(statements.append)
+    try:
+        await call()
+    finally:
+        for conn in connections:
+            await conn.set_trace_callback(None)
+
+    plans = []
+    for statement in dict.fromkeys(statements):  # Statements that fire triggers are traced again
+        if not re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', statement, re.I):
+            continue  # BEGIN, COMMIT, PRAGMA and trigger markers
+        async with db._writer.execute(f'EXPLAIN QUERY PLAN {statement}') as cursor:
+            plans.append((statement, [row[3] for row in await cursor.fetchall()]))
+    await db._writer.rollback()
+    return plans
+
+
+def table_scans(plans: list) -> list:
+    scans = []
+    for statement, details in plans:
+        names = watched_names(statement)
+        for detail in details:
+            match = re.match(r'SCAN (\w+)', detail)
+            if match and match.group(1) in names:
+                scans.append(f'{detail}\n    in: {" ".join(statement.split())}')
+    return scans
+
+
+def token_mode(mode):
+    async def call(db):
+        config.VIDEO_TOKEN_MODE, previous = mode, config.VIDEO_TOKEN_MODE
+        try:
+            return await db.create_video_token(1, 1)
+        finally:
+            config.VIDEO_TOKEN_MODE = previous
+    return call
+
+
+async def episode_sales_subquery(db):
+    """The stats triggers' count of an episode's approved sales"""
+    async with db.reader() as conn:
+        sql = f'SELECT {database._EPISODE_SALES.format(row="episodes")} FROM episodes WHERE episode_id = 1'
+        async with conn.execute(sql) as cursor:
+            await cursor.fetchall()
+
+
+async def validate_db_token(db):
+    token = await token_mode('db')(db)
+    await db.validate_token(token)
+
+
+async def entitlements(db):
+    db._entitlements.clear()
+    await db.has_access(1, 1)
+
+
+# name -> async fn(db) calling the queries under test
+CASES = {
+    'create_purchase': lambda db: db.create_purchase(5, 6, 'receipt'),
+    'get_purchase': lambda db: db.get_purchase(3),
+    'get_purchase_detail': lambda db: db.get_purchase_detail(13),
+    'approve_purchase': lambda db: db.approve_purchase(13),
+    'reject_purchase': lambda db: db.reject_purchase(14),
+    'approve_purchases': lambda db: db.approve_purchases([15, 16, 17]),
+    'pending_page_first': lambda db: db.get_pending_purchases_page(None, True, 10),
+    'pending_page_next': lambda db: db.get_pending_purchases_page((20,), True, 10),
+    'pending_page_back': lambda db: db.get_pending_purchases_page((20,), False, 10),
+    'count_pending_purchases': lambda db: db.count_pending_purchases(),
+    'user_purchases_page': lambda db: db.get_user_purchases_page(1, None, True, 10),
+    'user_purchases_page_back': lambda db: db.get_user_purchases_page(1, (5, 2, 1), False, 10),
+    'entitlements': entitlements,
+    'get_stats': lambda db: db.get_stats(),
+    'episode_sales_subquery': episode_sales_subquery,
+    'delete_episode': lambda db: db.delete_episode(2),
+    'delete_course': lambda db: db.delete_course(1),
+    'create_video_token': token_mode('db'),
+    'validate_token': validate_db_token,
+    'export_purchases': lambda db: db.export_purchases((10,), 100),
+    'rollup': lambda db: Analytics(db)._rollup_batch(),
+    'prune_expired_tokens': lambda db: MaintenanceScheduler(db).prune_expired_tokens(),
+    'prune_fsm_states': lambda db: MaintenanceScheduler(db).prune_fsm_states(),
+}
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_hot_query_does_not_scan(tmp_path, name):
+    async def check():
+        db = await open_database(tmp_path / 'bot.db')
+        try:
+            return await traced_plans(db, lambda: CASES[name](db))
+        finally:
+            await db.close()
+
+    plans = run(check())
+    assert plans, f'{name} ran no statements'
+    scans = table_scans(plans)
+    assert not scans, 'full table scan:\n' + '\n'.join(scans)
+
+
+def test_every_index_is_used(tmp_path):
+    """An index no hot query uses only slows down writes"""
+    async def check():
+        db = await open_database(tmp_path / 'bot.db')
+        plans = []
+        try:
+            for name in sorted(CASES):
+                plans += await traced_plans(db, lambda: CASES[name](db))
+        finally:
+            await db.close()
+        return plans
+
+    used = ' '.join(detail for _, details in run(check()) for detail in details)
+    for statement in database.INDEXES:
+        index = re.search(r'EXISTS (\w+)', statement).group(1)
+        assert re.search(rf'\b{index}\b', used), f'{index} is not used by any hot query'
@@ -0,0 +1,212 @@
+"""TelegramMedia against a stand-in Bot API server
+
+TELEGRAM_API_BASE points at a local aiohttp app that answers getFile and
+serves file bytes (with Range support), and counts what it was asked for.
+"""
+import asyncio
+import os
+import re
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import config
+from webapp import server
+from webapp.telegram_media import TelegramMedia
+
+FILES = {
+    'video-a': bytes(range(256)) * 4,
+    'video-b': bytes(reversed(range(256))) * 4,
+    'video-c': b'c' * 1024,
+    'broken': b'',  # getFile works, the download answers 500
+}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class StandIn:
+    """A fake Bot API: getFile plus /file downloads"""
+
+    def __init__(self):
+        self.get_file_calls = []
+        self.downloads = []  # (file_path, Range header or None)
+        self.get_file_delay = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/bot{token}/getFile', self.get_file)
+        app.router.add_get('/file/bot{token}/{file_path:.+}', self.file)
+        return app
+
+    async def get_file(self, request: web.Request):
+        file_id = request.query['file_id']
+        self.get_file_calls.append(file_id)
+        await asyncio.sleep(self.get_file_delay)
+        if file_id == 'gone':
+            return web.Response(status=500, text='Internal Server Error')
+        if file_id not in FILES:
+            return web.json_response({'ok': False, 'error_code': 400, 'description': 'Bad Request: invalid file_id'})
+        return web.json_response({'ok': True, 'result': {
+            'file_id': file_id, 'file_path': f'videos/{file_id}.mp4', 'file_size': len(FILES[file_id]),
+        }})
+
+    async def file(self, request: web.Request):
+        file_path = request.match_info['file_path']
+        self.downloads.append((file_path, request.headers.get('Range')))
+        file_id = file_path[len('videos/'):-len('.mp4')]
+        if file_id == 'broken':
+            return web.Response(status=500)
+        data = FILES[file_id]
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if not match:
+            return web.Response(body=data, headers={'Accept-Ranges': 'bytes'})
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(data) - 1
+        return web.Response(status=206, body=data[start:end + 1], headers={
+            'Accept-Ranges': 'bytes', 'Content-Range': f'bytes {start}-{end}/{len(data)}',
+        })
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'BOT_TOKEN', '123:test')
+    monkeypatch.setattr(config, 'TELEGRAM_CACHE_DIR', str(tmp_path / 'telegram_cache'))
+    monkeypatch.setattr(config, 'VIDEOS_DIR', str(tmp_path))
+    return monkeypatch
+
+
+async def started(settings, test):
+    """Run `test(media, telegram, client)` with the stand-in and a media route up"""
+    telegram = StandIn()
+    api = TestServer(telegram.app())
+    await api.start_server()
+    settings.setattr(config, 'TELEGRAM_API_BASE', str(api.make_url('')).rstrip('/'))
+
+    media = TelegramMedia()
+    settings.setattr(server, 'telegram_media', media)
+
+    async def handler(request: web.Request):
+        file_id = request.match_info['file_id']
+        return await server.serve_media(request, file_id, 'video/mp4', len(FILES.get(file_id, b'')) or None)
+
+    app = web.Application()
+    app.router.add_get('/media/{file_id}', handler)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        return await test(media, telegram, client)
+    finally:
+        await media.close()
+        await client.close()
+        await api.close()
+
+
+async def downloaded(media: TelegramMedia):
+    """Wait for the background cache fills to finish"""
+    await asyncio.gather(*media._downloads.values(), return_exceptions=True)
+
+
+def test_get_file_is_cached_and_shared(settings):
+    async def test(media, telegram, client):
+        telegram.get_file_delay = 0.05
+        results = await asyncio.gather(*(media.resolve('video-a') for _ in range(10)))
+        assert set(results) == {('videos/video-a.mp4', len(FILES['video-a']))}
+        assert telegram.get_file_calls == ['video-a']
+
+        await media.resolve('video-a')
+        assert telegram.get_file_calls == ['video-a']
+
+        settings.setattr(config, 'TELEGRAM_FILE_PATH_TTL', 0)
+        media._file_paths.clear()
+        await media.resolve('video-a')
+        await media.resolve('video-a')
+        assert telegram.get_file_calls == ['video-a'] * 3
+
+    run(started(settings, test))
+
+
+def test_range_on_a_cache_miss_is_passed_through(settings):
+    async def test(media, telegram, client):
+        response = await client.get('/media/video-a', headers={'Range': 'bytes=100-199'})
+        assert response.status == 206
+        assert response.headers['Content-Range'] == f'bytes 100-199/{len(FILES["video-a"])}'
+        assert response.headers['Content-Type'] == 'video/mp4'
+        assert await response.read() == FILES['video-a'][100:200]
+        assert ('videos/video-a.mp4', 'bytes=100-199') in telegram.downloads
+
+        # The miss also started filling the cache
+        await downloaded(media)
+        assert ('videos/video-a.mp4', None) in telegram.downloads
+        assert media.cached_file('video-a') is not None
+
+    run(started(settings, test))
+
+
+def test_range_is_served_from_the_cache_after_prefetch(settings):
+    async def test(media, telegram, client):
+        media.prefetch('video-b')
+        await downloaded(media)
+        assert telegram.downloads == [('videos/video-b.mp4', None)]
+        with open(media.cached_file('video-b'), 'rb') as f:
+            assert f.read() == FILES['video-b']
+
+        response = await client.get('/media/video-b', headers={'Range': 'bytes=1000-'})
+        assert response.status == 206
+        assert response.headers['Content-Range'] == f'bytes 1000-1023/{len(FILES["video-b"])}'
+        assert await response.read() == FILES['video-b'][1000:]
+        assert telegram.downloads == [('videos/video-b.mp4', None)]
+
+    run(started(settings, test))
+
+
+def test_cache_evicts_least_recently_served(settings):
+    settings.setattr(config, 'TELEGRAM_CACHE_MAX_BYTES', 2500)
+
+    async def test(media, telegram, client):
+        for file_id in ('video-a', 'video-b'):
+            media.prefetch(file_id)
+            await downloaded(media)
+        evicted = media.cached_file('video-b')
+
+        # Serving video-a makes video-b the least recently served
+        response = await client.get('/media/video-a')
+        assert await response.read() == FILES['video-a']
+
+        media.prefetch('video-c')
+        await downloaded(media)
+        assert media.cached_file('video-b') is None
+        assert media.cached_file('video-a') is not None
+        assert media.cached_file('video-c') is not None
+        assert media._cache_bytes == 2048
+        assert not os.path.exists(evicted)
+
+    run(started(settings, test))
+
+
+def test_files_larger_than_the_cache_are_not_prefetched(settings):
+    settings.setattr(config, 'TELEGRAM_CACHE_MAX_BYTES', 512)
+
+    async def test(media, telegram, client):
+        response = await client.get('/media/video-a')
+        assert await response.read() == FILES['video-a']
+        await downloaded(media)
+        assert telegram.downloads == [('videos/video-a.mp4', None)]
+        assert media.cached_file('video-a') is None
+
+    run(started(settings, test))
+
+
+@pytest.mark.parametrize('file_id', ['missing', 'gone', 'broken'])
+def test_upstream_failures_answer_502(settings, file_id):
+    """getFile answering ok: false or HTTP 500, and a download answering HTTP 500"""
+    async def test(media, telegram, client):
+        response = await client.get('/media/' + file_id, headers={'Range': 'bytes=0-99'})
+        assert response.status == 502
+        assert 'error' in await response.json()
+        await downloaded(media)
+        assert media.cached_file(file_id) is None
+
+    run(started(settings, test))
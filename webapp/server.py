@@ -1,164 +1,293 @@
-from flask import Flask, render_template, jsonify, send_file, request, Response
+from aiohttp import web
 import asyncio
+import logging
+import multiprocessing
 import os
+import socket
 import sys
-from datetime import datetime
+import time
 
 # Add parent directory to path to import database
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import config
-from database import db
+from database import db, sign_video_token
+from webapp.streaming import handles, send_file
+from webapp.telegram_media import TelegramFileError, telegram_media
 
-app = Flask(__name__, 
-            template_folder='.',
-            static_folder='static')
+logger = logging.getLogger(__name__)
 
+WEBAPP_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_PATH = os.path.join(WEBAPP_DIR, 'index.html')
+STATIC_DIR = os.path.join(WEBAPP_DIR, 'static')
 
-def get_event_loop():
-    """Get or create event loop"""
+# Routes that stream a body for as long as the viewer keeps watching; the
+# request timeout would cut them off mid-video.
+STREAMING_ROUTES = {'stream_local_video', 'media'}
+
+routes = web.RouteTableDef()
+
+
+def error_response(message: str, status: int) -> web.Response:
+    """JSON error body in the shape the Web App expects"""
+    return web.json_response({'error': message}, status=status)
+
+
+@web.middleware
+async def timeout_middleware(request: web.Request, handler):
+    """Abort handlers that take longer than WEBAPP_REQUEST_TIMEOUT"""
+    if request.match_info.route.name in STREAMING_ROUTES:
+        return await handler(request)
+    try:
+        return await asyncio.wait_for(handler(request), config.WEBAPP_REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        return error_response('انتهت مهلة الطلب، حاول مرة أخرى', 504)
+
+
+def is_mobile_request(request: web.Request) -> bool:
+    """Server-side device check matching the one in index.html"""
+    user_agent = request.headers.get('User-Agent', '').lower()
+    is_mobile = any(device in user_agent for device in ['android', 'iphone', 'ipad', 'mobile'])
+    return is_mobile or 'telegram' in user_agent
+
+
+def local_file(name: str):
+    """Path of `name` inside VIDEOS_DIR if it is stored there, else None"""
+    if not name:
+        return None
+    path = os.path.join(config.VIDEOS_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def media_token_for(video_info: dict):
+    """Short-lived signed token for the media URLs of a validated token
+
+    The media URL never outlives the page token, so a copied link stops
+    working soon after playback.
+    """
+    expires_at = min(video_info['expires_at'], int(time.time()) + config.MEDIA_URL_TTL)
+    return sign_video_token(video_info['user_id'], video_info['episode_id'], expires_at), expires_at
+
+
+async def serve_media(request: web.Request, name: str, content_type: str, file_size: int = None):
+    """Serve a file from VIDEOS_DIR, or proxy it from Telegram by file_id"""
+    path = local_file(name)
     try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    return loop
+        if path:
+            return await send_file(request, path, content_type=content_type)
+        return await telegram_media.serve(request, name, content_type, file_size)
+    except FileNotFoundError:
+        return error_response('الملف غير موجود', 404)
+    except TelegramFileError as e:
+        logger.warning(f"Telegram file {name} unavailable: {e}")
+        return error_response('تعذر تحميل الملف من تلغرام، حاول لاحقاً', 502)
 
 
-@app.route('/')
-def index():
+@routes.get('/')
+async def index(request: web.Request):
     """Serve the Web App"""
-    return render_template('index.html')
+    return web.FileResponse(INDEX_PATH)
 
 
-@app.route('/watch')
-def watch():
+@routes.get('/watch')
+async def watch(request: web.Request):
     """Watch page (same as index)"""
-    return render_template('index.html')
+    return web.FileResponse(INDEX_PATH)
 
 
-@app.route('/api/video/<token>')
-def validate_video_token(token):
+@routes.get('/api/video/{token}')
+async def validate_video_token(request: web.Request):
     """Validate token and return video info"""
-    loop = get_event_loop()
-    
     # Validate token
-    video_info = loop.run_until_complete(db.validate_token(token))
-    
+    video_info = await db.validate_token(request.match_info['token'])
+
     if not video_info:
-        return jsonify({'error': 'رمز الوصول غير صحيح أو منتهي الصلاحية'}), 404
-    
-    return jsonify({
+        return error_response('رمز الوصول غير صحيح أو منتهي الصلاحية', 404)
+
+    return web.json_response({
         'title': video_info['title'],
         'episode_id': video_info['episode_id']
     })
 
 
-@app.route('/api/stream/<token>')
-def stream_video(token):
+@routes.get('/api/stream/{token}')
+async def stream_video(request: web.Request):
     """Stream video file with token validation"""
-    loop = get_event_loop()
-    
     # Validate token
-    video_info = loop.run_until_complete(db.validate_token(token))
-    
+    video_info = await db.validate_token(request.match_info['token'])
+
     if not video_info:
-        return jsonify({'error': 'رمز الوصول غير صحيح أو منتهي الصلاحية'}), 404
-    
-    # Additional device check (server-side)
-    user_agent = request.headers.get('User-Agent', '').lower()
-    
-    # Check if request is from mobile
-    is_mobile = any(device in user_agent for device in ['android', 'iphone', 'ipad', 'mobile'])
-    
+        return error_response('رمز الوصول غير صحيح أو منتهي الصلاحية', 404)
+
     # Block desktop browsers (additional server-side check)
-    if not is_mobile and 'telegram' not in user_agent:
-        return jsonify({'error': 'يمكن المشاهدة فقط من الهاتف المحمول'}), 403
-    
+    if not is_mobile_request(request):
+        return error_response('يمكن المشاهدة فقط من الهاتف المحمول', 403)
+
     video_path = video_info['video_path']
-    
-    # For Telegram file_ids, return the file_id so the Web App can request it from bot
-    # Or redirect to Telegram file URL
-    return jsonify({
-        'video_url': f'https://api.telegram.org/file/bot{config.BOT_TOKEN}/{video_path}',
+    media_token, _ = media_token_for(video_info)
+
+    # The bytes come through /api/media, which proxies Telegram file_ids,
+    # so the bot token never reaches the client
+    return web.json_response({
+        'video_url': f'/api/media/{media_token}',
         'file_id': video_path,
         'title': video_info['title']
     })
 
 
-@app.route('/api/stream/local/<token>')
-def stream_local_video(token):
+@routes.get('/api/stream/local/{token}', name='stream_local_video')
+async def stream_local_video(request: web.Request):
     """Stream locally stored video file"""
-    loop = get_event_loop()
-    
     # Validate token
-    video_info = loop.run_until_complete(db.validate_token(token))
-    
+    video_info = await db.validate_token(request.match_info['token'])
+
     if not video_info:
-        return jsonify({'error': 'رمز الوصول غير صحيح أو منتهي الصلاحية'}), 404
-    
+        return error_response('رمز الوصول غير صحيح أو منتهي الصلاحية', 404)
+
     # Get video file path (assuming it's stored in videos directory)
     # This is for locally stored videos, not Telegram file_ids
     video_filename = video_info.get('video_path')
     video_file_path = os.path.join(config.VIDEOS_DIR, video_filename)
-    
-    if not os.path.exists(video_file_path):
-        return jsonify({'error': 'الفيديو غير موجود'}), 404
-    
-    # Get file size
-    file_size = os.path.getsize(video_file_path)
-    
-    # Handle range requests for video streaming
-    range_header = request.headers.get('Range', None)
-    
-    if range_header:
-        # Parse range header
-        byte_range = range_header.replace('bytes=', '').split('-')
-        start = int(byte_range[0]) if byte_range[0] else 0
-        end = int(byte_range[1]) if len(byte_range) > 1 and byte_range[1] else file_size - 1
-        length = end - start + 1
-        
-        # Read file chunk
-        with open(video_file_path, 'rb') as f:
-            f.seek(start)
-            data = f.read(length)
-        
-        # Return partial content
-        response = Response(
-            data,
-            206,
-            mimetype='video/mp4',
-            direct_passthrough=True
-        )
-        response.headers.add('Content-Range', f'bytes {start}-{end}/{file_size}')
-        response.headers.add('Accept-Ranges', 'bytes')
-        response.headers.add('Content-Length', str(length))
-        return response
-    else:
-        # Return full file
-        return send_file(
-            video_file_path,
-            mimetype='video/mp4',
-            as_attachment=False
-        )
 
+    try:
+        return await send_file(request, video_file_path, content_type='video/mp4')
+    except FileNotFoundError:
+        return error_response('الفيديو غير موجود', 404)
+
+
+@routes.get('/api/manifest/{token}')
+async def playback_manifest(request: web.Request):
+    """Everything the player needs to start, from a single token validation"""
+    video_info = await db.validate_token(request.match_info['token'])
+
+    if not video_info:
+        return error_response('رمز الوصول غير صحيح أو منتهي الصلاحية', 404)
 
-async def init_database():
+    if not is_mobile_request(request):
+        return error_response('يمكن المشاهدة فقط من الهاتف المحمول', 403)
+
+    media_token, expires_at = media_token_for(video_info)
+    video_file = local_file(video_info['video_path'])
+    size = os.path.getsize(video_file) if video_file else video_info['file_size']
+
+    return web.json_response({
+        'title': video_info['title'],
+        'episode_id': video_info['episode_id'],
+        'media_url': f'/api/media/{media_token}',
+        'media_expires_at': expires_at,
+        'mime_type': 'video/mp4',
+        'size': size,
+        'duration': video_info['duration'],
+        'poster_url': f'/api/poster/{media_token}' if video_info['poster'] else None
+    }, headers={'Cache-Control': 'no-store'})
+
+
+@routes.get('/api/media/{token}', name='media')
+async def media(request: web.Request):
+    """Video bytes for a manifest media URL"""
+    video_info = await db.validate_token(request.match_info['token'])
+
+    if not video_info:
+        return error_response('رمز الوصول غير صحيح أو منتهي الصلاحية', 404)
+
+    return await serve_media(request, video_info['video_path'], 'video/mp4', video_info['file_size'])
+
+
+@routes.get('/api/poster/{token}')
+async def poster(request: web.Request):
+    """Poster image for a manifest media URL"""
+    video_info = await db.validate_token(request.match_info['token'])
+
+    if not video_info:
+        return error_response('رمز الوصول غير صحيح أو منتهي الصلاحية', 404)
+
+    if not video_info['poster']:
+        return error_response('الصورة غير موجودة', 404)
+
+    return await serve_media(request, video_info['poster'], 'image/jpeg')
+
+
+async def on_startup(app: web.Application):
     """Initialize database"""
     await db.init_db()
-    print("Database initialized!")
+    logger.info("Database initialized!")
+
+
+async def on_cleanup(app: web.Application):
+    """Close cached video files and the Telegram session"""
+    handles.close_all()
+    await telegram_media.close()
+
+
+async def close_database(app: web.Application):
+    """Close the database pool"""
+    await db.close()
+
+
+def create_app(manage_database: bool = True) -> web.Application:
+    """Build the Web App application
+
+    start.py passes manage_database=False because it opens and closes the
+    shared database around both the bot and the server.
+    """
+    app = web.Application(middlewares=[timeout_middleware])
+    app.add_routes(routes)
+    app.router.add_static('/static', STATIC_DIR)
+    app.on_cleanup.append(on_cleanup)
+    if manage_database:
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(close_database)
+    return app
+
+
+def run_worker(sock: socket.socket = None):
+    """Serve the Web App in this process, on a shared socket if given"""
+    if sock is None:
+        options = {'host': config.WEBAPP_HOST, 'port': config.WEBAPP_PORT}
+    else:
+        options = {'sock': sock}
+    web.run_app(
+        create_app(),
+        keepalive_timeout=config.WEBAPP_KEEPALIVE_TIMEOUT,
+        shutdown_timeout=config.WEBAPP_SHUTDOWN_TIMEOUT,
+        print=None,
+        **options
+    )
+
+
+def main():
+    """Run the Web App with WEBAPP_WORKERS processes"""
+    logger.info(f"Starting Web App server on {config.WEBAPP_HOST}:{config.WEBAPP_PORT}")
+    logger.info(f"Web App URL: {config.WEBAPP_URL}")
+
+    if config.WEBAPP_WORKERS <= 1:
+        run_worker()
+        return
+
+    # Every worker accepts from one listening socket, so the kernel spreads
+    # connections across them; each worker opens its own database pool.
+    sock = socket.create_server((config.WEBAPP_HOST, config.WEBAPP_PORT), backlog=1024)
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(sock,), name=f'webapp-{number}')
+        for number in range(config.WEBAPP_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {len(workers)} workers")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Workers got the same Ctrl+C and shut down on their own
+        for worker in workers:
+            worker.join()
+    finally:
+        sock.close()
 
 
 if __name__ == '__main__':
-    # Initialize database
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init_database())
-    
-    # Run Flask app
-    print(f"Starting Web App server on {config.WEBAPP_HOST}:{config.WEBAPP_PORT}")
-    print(f"Web App URL: {config.WEBAPP_URL}")
-    app.run(
-        host=config.WEBAPP_HOST,
-        port=config.WEBAPP_PORT,
-        debug=True
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
+    main()
@@ -0,0 +1,298 @@
+from aiohttp import web
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import os
+import secrets
+import threading
+import time
+
+import config
+
+
+class RangeNotSatisfiable(Exception):
+    """Every range in the Range header lies outside the file"""
+
+
+class FileHandle:
+    """An open video file shared by every viewer currently streaming it"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb', buffering=0)
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        self.last_modified = formatdate(int(stat.st_mtime), usegmt=True)
+        self.checked_at = time.monotonic()
+        self.refs = 0
+        self.evicted = False
+        self._lock = threading.Lock()
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Read without touching the shared file position (runs in a thread)"""
+        if hasattr(os, 'pread'):
+            return os.pread(self.file.fileno(), size, offset)
+        with self._lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+
+class FileHandleCache:
+    """LRU of open video files, so concurrent viewers share one descriptor
+
+    Handles are re-stat'ed at most every STREAM_STAT_TTL seconds; a file that
+    was replaced on disk gets a fresh handle (and so a new ETag). Evicted
+    handles stay open until the last viewer using them releases them.
+    """
+
+    def __init__(self, size: int, stat_ttl: float):
+        self.size = size
+        self.stat_ttl = stat_ttl
+        self._entries = OrderedDict()
+
+    def acquire(self, path: str) -> FileHandle:
+        """Return an open handle for path; raises FileNotFoundError"""
+        entry = self._entries.get(path)
+        if entry is not None and time.monotonic() - entry.checked_at > self.stat_ttl:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self._discard(path)
+                raise
+            if (stat.st_size, stat.st_mtime_ns) == (entry.size, entry.mtime_ns):
+                entry.checked_at = time.monotonic()
+            else:
+                self._discard(path)
+                entry = None
+
+        if entry is None:
+            entry = FileHandle(path)
+            self._entries[path] = entry
+            while len(self._entries) > self.size:
+                self._discard(next(iter(self._entries)))
+
+        self._entries.move_to_end(path)
+        entry.refs += 1
+        return entry
+
+    def release(self, entry: FileHandle):
+        entry.refs -= 1
+        if entry.refs == 0 and entry.evicted:
+            entry.close()
+
+    def _discard(self, path: str):
+        entry = self._entries.pop(path)
+        entry.evicted = True
+        if entry.refs == 0:
+            entry.close()
+
+    def close_all(self):
+        for path in list(self._entries):
+            self._discard(path)
+
+
+# Global handle cache (one per server process)
+handles = FileHandleCache(config.STREAM_HANDLE_CACHE_SIZE, config.STREAM_STAT_TTL)
+
+
+def parse_range(header: str, size: int):
+    """Parse a `bytes=` Range header into sorted, merged (start, end) pairs
+
+    Returns None when the header should be ignored (bad syntax, another unit,
+    or too many ranges), in which case the whole file is sent. Raises
+    RangeNotSatisfiable when no range overlaps the file.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    parts = [part.strip() for part in spec.split(',') if part.strip()]
+    if not parts:
+        return None
+    for part in parts:
+        first, dash, last = part.partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash:
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            if not last.isdigit():
+                return None
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size - 1))
+        else:
+            if not first.isdigit() or (last and not last.isdigit()):
+                return None
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            if start < size:
+                ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    # Overlapping or touching ranges are sent once, in file order
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > config.STREAM_MAX_RANGES:
+        return None
+    return merged
+
+
+def _parse_date(value: str):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match uses weak comparison, so W/ prefixes are ignored"""
+    if header.strip() == '*':
+        return True
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _not_modified(request: web.Request, entry: FileHandle) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, entry.etag)
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        since = _parse_date(if_modified_since)
+        return since is not None and entry.mtime_ns // 1_000_000_000 <= since
+    return False
+
+
+def _range_applies(request: web.Request, entry: FileHandle) -> bool:
+    """If-Range: only honour Range while the client's copy is still current"""
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Strong comparison; a weak validator never matches
+        return if_range == entry.etag
+    return if_range == entry.last_modified
+
+
+async def _copy(response: web.StreamResponse, entry: FileHandle, offset: int, count: int):
+    """Write a slice of the file in bounded chunks"""
+    loop = asyncio.get_running_loop()
+    while count > 0:
+        chunk = await loop.run_in_executor(
+            None, entry.read_at, offset, min(config.STREAM_CHUNK_SIZE, count)
+        )
+        if not chunk:
+            raise RuntimeError(f'{entry.path} shrank while streaming')
+        await response.write(chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+async def _sendfile(request: web.Request, entry: FileHandle, offset: int, count: int) -> bool:
+    """Let the kernel copy the slice straight to the socket; False if it can't"""
+    transport = request.transport
+    if (not config.STREAM_SENDFILE or transport is None
+            or transport.get_extra_info('sslcontext') is not None
+            or transport.get_extra_info('socket') is None):
+        return False
+    try:
+        await asyncio.get_running_loop().sendfile(transport, entry.file, offset, count, fallback=False)
+    except (NotImplementedError, asyncio.SendfileNotAvailableError):
+        return False
+    return True
+
+
+async def send_file(request: web.Request, path: str, content_type: str = 'application/octet-stream') -> web.StreamResponse:
+    """Stream a file with Range, multi-range and conditional request support
+
+    Raises FileNotFoundError before anything is sent if the file is missing.
+    """
+    entry = handles.acquire(path)
+    try:
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'ETag': entry.etag,
+            'Last-Modified': entry.last_modified,
+        }
+        if _not_modified(request, entry):
+            return web.Response(status=304, headers=headers)
+
+        ranges = None
+        range_header = request.headers.get('Range')
+        if range_header is not None and _range_applies(request, entry):
+            try:
+                ranges = parse_range(range_header, entry.size)
+            except RangeNotSatisfiable:
+                headers['Content-Range'] = f'bytes */{entry.size}'
+                return web.Response(status=416, headers=headers)
+
+        response = web.StreamResponse(headers=headers)
+        if ranges is None or len(ranges) == 1:
+            start, end = ranges[0] if ranges else (0, entry.size - 1)
+            count = end - start + 1 if entry.size else 0
+            if ranges:
+                response.set_status(206)
+                response.headers['Content-Range'] = f'bytes {start}-{end}/{entry.size}'
+            response.content_type = content_type
+            response.content_length = count
+            await response.prepare(request)
+            if request.method != 'HEAD' and count:
+                if await _sendfile(request, entry, start, count):
+                    await response.write_eof()
+                    return response
+                await _copy(response, entry, start, count)
+            await response.write_eof()
+            return response
+
+        # Several ranges: one multipart/byteranges body
+        boundary = secrets.token_hex(16)
+        part_headers = [
+            (f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+             f'Content-Range: bytes {start}-{end}/{entry.size}\r\n\r\n').encode()
+            for start, end in ranges
+        ]
+        closing = f'\r\n--{boundary}--\r\n'.encode()
+        response.set_status(206)
+        response.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        response.content_length = (
+            sum(len(head) for head in part_headers)
+            + sum(end - start + 1 for start, end in ranges)
+            + len(closing)
+        )
+        await response.prepare(request)
+        if request.method != 'HEAD':
+            for head, (start, end) in zip(part_headers, ranges):
+                await response.write(head)
+                await _copy(response, entry, start, end - start + 1)
+            await response.write(closing)
+        await response.write_eof()
+        return response
+    except ConnectionError:
+        # The viewer seeked or closed the player mid-stream
+        return response
+    finally:
+        handles.release(entry)
@@ -0,0 +1,229 @@
+from aiohttp import web
+from collections import OrderedDict
+import aiohttp
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+import config
+from webapp.streaming import send_file
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramFileError(Exception):
+    """getFile failed or Telegram would not serve the file"""
+
+
+class TelegramMedia:
+    """Serve Telegram-hosted videos without handing the bot token to clients
+
+    file_id -> file_path lookups are cached for TELEGRAM_FILE_PATH_TTL. A miss
+    on the disk cache streams the requested bytes straight through from
+    Telegram while a background download fills the cache, so later viewers
+    (and their Range requests) are served from TELEGRAM_CACHE_DIR. The cache
+    is trimmed to TELEGRAM_CACHE_MAX_BYTES, least recently served first.
+    """
+
+    def __init__(self):
+        self._session = None
+        self._file_paths = {}  # file_id -> (expires_at, file_path, file_size)
+        self._lookups = {}  # file_id -> in-flight getFile future
+        self._downloads = {}  # file_id -> background cache-fill task
+        self._download_slots = None
+        self._cache = None  # cache file name -> size, least recently served first
+        self._cache_bytes = 0
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, connect=10, sock_read=60),
+                auto_decompress=False,
+                headers={'Accept-Encoding': 'identity'},
+            )
+        return self._session
+
+    async def close(self):
+        """Cancel cache fills and close the HTTP session"""
+        for task in list(self._downloads.values()):
+            task.cancel()
+        await asyncio.gather(*self._downloads.values(), return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _file_url(self, file_path: str) -> str:
+        return f'{config.TELEGRAM_API_BASE}/file/bot{config.BOT_TOKEN}/{file_path}'
+
+    # getFile lookups
+    async def resolve(self, file_id: str):
+        """Return (file_path, file_size) for a file_id"""
+        cached = self._file_paths.get(file_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1], cached[2]
+
+        # Viewers arriving together share one getFile call
+        lookup = self._lookups.get(file_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._get_file(file_id))
+            self._lookups[file_id] = lookup
+            lookup.add_done_callback(lambda _: self._lookups.pop(file_id, None))
+        return await asyncio.shield(lookup)
+
+    async def _get_file(self, file_id: str):
+        url = f'{config.TELEGRAM_API_BASE}/bot{config.BOT_TOKEN}/getFile'
+        try:
+            async with self.session.get(url, params={'file_id': file_id}) as response:
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise TelegramFileError(f'getFile failed: {e}') from e
+
+        result = data.get('result') or {}
+        if not data.get('ok') or not result.get('file_path'):
+            raise TelegramFileError(data.get('description', 'getFile returned no file_path'))
+
+        now = time.monotonic()
+        if len(self._file_paths) >= 1000:
+            self._file_paths = {k: v for k, v in self._file_paths.items() if v[0] > now}
+        self._file_paths[file_id] = (now + config.TELEGRAM_FILE_PATH_TTL, result['file_path'], result.get('file_size'))
+        return result['file_path'], result.get('file_size')
+
+    # Disk cache
+    def _load_cache(self):
+        if self._cache is not None:
+            return
+        os.makedirs(config.TELEGRAM_CACHE_DIR, exist_ok=True)
+        files = []
+        with os.scandir(config.TELEGRAM_CACHE_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+        # Serving order is not persisted, so a restart falls back to download order
+        self._cache = OrderedDict((name, size) for _, name, size in sorted(files))
+        self._cache_bytes = sum(self._cache.values())
+
+    @staticmethod
+    def _cache_name(file_id: str) -> str:
+        return hashlib.sha256(file_id.encode()).hexdigest()[:32]
+
+    def cached_file(self, file_id: str):
+        """Path of the cached copy of file_id, or None"""
+        self._load_cache()
+        name = self._cache_name(file_id)
+        path = os.path.join(config.TELEGRAM_CACHE_DIR, name)
+        if not os.path.isfile(path):
+            if name in self._cache:
+                self._cache_bytes -= self._cache.pop(name)
+            return None
+        if name not in self._cache:
+            # Downloaded by another worker process
+            self._add_to_cache(name, os.path.getsize(path))
+        self._cache.move_to_end(name)
+        return path
+
+    def _add_to_cache(self, name: str, size: int):
+        self._cache[name] = size
+        self._cache_bytes += size
+        while self._cache_bytes > config.TELEGRAM_CACHE_MAX_BYTES and len(self._cache) > 1:
+            old_name, old_size = self._cache.popitem(last=False)
+            self._cache_bytes -= old_size
+            try:
+                # Viewers still streaming it keep their open handle
+                os.remove(os.path.join(config.TELEGRAM_CACHE_DIR, old_name))
+            except OSError:
+                pass
+
+    def prefetch(self, file_id: str, file_size: int = None):
+        """Start filling the disk cache for file_id in the background"""
+        if file_id in self._downloads:
+            return
+        if file_size and file_size > config.TELEGRAM_CACHE_MAX_BYTES:
+            return
+        task = asyncio.ensure_future(self._download(file_id))
+        self._downloads[file_id] = task
+        task.add_done_callback(lambda done: self._download_finished(file_id, done))
+
+    def _download_finished(self, file_id: str, task: asyncio.Task):
+        self._downloads.pop(file_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Caching Telegram file failed: {task.exception()}")
+
+    async def _download(self, file_id: str):
+        if self._download_slots is None:
+            self._download_slots = asyncio.Semaphore(config.TELEGRAM_CACHE_DOWNLOADS)
+        async with self._download_slots:
+            if self.cached_file(file_id):
+                return
+            file_path, _ = await self.resolve(file_id)
+            name = self._cache_name(file_id)
+            path = os.path.join(config.TELEGRAM_CACHE_DIR, name)
+            part = f'{path}.{os.getpid()}.part'
+            loop = asyncio.get_running_loop()
+            size = 0
+            try:
+                async with self.session.get(self._file_url(file_path)) as response:
+                    if response.status != 200:
+                        raise TelegramFileError(f'file download returned HTTP {response.status}')
+                    with open(part, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(config.STREAM_CHUNK_SIZE):
+                            await loop.run_in_executor(None, f.write, chunk)
+                            size += len(chunk)
+                os.replace(part, path)
+            except BaseException:
+                if os.path.exists(part):
+                    os.remove(part)
+                raise
+            self._add_to_cache(name, size)
+
+    # Serving
+    async def serve(self, request: web.Request, file_id: str, content_type: str, file_size: int = None) -> web.StreamResponse:
+        """Answer a request for file_id from the disk cache, or pass it through"""
+        path = self.cached_file(file_id)
+        if path:
+            try:
+                return await send_file(request, path, content_type=content_type)
+            except FileNotFoundError:
+                pass  # Evicted by another worker just now
+        self.prefetch(file_id, file_size)
+        return await self.passthrough(request, file_id, content_type)
+
+    async def passthrough(self, request: web.Request, file_id: str, content_type: str) -> web.StreamResponse:
+        """Relay the requested bytes from Telegram chunk by chunk"""
+        file_path, _ = await self.resolve(file_id)
+        headers = {}
+        if 'Range' in request.headers:
+            headers['Range'] = request.headers['Range']
+
+        try:
+            upstream = await self.session.get(self._file_url(file_path), headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TelegramFileError(f'file download failed: {e}') from e
+
+        async with upstream:
+            if upstream.status not in (200, 206, 416):
+                raise TelegramFileError(f'file download returned HTTP {upstream.status}')
+
+            response = web.StreamResponse(status=upstream.status)
+            for name in ('Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified'):
+                if name in upstream.headers:
+                    response.headers[name] = upstream.headers[name]
+            if upstream.content_length is not None:
+                response.content_length = upstream.content_length
+            response.content_type = content_type
+            await response.prepare(request)
+            try:
+                if request.method != 'HEAD':
+                    async for chunk in upstream.content.iter_chunked(config.STREAM_CHUNK_SIZE):
+                        await response.write(chunk)
+                await response.write_eof()
+            except ConnectionError:
+                pass  # The viewer seeked or closed the player mid-stream
+            return response
+
+
+# Global proxy instance (one per server process)
+telegram_media = TelegramMedia()
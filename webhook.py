@@ -0,0 +1,129 @@
+import asyncio
+import hmac
+import logging
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry the user who caused the update
+USER_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query',
+    'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+    'my_chat_member', 'chat_member', 'chat_join_request',
+)
+
+
+def update_user_id(data: dict) -> int:
+    """The sending user's id from a raw update, or 0 if it has none"""
+    for field in USER_FIELDS:
+        event = data.get(field)
+        if event and event.get('from'):
+            return event['from']['id']
+    return 0
+
+
+async def feed_raw_update(bot: Bot, dp: Dispatcher, data: dict):
+    """Parse a raw update and run it through the dispatcher"""
+    update = Update.model_validate(data, context={'bot': bot})
+    await dp.feed_update(bot, update)
+
+
+class UpdateLanes:
+    """Bounded queue of raw updates, processed in the background
+
+    Updates are spread over UPDATE_LANES lanes by user id and each lane is
+    worked by one task, so one user's updates are handled one at a time and
+    in order while different users proceed concurrently.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        lane_size = max(1, config.UPDATE_QUEUE_SIZE // config.UPDATE_LANES)
+        self._lanes = [asyncio.Queue(maxsize=lane_size) for _ in range(config.UPDATE_LANES)]
+        self._workers = []
+
+    def _lane(self, data: dict) -> asyncio.Queue:
+        return self._lanes[update_user_id(data) % len(self._lanes)]
+
+    def submit(self, data: dict) -> bool:
+        """Queue an update; False if its lane is full"""
+        try:
+            self._lane(data).put_nowait(data)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, data: dict):
+        """Queue an update, waiting for room in its lane"""
+        await self._lane(data).put(data)
+
+    def start(self):
+        """Start one worker task per lane"""
+        self._workers = [asyncio.ensure_future(self._work(lane)) for lane in self._lanes]
+
+    async def stop(self):
+        """Finish the queued updates (up to UPDATE_DRAIN_TIMEOUT), then stop"""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(lane.join() for lane in self._lanes)),
+                config.UPDATE_DRAIN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {sum(lane.qsize() for lane in self._lanes)} unprocessed updates")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self, lane: asyncio.Queue):
+        while True:
+            data = await lane.get()
+            try:
+                await self.process(data)
+            except Exception:
+                logger.exception("Failed to process update")
+            finally:
+                lane.task_done()
+
+
+class WebhookIntake:
+    """Accept Telegram webhook calls and hand the raw updates to `submit`
+
+    The handler only checks the secret token and queues the update, so
+    Telegram gets its 200 right away. `submit` returns False when the queue
+    is full; the handler then answers 503 and Telegram redelivers later.
+    """
+
+    def __init__(self, bot: Bot, submit, allowed_updates: list):
+        self.bot = bot
+        self.submit = submit
+        self.allowed_updates = allowed_updates
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """POST handler for WEBHOOK_PATH"""
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), config.WEBHOOK_SECRET.encode()):
+            return web.Response(status=401)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        if not self.submit(data):
+            logger.warning("Update queue full, asking Telegram to retry later")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def register(self):
+        """Point Telegram at this server's webhook URL"""
+        await self.bot.set_webhook(
+            url=config.WEBHOOK_BASE_URL.rstrip('/') + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=self.allowed_updates,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )